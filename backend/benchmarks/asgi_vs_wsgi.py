@@ -0,0 +1,154 @@
+"""
+Upload throughput and memory: the synchronous endpoint served WSGI-style (one
+thread per in-flight request, like gunicorn --threads) against the async endpoint
+on a single event loop (like one uvicorn worker).
+
+Both use the offline `fake` backend, whose latency stands in for the provider.
+Requests go through Django's in-process test handlers, so this measures the
+application rather than an HTTP server. Each mode and concurrency level runs in
+its own subprocess, so peak RSS and thread counts are not shared.
+
+Usage (from backend/):
+    python benchmarks/asgi_vs_wsgi.py [--concurrency 16,64,256] [--requests 512] [--latency 0.2]
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from suite import latency_summary, parse_ints, peak_rss_mb, setup_django
+from synthetic import make_receipt_pdf
+
+MODES = {
+    'wsgi': '/api/upload/',
+    'asgi': '/api/async/upload/',
+}
+
+
+class ThreadSampler:
+    """Records the highest number of live threads while running."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_wsgi(documents, concurrency):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import Client
+
+    local = threading.local()
+
+    def upload(document):
+        name, data = document
+        if not hasattr(local, 'client'):
+            local.client = Client(raise_request_exception=False) # Report 500s like a real server
+        started = time.perf_counter()
+        response = local.client.post(MODES['wsgi'], {'file': SimpleUploadedFile(name, data, 'application/pdf')})
+        return time.perf_counter() - started, response.status_code
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(upload, documents))
+
+def run_asgi(documents, concurrency):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import AsyncClient
+
+    async def main():
+        slots = asyncio.Semaphore(concurrency)
+
+        async def upload(document):
+            name, data = document
+            async with slots:
+                started = time.perf_counter()
+                response = await AsyncClient(raise_request_exception=False).post(MODES['asgi'], {'file': SimpleUploadedFile(name, data, 'application/pdf')})
+                return time.perf_counter() - started, response.status_code
+
+        return await asyncio.gather(*(upload(document) for document in documents))
+
+    return asyncio.run(main())
+
+def run_one(args):
+    """Runs one mode at one concurrency level in this process and prints the JSON result."""
+    with tempfile.TemporaryDirectory(prefix='receipt-bench-') as workdir:
+        setup_django(argparse.Namespace(backend='fake', latency=args.latency, no_cache=True), workdir)
+        documents = [(f'bench-{i}.pdf', make_receipt_pdf(i)) for i in range(args.requests)]
+        baseline_threads = threading.active_count()
+        runner = run_wsgi if args.run == 'wsgi' else run_asgi
+        with ThreadSampler() as threads:
+            started = time.perf_counter()
+            results = runner(documents, args.concurrency[0])
+            wall = time.perf_counter() - started
+
+    statuses = {}
+    for _, code in results:
+        statuses[str(code)] = statuses.get(str(code), 0) + 1
+    print(json.dumps({
+        'mode': args.run,
+        'concurrency': args.concurrency[0],
+        'requests': len(results),
+        'requests_per_second': round(len(results) / wall, 2),
+        'latency': latency_summary([seconds for seconds, _ in results]),
+        'status_codes': statuses,
+        'peak_threads': threads.peak - baseline_threads + 1,
+        'peak_rss_mb': peak_rss_mb(),
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=parse_ints, default=[16, 64, 256])
+    parser.add_argument('--requests', type=int, default=512, help='Uploads per run')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds the fake provider takes per receipt')
+    parser.add_argument('--modes', default='wsgi,asgi')
+    parser.add_argument('--run', choices=sorted(MODES), help=argparse.SUPPRESS) # Internal: one measurement per subprocess
+    parser.add_argument('--output', help='Write the JSON result to this file as well as stdout')
+    args = parser.parse_args()
+
+    if args.run:
+        run_one(args)
+        return
+
+    runs = []
+    for concurrency in args.concurrency:
+        for mode in args.modes.split(','):
+            command = [
+                sys.executable, os.path.abspath(__file__), '--run', mode, '--concurrency', str(concurrency),
+                '--requests', str(args.requests), '--latency', str(args.latency),
+            ]
+            env = dict(os.environ, PYTHONWARNINGS='ignore')
+            output = subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    result = json.dumps({
+        'benchmark': 'asgi_vs_wsgi',
+        'options': {'requests': args.requests, 'latency_s': args.latency},
+        'runs': runs,
+    }, indent=2)
+    print(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
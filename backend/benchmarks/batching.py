@@ -0,0 +1,150 @@
+"""
+Request batching benchmark: receipts per second through the Gemini extractor,
+one request per receipt ('gemini') against several receipts per request
+('gemini-batch', at each --batch-sizes).
+
+The provider is a local fake behind the real ExtractionClient (in-flight cap,
+no rate limiter). A request costs --overhead seconds plus --per-document
+seconds for every receipt in it, standing in for connection setup, prompt
+tokens and queueing on one side and the model's work per document on the other.
+--malformed is the share of documents whose part of a batched answer is
+unusable, so they are sent again on their own.
+
+--concurrency threads extract --receipts synthetic text PDFs (through the real
+preprocessing), like the worker pool or the segments of split PDFs would.
+
+Usage (from backend/):
+    python benchmarks/batching.py [--receipts 96] [--concurrency 32] [--batch-sizes 4,8,16] [--overhead 0.8]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from suite import BACKEND_DIR, latency_summary, parse_ints
+from synthetic import make_receipt_pdf
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+    def resolve(self):
+        pass
+
+
+class FakeProvider:
+    """generate_content stand-in; answers every document with its own receipt number."""
+
+    def __init__(self, overhead, per_document, malformed, seed=0):
+        self.overhead, self.per_document, self.malformed = overhead, per_document, malformed
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.documents = 0
+
+    def __call__(self, contents):
+        documents = [part['inline_data']['data'] for part in contents if 'inline_data' in part]
+        with self.lock:
+            self.requests += 1
+            self.documents += len(documents)
+            broken = {index for index in range(len(documents)) if len(documents) > 1 and self.rng.random() < self.malformed}
+        time.sleep(self.overhead + self.per_document * len(documents))
+        answers = []
+        for index, data in enumerate(documents):
+            if index in broken:
+                continue
+            answers.append({
+                'document': index,
+                'merchant_name': f'Merchant {len(data)}',
+                'purchase_date': '2025-07-29',
+                'total_amount': '$12.34',
+                'items': [],
+            })
+        if len(documents) == 1:
+            del answers[0]['document']
+            return FakeResponse(json.dumps(answers[0]))
+        return FakeResponse('```json\n' + json.dumps(answers) + '\n```')
+
+def run(backend, batch_size, corpus, args):
+    from django.conf import settings
+    from receipts import batching, utils
+    from receipts.backends import get_backend
+    from receipts.client import ExtractionClient
+
+    settings.GEMINI_BATCH_MAX_ITEMS = batch_size
+    provider = FakeProvider(args.overhead, args.per_document, args.malformed)
+    utils._gemini_client = ExtractionClient(provider, max_in_flight=args.in_flight, max_retries=0)
+    utils._gemini_batcher = None # Rebuilt with this run's batch size
+    batching.reset_batching_stats()
+    extract = get_backend(backend)
+
+    def timed_extract(data):
+        started = time.perf_counter()
+        parsed_data, raw_response = extract(None, data)
+        if parsed_data is None:
+            raise RuntimeError(raw_response)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = list(executor.map(timed_extract, corpus))
+    elapsed = time.perf_counter() - started
+    return {
+        'backend': backend,
+        'batch_size': batch_size if backend == 'gemini-batch' else 1,
+        'seconds': round(elapsed, 3),
+        'receipts_per_second': round(len(corpus) / elapsed, 2),
+        'requests': provider.requests,
+        'retried_alone': batching.get_batching_stats()['retried'],
+        'latency': latency_summary(latencies),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--receipts', type=int, default=96, help='Receipts extracted per run')
+    parser.add_argument('--concurrency', type=int, default=32, help='Threads extracting at once')
+    parser.add_argument('--batch-sizes', type=parse_ints, default=[4, 8, 16], help='GEMINI_BATCH_MAX_ITEMS values to run')
+    parser.add_argument('--max-wait-ms', type=int, default=50, help='GEMINI_BATCH_MAX_WAIT_MS')
+    parser.add_argument('--overhead', type=float, default=0.8, help='Fake provider seconds per request')
+    parser.add_argument('--per-document', type=float, default=0.1, help='Fake provider seconds per receipt in a request')
+    parser.add_argument('--malformed', type=float, default=0.05, help='Share of batched answers that are unusable')
+    parser.add_argument('--in-flight', type=int, default=4, help='GEMINI_MAX_IN_FLIGHT')
+    parser.add_argument('--output', help='Write the JSON result to this file as well as stdout')
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'receipt_manager.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    settings.GEMINI_BATCH_MAX_WAIT_MS = args.max_wait_ms
+
+    corpus = [make_receipt_pdf(index) for index in range(args.receipts)]
+    runs = [run('gemini', 1, corpus, args)]
+    print(json.dumps(runs[-1]), file=sys.stderr)
+    for batch_size in args.batch_sizes:
+        runs.append(run('gemini-batch', batch_size, corpus, args))
+        print(json.dumps(runs[-1]), file=sys.stderr)
+
+    result = json.dumps({
+        'benchmark': 'batching',
+        'options': {
+            'receipts': args.receipts, 'concurrency': args.concurrency, 'overhead': args.overhead,
+            'per_document': args.per_document, 'malformed': args.malformed, 'in_flight': args.in_flight,
+            'max_wait_ms': args.max_wait_ms,
+        },
+        'runs': runs,
+    }, indent=2)
+    print(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
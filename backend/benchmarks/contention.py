@@ -0,0 +1,151 @@
+"""
+Concurrent-writer contention on SQLite: N threads upload receipts at once through
+POST /api/upload/ and we count how many fail with "database is locked".
+
+Two database profiles are compared, each in its own subprocess on a fresh database:
+  legacy  rollback journal, default 5s busy timeout, deferred transactions,
+          a new connection per request
+  tuned   the project settings: WAL, SQLITE_BUSY_TIMEOUT, IMMEDIATE transactions,
+          persistent connections (DATABASE_CONN_MAX_AGE)
+
+Each run also records the write statements (INSERT/UPDATE/DELETE) one upload issues.
+
+Usage (from backend/):
+    python benchmarks/contention.py [--writers 8,32] [--uploads 20] [--latency 0]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from suite import latency_summary, parse_ints, setup_django
+from synthetic import make_receipt_pdf
+
+PROFILES = ('legacy', 'tuned')
+WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+def apply_profile(profile):
+    from django.conf import settings
+    database = settings.DATABASES['default']
+    if profile == 'legacy':
+        database['OPTIONS'] = {}
+        database['CONN_MAX_AGE'] = 0
+        database['CONN_HEALTH_CHECKS'] = False
+
+def count_upload_writes(client):
+    """Write statements issued by one successful upload."""
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.post('/api/upload/', {'file': SimpleUploadedFile('probe.pdf', make_receipt_pdf(10 ** 6), 'application/pdf')})
+    writes = [query['sql'] for query in queries.captured_queries if query['sql'].lstrip().upper().startswith(WRITE_PREFIXES)]
+    return response.status_code, len(writes)
+
+def run_one(args):
+    """Runs one profile at one writer count in this process and prints the JSON result."""
+    with tempfile.TemporaryDirectory(prefix='receipt-bench-') as workdir:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'receipt_manager.settings')
+        from django.conf import settings
+        settings.DATABASES['default'] # Load settings before setup_django edits them
+        apply_profile(args.run)
+        setup_django(argparse.Namespace(backend='fake', latency=args.latency, no_cache=args.no_cache), workdir)
+
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.db import connection
+        from django.test import Client
+
+        writers = args.writers[0]
+        documents = [(f'bench-{i}.pdf', make_receipt_pdf(i)) for i in range(writers * args.uploads)]
+        latencies, statuses, errors = [], {}, set()
+        lock = threading.Lock()
+        start = threading.Barrier(writers)
+
+        def writer(batch):
+            client = Client(raise_request_exception=False) # Report 500s like a real server
+            start.wait()
+            try:
+                for name, data in batch:
+                    started = time.perf_counter()
+                    response = client.post('/api/upload/', {'file': SimpleUploadedFile(name, data, 'application/pdf')})
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        latencies.append(elapsed)
+                        statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+                        if response.status_code >= 500 and len(errors) < 3:
+                            errors.add(response.content[:160].decode('utf-8', 'replace'))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=writer, args=(documents[i::writers],)) for i in range(writers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+
+        probe_status, writes_per_upload = count_upload_writes(Client(raise_request_exception=False))
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            journal_mode = cursor.fetchone()[0]
+
+    print(json.dumps({
+        'profile': args.run,
+        'journal_mode': journal_mode,
+        'writers': writers,
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / wall, 2),
+        'succeeded': statuses.get('201', 0),
+        'failed': sum(count for code, count in statuses.items() if code.startswith('5')),
+        'status_codes': statuses,
+        'latency': latency_summary(latencies),
+        'writes_per_upload': writes_per_upload if probe_status == 201 else None,
+        'sample_errors': sorted(errors),
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=parse_ints, default=[8, 32], help='Concurrent uploading threads')
+    parser.add_argument('--uploads', type=int, default=20, help='Uploads per writer')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the fake provider takes per receipt')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the extraction cache (one less write per upload)')
+    parser.add_argument('--profiles', default=','.join(PROFILES))
+    parser.add_argument('--run', choices=PROFILES, help=argparse.SUPPRESS) # Internal: one measurement per subprocess
+    parser.add_argument('--output', help='Write the JSON result to this file as well as stdout')
+    args = parser.parse_args()
+
+    if args.run:
+        run_one(args)
+        return
+
+    runs = []
+    for writers in args.writers:
+        for profile in args.profiles.split(','):
+            command = [
+                sys.executable, os.path.abspath(__file__), '--run', profile, '--writers', str(writers),
+                '--uploads', str(args.uploads), '--latency', str(args.latency),
+            ] + (['--no-cache'] if args.no_cache else [])
+            env = dict(os.environ, PYTHONWARNINGS='ignore')
+            output = subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    result = json.dumps({
+        'benchmark': 'contention',
+        'options': {'uploads_per_writer': args.uploads, 'latency_s': args.latency, 'cache': not args.no_cache},
+        'runs': runs,
+    }, indent=2)
+    print(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Export memory benchmark: peak RSS of GET /api/receipts/export/ as the table grows.
+
+The table is grown to each --rows size once (bulk inserts, like the suite's list
+section). Every format is then exported by a fresh subprocess, so each measurement
+has its own high-water mark: the process warms up with a small export, records its
+RSS, streams the full export through the test client (bytes are counted and
+dropped, like a client writing to disk) and reports how much the peak grew.
+
+The `serialized` mode is the old way of getting everything: the full list through
+ReceiptDetailSerializer, held in memory. It is only run up to --serialized-max-rows.
+
+Usage (from backend/):
+    python benchmarks/export.py [--rows 1000,100000,1000000] [--formats csv,ndjson,parquet,serialized]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from suite import parse_ints, peak_rss_mb, seed_receipts, setup_django
+
+FORMATS = ('csv', 'ndjson', 'parquet', 'serialized')
+
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return round(pages * resource.getpagesize() / (1024 * 1024), 1)
+
+def run_one(args):
+    """Exports the seeded database in one format in this process and prints the JSON result."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'receipt_manager.settings')
+    import django
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = args.database
+    settings.DEBUG = False
+    settings.ALLOWED_HOSTS = ['testserver']
+    django.setup()
+
+    from django.test import Client
+    from receipts.models import Receipt
+    from receipts.serializers import ReceiptDetailSerializer
+
+    def export():
+        if args.run == 'serialized':
+            receipts = Receipt.objects.select_related('receipt_file').prefetch_related('items').order_by('id')
+            data = json.dumps(ReceiptDetailSerializer(receipts, many=True).data).encode('utf-8')
+            return Receipt.objects.count(), len(data)
+        response = Client().get('/api/receipts/export/', {'format': args.run})
+        if response.status_code != 200:
+            return None, response.json()['error']
+        size = 0
+        for piece in response.streaming_content:
+            size += len(piece)
+        response.close()
+        return Receipt.objects.count(), size
+
+    # Warm-up: imports, connection and query compilation shouldn't count as export memory
+    Receipt.objects.count()
+    Client().get('/api/receipts/export/', {'format': 'csv', 'purchased_after': '2100-01-01'})
+    baseline = max(current_rss_mb(), peak_rss_mb())
+
+    started = time.perf_counter()
+    rows, size = export()
+    elapsed = time.perf_counter() - started
+    if rows is None:
+        print(json.dumps({'format': args.run, 'skipped': size}))
+        return
+    peak = peak_rss_mb()
+    print(json.dumps({
+        'format': args.run,
+        'rows': rows,
+        'bytes': size,
+        'seconds': round(elapsed, 2),
+        'rows_per_second': round(rows / elapsed) if elapsed else None,
+        'baseline_rss_mb': baseline,
+        'peak_rss_mb': peak,
+        'export_rss_mb': round(peak - baseline, 1),
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=parse_ints, default=[1000, 100_000, 1_000_000])
+    parser.add_argument('--formats', default=','.join(FORMATS))
+    parser.add_argument('--serialized-max-rows', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--run', choices=FORMATS, help=argparse.SUPPRESS) # Internal: one export per subprocess
+    parser.add_argument('--database', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='Write the JSON result to this file as well as stdout')
+    args = parser.parse_args()
+
+    if args.run:
+        run_one(args)
+        return
+
+    formats = [name for name in args.formats.split(',') if name]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        parser.error(f"unknown formats: {', '.join(sorted(unknown))}")
+
+    runs = []
+    with tempfile.TemporaryDirectory(prefix='receipt-bench-') as workdir:
+        setup_django(argparse.Namespace(backend='fake', latency=0.0, no_cache=False), workdir)
+        from django.db import connection
+        for rows in sorted(args.rows):
+            seed_seconds = seed_receipts(rows, args.seed)
+            connection.close() # Let the subprocesses see every committed row
+            for name in formats:
+                if name == 'serialized' and rows > args.serialized_max_rows:
+                    continue
+                command = [sys.executable, os.path.abspath(__file__), '--run', name, '--database', os.path.join(workdir, 'bench.sqlite3')]
+                env = dict(os.environ, PYTHONWARNINGS='ignore')
+                output = subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout
+                run = json.loads(output.strip().splitlines()[-1])
+                run.update({'table_rows': rows, 'seed_seconds': round(seed_seconds, 2)})
+                runs.append(run)
+                print(json.dumps(run), file=sys.stderr)
+
+    result = json.dumps({'benchmark': 'export', 'runs': runs}, indent=2)
+    print(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Near-duplicate benchmark for receipts.near_duplicates: how well the first-page
+perceptual hash recognises rescans, what it costs, and how fast the index is.
+
+Accuracy: every synthetic receipt is hashed as a text PDF and as phone scans of
+it (paper texture, JPEG) at each of --dpis. A rescan is found when its hash is
+within RECEIPT_NEAR_DUPLICATE_MAX_DISTANCE bits of the original's; two different
+receipts within that distance would be a false match. All synthetic receipts
+share one layout, so this is the hard case for telling receipts apart.
+
+Index: lookup latency of the multi-index against checking every hash, at each
+--index-sizes. 'varied' hashes are random (files of many different layouts);
+'one_template' hashes are assembled from the rows of real receipt hashes, which
+is what a table full of one shop's receipts looks like.
+
+Usage (from backend/):
+    python benchmarks/near_duplicates.py [--receipts 24] [--dpis 150,200] [--index-sizes 10000,100000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from suite import BACKEND_DIR, latency_summary, parse_ints
+from synthetic import make_receipt_pdf, make_scanned_receipt_pdf
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+def bench_accuracy(args):
+    from django.conf import settings
+    from receipts.near_duplicates import perceptual_hash, hamming_distance
+
+    max_distance = settings.RECEIPT_NEAR_DUPLICATE_MAX_DISTANCE
+    originals, rescans, seconds = [], [], []
+    for index in range(args.receipts):
+        value, elapsed = timed(perceptual_hash, make_receipt_pdf(index))
+        originals.append(int(value, 16))
+        seconds.append(elapsed)
+        for dpi in args.dpis:
+            # make_receipt_pdf(index) prints the lines of receipt index * 10_000 on its first page
+            scan = make_scanned_receipt_pdf(index * 10_000, dpi=dpi, seed=0, quality=60)
+            value, elapsed = timed(perceptual_hash, scan)
+            rescans.append(hamming_distance(originals[-1], int(value, 16)))
+            seconds.append(elapsed)
+
+    different = [
+        hamming_distance(originals[i], originals[j])
+        for i in range(len(originals)) for j in range(i + 1, len(originals))
+    ]
+    return {
+        'receipts': args.receipts,
+        'max_distance': max_distance,
+        'rescan_distance_max': max(rescans),
+        'rescan_distance_median': sorted(rescans)[len(rescans) // 2],
+        'rescans_found': round(sum(distance <= max_distance for distance in rescans) / len(rescans), 4),
+        'different_distance_min': min(different),
+        'false_matches': sum(distance <= max_distance for distance in different),
+        'hash': latency_summary(seconds),
+    }
+
+def template_hashes(count):
+    """Row-wise recombinations of real hashes, like a table of receipts from one template."""
+    from receipts.near_duplicates import perceptual_hash, HASH_HEIGHT, HASH_WIDTH
+    row_bits = HASH_WIDTH - 1
+    rows = []
+    for index in range(64):
+        value = int(perceptual_hash(make_receipt_pdf(index)), 16)
+        rows.append([(value >> (row * row_bits)) & ((1 << row_bits) - 1) for row in range(HASH_HEIGHT)])
+    rng = random.Random(0)
+    return [
+        sum(rows[rng.randrange(len(rows))][row] << (row * row_bits) for row in range(HASH_HEIGHT))
+        for _ in range(count)
+    ]
+
+def bench_index(args):
+    from django.conf import settings
+    from receipts.near_duplicates import MultiIndexHash, HASH_BITS, INDEX_CHUNKS
+
+    max_distance = settings.RECEIPT_NEAR_DUPLICATE_MAX_DISTANCE
+    rng = random.Random(1)
+    runs = []
+    for size in args.index_sizes:
+        for kind in ('varied', 'one_template'):
+            if kind == 'varied':
+                hashes = [rng.getrandbits(HASH_BITS) for _ in range(size + args.queries)]
+            else:
+                hashes = template_hashes(size + args.queries)
+            stored, queries = hashes[:size], hashes[size:]
+
+            table = MultiIndexHash(HASH_BITS, INDEX_CHUNKS)
+            started = time.perf_counter()
+            for item, value in enumerate(stored):
+                table.add(value, item)
+            build = time.perf_counter() - started
+
+            indexed, scanned = [], []
+            for query in queries:
+                indexed.append(timed(table.search, query, max_distance)[1])
+                scanned.append(timed(lambda: [v for v in stored if (query ^ v).bit_count() <= max_distance])[1])
+            result = {
+                'size': size,
+                'hashes': kind,
+                'build_seconds': round(build, 3),
+                'index': latency_summary(indexed),
+                'scan': latency_summary(scanned),
+            }
+            runs.append(result)
+            print(json.dumps(result), file=sys.stderr)
+    return runs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--receipts', type=int, default=24, help='Synthetic receipts for the accuracy run')
+    parser.add_argument('--dpis', type=parse_ints, default=[150, 200], help='Scan resolutions of the rescans')
+    parser.add_argument('--index-sizes', type=parse_ints, default=[10_000, 100_000], help='Hashes in the index')
+    parser.add_argument('--queries', type=int, default=50, help='Lookups per index size')
+    parser.add_argument('--output', help='Write the JSON result to this file as well as stdout')
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'receipt_manager.settings')
+    import django
+    django.setup()
+
+    result = json.dumps({
+        'benchmark': 'near_duplicates',
+        'accuracy': bench_accuracy(args),
+        'index': bench_index(args),
+    }, indent=2)
+    print(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Payload preprocessing benchmark: how much receipts.preprocess shrinks what is sent
+to the extraction model, and what that does to per-receipt latency.
+
+The synthetic corpus mixes phone-scan-like PDFs (one JPEG per page at 200-400 DPI,
+some with a blank page or a repeated page) with small digitally generated PDFs.
+Each mode is run over the whole corpus:
+  off        the PDF as stored
+  pdf        blank/duplicate pages dropped, images downsampled (the default)
+  rasterize  the kept pages as one JPEG (PDF_PREPROCESS_RASTERIZE)
+
+Latency per receipt is the measured preprocessing time plus the time to upload
+the payload at --uplink-mbps. Model-side time also grows with payload size but
+is not simulated.
+
+Usage (from backend/):
+    python benchmarks/preprocess.py [--receipts 24] [--dpi 150] [--uplink-mbps 10] [--output preprocess.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+from suite import BACKEND_DIR, latency_summary
+from synthetic import make_receipt_pdf, make_scanned_receipt_pdf
+
+MODES = ('off', 'pdf', 'rasterize')
+SCAN_DPIS = (200, 300, 400)
+
+
+def build_corpus(count):
+    """Three scans for every digital PDF; every third scan has a blank page, every fourth a repeated page."""
+    corpus = []
+    for index in range(count):
+        if index % 4 == 3:
+            corpus.append(('digital', make_receipt_pdf(index)))
+        else:
+            corpus.append(('scan', make_scanned_receipt_pdf(
+                index, dpi=SCAN_DPIS[index % len(SCAN_DPIS)],
+                blank_pages=1 if index % 3 == 0 else 0, duplicate_pages=1 if index % 4 == 0 else 0,
+            )))
+    return corpus
+
+def run_mode(mode, corpus, args):
+    from receipts.preprocess import shrink_pdf
+
+    sizes, seconds, latencies, dropped = [], [], [], 0
+    for _, data in corpus:
+        started = time.perf_counter()
+        if mode == 'off':
+            payload = data
+        else:
+            result = shrink_pdf(data, target_dpi=args.dpi, quality=args.quality, rasterize=mode == 'rasterize')
+            payload = result.data
+            dropped += result.pages_dropped
+        elapsed = time.perf_counter() - started
+        upload = len(payload) * 8 / (args.uplink_mbps * 1_000_000)
+        sizes.append(len(payload))
+        seconds.append(elapsed)
+        latencies.append(elapsed + upload)
+
+    original = sum(len(data) for _, data in corpus)
+    return {
+        'mode': mode,
+        'total_bytes': sum(sizes),
+        'median_bytes': int(statistics.median(sizes)),
+        'reduction': round(1 - sum(sizes) / original, 4),
+        'pages_dropped': dropped,
+        'preprocess': latency_summary(seconds),
+        'preprocess_plus_upload': latency_summary(latencies),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--receipts', type=int, default=24, help='Corpus size')
+    parser.add_argument('--dpi', type=int, default=150, help='Target DPI (PDF_PREPROCESS_TARGET_DPI)')
+    parser.add_argument('--quality', type=int, default=75, help='JPEG quality (PDF_PREPROCESS_JPEG_QUALITY)')
+    parser.add_argument('--uplink-mbps', type=float, default=10.0, help='Upload bandwidth to the model provider')
+    parser.add_argument('--output', help='Write the JSON result to this file as well as stdout')
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'receipt_manager.settings')
+    import django
+    django.setup()
+
+    corpus = build_corpus(args.receipts)
+    result = json.dumps({
+        'benchmark': 'preprocess',
+        'options': {'target_dpi': args.dpi, 'jpeg_quality': args.quality, 'uplink_mbps': args.uplink_mbps},
+        'corpus': {
+            'receipts': len(corpus),
+            'scans': sum(1 for kind, _ in corpus if kind == 'scan'),
+            'bytes': sum(len(data) for _, data in corpus),
+        },
+        'runs': [run_mode(mode, corpus, args) for mode in MODES],
+    }, indent=2)
+    print(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
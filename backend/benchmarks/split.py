@@ -0,0 +1,122 @@
+"""
+Multi-receipt PDF benchmark: wall-clock time of POST /api/upload/?split=pages for
+a stack of receipts, with the segments extracted one at a time
+(RECEIPT_SPLIT_MAX_WORKERS = 1) and concurrently (--workers).
+
+The extractor sleeps a different time for every page (0.5x to 1.5x --latency,
+picked from the page's bytes), standing in for a model whose latency varies.
+Each run reports the sum of the page latencies and the slowest one: sequential
+extraction takes about the sum, concurrent extraction about the slowest page
+(as long as there are no more pages than workers).
+
+Usage (from backend/):
+    python benchmarks/split.py [--pages 1,4,8,16] [--latency 0.5] [--workers 8]
+"""
+import argparse
+import hashlib
+import json
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import fitz  # PyMuPDF
+
+from suite import parse_ints, setup_django
+from synthetic import receipt_lines
+
+_sleeps = []
+_sleeps_lock = threading.Lock()
+_latency = 0.5
+
+
+def uneven_extractor(pdf_path, pdf_data=None):
+    """Fake extractor whose latency depends on the page it is given."""
+    from receipts.utils import fake_extract_details
+    digest = hashlib.sha256(bytes(pdf_data)).digest() # Split pages always come as bytes
+    seconds = _latency * (0.5 + digest[0] / 255)
+    with _sleeps_lock:
+        _sleeps.append(seconds)
+    time.sleep(seconds)
+    return fake_extract_details(pdf_path, pdf_data)
+
+def make_stack_pdf(receipts, first_index):
+    """One receipt per page."""
+    doc = fitz.open()
+    for index in range(first_index, first_index + receipts):
+        page = doc.new_page()
+        y = 72
+        for line in receipt_lines(index):
+            page.insert_text((72, y), line, fontname='cour', fontsize=10)
+            y += 14
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+def run(client, pages, workers, first_index):
+    from django.conf import settings
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from receipts.jobs import shutdown_executor
+
+    shutdown_executor() # The segment pool is sized when it is first used
+    settings.RECEIPT_SPLIT_MAX_WORKERS = workers
+    _sleeps.clear()
+    upload = SimpleUploadedFile('stack.pdf', make_stack_pdf(pages, first_index), content_type='application/pdf')
+    started = time.perf_counter()
+    response = client.post('/api/upload/?split=pages', {'file': upload})
+    elapsed = time.perf_counter() - started
+    if response.status_code != 201:
+        raise RuntimeError(f"Upload failed with {response.status_code}: {response.content[:200]!r}")
+    return {
+        'receipts': len(response.json()['extracted_receipts']),
+        'seconds': elapsed,
+        'sum_of_pages': sum(_sleeps),
+        'slowest_page': max(_sleeps),
+    }
+
+def main():
+    global _latency
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=parse_ints, default=[1, 4, 8, 16], help='Receipts per PDF')
+    parser.add_argument('--latency', type=float, default=0.5, help='Mean seconds per page')
+    parser.add_argument('--workers', type=int, default=8, help='RECEIPT_SPLIT_MAX_WORKERS for the concurrent runs')
+    parser.add_argument('--repeat', type=int, default=3, help='Uploads per measurement; the median is reported')
+    parser.add_argument('--output', help='Write the JSON result to this file as well as stdout')
+    args = parser.parse_args()
+    _latency = args.latency
+
+    runs = []
+    with tempfile.TemporaryDirectory(prefix='receipt-bench-') as workdir:
+        setup_django(argparse.Namespace(backend='__main__.uneven_extractor', latency=0.0, no_cache=True), workdir)
+        from django.test import Client
+        client = Client()
+        first_index = 0
+        for pages in args.pages:
+            for mode, workers in (('sequential', 1), ('concurrent', args.workers)):
+                samples = []
+                for _ in range(args.repeat):
+                    samples.append(run(client, pages, workers, first_index))
+                    first_index += pages # New receipts every time
+                median = sorted(samples, key=lambda sample: sample['seconds'])[len(samples) // 2]
+                result = {
+                    'pages': pages,
+                    'mode': mode,
+                    'workers': workers,
+                    'seconds': round(median['seconds'], 3),
+                    'sum_of_pages': round(median['sum_of_pages'], 3),
+                    'slowest_page': round(median['slowest_page'], 3),
+                    'seconds_stdev': round(statistics.pstdev(sample['seconds'] for sample in samples), 3),
+                }
+                runs.append(result)
+                print(json.dumps(result), file=sys.stderr)
+
+    output = json.dumps({'benchmark': 'split', 'latency': args.latency, 'runs': runs}, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Startup benchmark: how long a fresh interpreter takes to import the WSGI app,
+and to import the URLconf (which loads every view, i.e. the first request).
+
+Each sample runs in a new subprocess so nothing is already in sys.modules.
+
+Usage (from backend/):
+    python benchmarks/startup.py [--runs 10] [--output startup.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('google.generativeai', 'fitz', 'pymupdf')
+
+SNIPPET = """
+import json, sys, time
+start = time.perf_counter()
+import receipt_manager.wsgi
+wsgi = time.perf_counter() - start
+import receipt_manager.urls
+urls = time.perf_counter() - start
+print(json.dumps({'wsgi': wsgi, 'urls': urls, 'loaded': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def sample():
+    env = dict(os.environ, PYTHONWARNINGS='ignore')
+    output = subprocess.run(
+        [sys.executable, '-c', SNIPPET % (HEAVY_MODULES,)],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def summarize(values):
+    return {
+        'median_ms': round(statistics.median(values) * 1000, 2),
+        'min_ms': round(min(values) * 1000, 2),
+        'max_ms': round(max(values) * 1000, 2),
+    }
+
+def run(runs):
+    samples = [sample() for _ in range(runs)]
+    return {
+        'benchmark': 'startup',
+        'python': sys.version.split()[0],
+        'runs': runs,
+        'import_wsgi': summarize([s['wsgi'] for s in samples]),
+        'import_urls': summarize([s['urls'] for s in samples]),
+        'heavy_modules_loaded': samples[-1]['loaded'],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output', help='Write the JSON result to this file as well as stdout')
+    args = parser.parse_args()
+
+    result = json.dumps(run(args.runs), indent=2)
+    print(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""
+Benchmark suite for the receipt API, run against a throwaway database and
+MEDIA_ROOT with an offline extraction backend.
+
+Sections:
+  upload      POST /api/upload/ requests per second at each concurrency level
+  validation  validate_pdf / quick_validate_pdf cost per page count
+  list        GET /api/receipts/ and /api/receipts/<id>/ latency at each table size
+  search      search index rebuild time and GET /api/receipts/search/ latency at each table size
+
+Every section also records the process's peak RSS (high-water mark) when it ends.
+Results are printed as JSON (and written to --output), so runs can be diffed.
+
+Usage (from backend/):
+    python benchmarks/suite.py --quick
+    python benchmarks/suite.py --rows 10000,100000,1000000 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from synthetic import make_receipt_pdf  # noqa: E402
+
+SEED_BATCH_SIZE = 5000
+
+
+def parse_ints(value):
+    return [int(part) for part in value.split(',') if part]
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def latency_summary(seconds):
+    return {
+        'count': len(seconds),
+        'median_ms': round(statistics.median(seconds) * 1000, 3),
+        'p95_ms': round(percentile(seconds, 95) * 1000, 3),
+        'max_ms': round(max(seconds) * 1000, 3),
+    }
+
+def peak_rss_mb():
+    """High-water mark of this process's resident memory (ru_maxrss is KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def setup_django(args, workdir):
+    """Points the project at a fresh database and media directory, then migrates it."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'receipt_manager.settings')
+    import django
+    from django.conf import settings
+
+    settings.DATABASES['default']['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    settings.MEDIA_ROOT = os.path.join(workdir, 'media')
+    settings.DEBUG = False # Otherwise every query is kept in connection.queries
+    settings.ALLOWED_HOSTS = ['testserver']
+    settings.RECEIPT_EXTRACTOR = args.backend
+    settings.FAKE_EXTRACTION_LATENCY = args.latency
+    settings.EXTRACTION_CACHE_ENABLED = not args.no_cache
+    settings.GEMINI_RATE_LIMIT_DB = os.path.join(workdir, 'ratelimit.sqlite3')
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+def bench_upload(args, workdir):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.db import connection
+    from django.test import Client
+
+    results = []
+    index = 0
+    for concurrency in args.concurrency:
+        documents = []
+        for _ in range(args.uploads):
+            documents.append((f'bench-{index}.pdf', make_receipt_pdf(index, seed=args.seed)))
+            index += 1
+        latencies, statuses, errors = [], {}, set()
+        lock = threading.Lock()
+
+        def client_loop(batch):
+            client = Client()
+            try:
+                for name, data in batch:
+                    started = time.perf_counter()
+                    response = client.post('/api/upload/', {'file': SimpleUploadedFile(name, data, 'application/pdf')})
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        latencies.append(elapsed)
+                        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                        if response.status_code >= 400 and len(errors) < 5:
+                            errors.add(response.content[:200].decode('utf-8', 'replace'))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client_loop, args=(documents[i::concurrency],)) for i in range(concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+
+        results.append({
+            'concurrency': concurrency,
+            'requests': len(documents),
+            'requests_per_second': round(len(documents) / wall, 2),
+            'latency': latency_summary(latencies),
+            'status_codes': {str(code): count for code, count in sorted(statuses.items())},
+            'errors': sorted(errors), # Distinct error bodies, e.g. SQLite lock contention under concurrency
+        })
+    return {'backend': args.backend, 'extraction_latency_s': args.latency, 'levels': results, 'peak_rss_mb': peak_rss_mb()}
+
+def bench_validation(args, workdir):
+    from receipts.ingest import quick_validate_pdf
+    from receipts.utils import validate_pdf
+
+    results = []
+    for pages in args.pages:
+        data = make_receipt_pdf(pages=pages, seed=args.seed)
+        path = os.path.join(workdir, f'validation-{pages}.pdf')
+        with open(path, 'wb') as f:
+            f.write(data)
+        row = {'pages': pages, 'bytes': len(data)}
+        for name, check in (('validate_pdf', lambda: validate_pdf(path)), ('quick_validate_pdf', lambda: quick_validate_pdf(data))):
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                is_valid, reason = check()
+                timings.append(time.perf_counter() - started)
+                assert is_valid, reason
+            summary = latency_summary(timings)
+            summary['per_page_ms'] = round(summary['median_ms'] / pages, 4)
+            row[name] = summary
+        results.append(row)
+    return {'page_counts': results, 'peak_rss_mb': peak_rss_mb()}
+
+def seed_receipts(target, seed):
+    """Grows the Receipt table to `target` rows with bulk inserts. Returns the seconds spent."""
+    from receipts.models import ReceiptFile, Receipt
+    from synthetic import MERCHANTS, PRODUCTS
+
+    rng = random.Random(seed)
+    existing = Receipt.objects.count()
+    base_time = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+    started = time.perf_counter()
+    while existing < target:
+        size = min(SEED_BATCH_SIZE, target - existing)
+        files = ReceiptFile.objects.bulk_create([
+            ReceiptFile(file_name=f'seed-{existing + i}.pdf', file_path=f'receipts/seed-{existing + i}.pdf', is_valid=True, is_processed=True)
+            for i in range(size)
+        ])
+        receipts = []
+        for offset, receipt_file in enumerate(files):
+            amount_minor = rng.randrange(100, 50000)
+            merchant_name = f'{MERCHANTS[rng.randrange(len(MERCHANTS))]} #{rng.randrange(1000)}'
+            items = [{'description': rng.choice(PRODUCTS), 'price': f'${rng.randrange(99, 4999) / 100:.2f}'} for _ in range(rng.randrange(1, 15))]
+            raw = {'merchant_name': merchant_name, 'total_amount': f'${amount_minor / 100:.2f}', 'items': items}
+            created = base_time + timedelta(seconds=existing + offset)
+            receipts.append(Receipt(
+                receipt_file=receipt_file,
+                merchant_name=merchant_name,
+                purchased_at=created - timedelta(days=rng.randrange(30)),
+                total_amount=f'${amount_minor / 100:.2f}',
+                amount_minor=amount_minor,
+                currency='USD',
+                parsed_text=f"```json\n{json.dumps(raw, indent=2)}\n```", # Same shape as a model response
+                created_at=created,
+            ))
+        Receipt.objects.bulk_create(receipts)
+        existing += size
+    return time.perf_counter() - started
+
+def time_requests(client, urls):
+    timings = []
+    for url in urls:
+        started = time.perf_counter()
+        response = client.get(url)
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200, (url, response.status_code)
+    return latency_summary(timings)
+
+def bench_list(args, workdir):
+    from django.test import Client
+    from receipts.models import Receipt
+
+    client = Client()
+    rng = random.Random(args.seed)
+    results = []
+    for rows in args.rows:
+        seconds = seed_receipts(rows, args.seed)
+        ids = list(Receipt.objects.values_list('id', flat=True)[:100_000])
+
+        # Cursor for a page deep into the table
+        cursor = None
+        for _ in range(args.deep_pages):
+            page = client.get('/api/receipts/', {'limit': 50, 'fields': 'id', **({'cursor': cursor} if cursor else {})}).json()
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+
+        n = args.repeat
+        results.append({
+            'rows': rows,
+            'seed_seconds': round(seconds, 2),
+            'list_first_page': time_requests(client, ['/api/receipts/?limit=50'] * n),
+            'list_projected': time_requests(client, ['/api/receipts/?limit=50&fields=id,merchant_name,total_amount'] * n),
+            f'list_page_{args.deep_pages}': time_requests(client, [f'/api/receipts/?limit=50&cursor={cursor}'] * n) if cursor else None,
+            'list_filtered': time_requests(client, ['/api/receipts/?limit=50&merchant=cafe&min_amount=100'] * n),
+            'detail': time_requests(client, [f'/api/receipts/{rng.choice(ids)}/' for _ in range(n)]),
+            'peak_rss_mb': peak_rss_mb(),
+        })
+    return {'sizes': results, 'peak_rss_mb': peak_rss_mb()}
+
+def bench_search(args, workdir):
+    from django.test import Client
+    from receipts.models import Receipt
+    from receipts.search import rebuild_search_index
+
+    client = Client()
+    results = []
+    for rows in args.rows:
+        seconds = seed_receipts(rows, args.seed)
+        started = time.perf_counter()
+        rebuild_search_index(Receipt.objects.all()) # Seeding uses bulk_create, which skips the sync signals
+        rebuild_seconds = time.perf_counter() - started
+
+        n = args.repeat
+        queries = {
+            'merchant_prefix': 'caf', # Prefix of a common merchant word, many hits
+            'item': 'batteries',
+            'two_words': 'corner milk',
+            'rare': 'nonexistentword',
+        }
+        row = {'rows': rows, 'seed_seconds': round(seconds, 2), 'rebuild_seconds': round(rebuild_seconds, 2)}
+        for name, q in queries.items():
+            row[name] = time_requests(client, [f'/api/receipts/search/?q={q}&limit=50'] * n)
+        first_page = client.get('/api/receipts/search/', {'q': 'caf', 'limit': 50}).json()
+        if first_page['next_cursor']:
+            row['merchant_prefix_page_2'] = time_requests(client, [f"/api/receipts/search/?q=caf&limit=50&cursor={first_page['next_cursor']}"] * n)
+        row['peak_rss_mb'] = peak_rss_mb()
+        results.append(row)
+    return {'sizes': results, 'peak_rss_mb': peak_rss_mb()}
+
+SECTIONS = {
+    'validation': bench_validation,
+    'upload': bench_upload,
+    'list': bench_list,
+    'search': bench_search,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sections', default=','.join(SECTIONS), help='Comma-separated subset of: ' + ', '.join(SECTIONS))
+    parser.add_argument('--backend', default='fake', help='Extraction backend name or dotted path (default: fake)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds the fake backend sleeps per receipt')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the extraction cache')
+    parser.add_argument('--uploads', type=int, default=100, help='Uploads per concurrency level')
+    parser.add_argument('--concurrency', type=parse_ints, default=[1, 4, 8, 16])
+    parser.add_argument('--pages', type=parse_ints, default=[1, 10, 50, 200])
+    parser.add_argument('--rows', type=parse_ints, default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--deep-pages', type=int, default=20, help='Pages to walk before timing a deep cursor page')
+    parser.add_argument('--repeat', type=int, default=30, help='Samples per latency measurement')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quick', action='store_true', help='Small sizes for a smoke run')
+    parser.add_argument('--output', help='Write the JSON result to this file as well as stdout')
+    args = parser.parse_args()
+    if args.quick:
+        args.uploads, args.concurrency, args.pages = 20, [1, 4], [1, 10]
+        args.rows, args.deep_pages, args.repeat = [1000, 5000], 5, 10
+
+    sections = [name for name in args.sections.split(',') if name]
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error(f"unknown sections: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix='receipt-bench-')
+    try:
+        setup_django(args, workdir)
+        import django
+        result = {
+            'benchmark': 'suite',
+            'started_at': datetime.now(dt_timezone.utc).isoformat(timespec='seconds'),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+            'options': {key: value for key, value in vars(args).items() if key not in ('output', 'sections')},
+        }
+        for name in sections:
+            started = time.perf_counter()
+            result[name] = SECTIONS[name](args, workdir)
+            result[name]['seconds'] = round(time.perf_counter() - started, 2)
+        result['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
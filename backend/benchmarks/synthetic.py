@@ -0,0 +1,78 @@
+"""
+Deterministic synthetic receipt PDFs for benchmarks.
+The same (index, pages, seed) always produces the same document, and different
+indexes produce different bytes, so uploads don't hit the extraction cache.
+"""
+import random
+from datetime import date, timedelta
+import fitz  # PyMuPDF
+
+MERCHANTS = (
+    'Corner Grocery', 'Blue Bottle Cafe', 'Hardware Depot', 'City Pharmacy',
+    'Green Market', 'Book Nook', 'Fuel Stop', 'Pasta House',
+)
+PRODUCTS = (
+    'Milk', 'Bread', 'Coffee', 'Eggs', 'Apples', 'Batteries', 'Notebook',
+    'Shampoo', 'Pasta', 'Tomatoes', 'Cheese', 'Light Bulb', 'Tea', 'Rice',
+)
+
+
+def receipt_lines(index, seed=0, items=12):
+    """Text lines of one fake receipt: merchant, date, items, subtotal, tax and total."""
+    rng = random.Random(seed * 1_000_003 + index)
+    purchased = date(2024, 1, 1) + timedelta(days=rng.randrange(600))
+    lines = [MERCHANTS[rng.randrange(len(MERCHANTS))], f"Receipt #{index:08d}", f"Date: {purchased:%Y-%m-%d}", ""]
+    subtotal = 0
+    for _ in range(items):
+        cents = rng.randrange(99, 4999)
+        subtotal += cents
+        lines.append(f"{PRODUCTS[rng.randrange(len(PRODUCTS))]:<24} ${cents / 100:.2f}")
+    tax = round(subtotal * 0.08)
+    lines += ["", f"Subtotal ${subtotal / 100:.2f}", f"Tax ${tax / 100:.2f}", f"TOTAL ${(subtotal + tax) / 100:.2f}"]
+    return lines
+
+def make_receipt_pdf(index=0, pages=1, seed=0):
+    """Returns the bytes of a text PDF receipt with `pages` pages."""
+    doc = fitz.open()
+    for page_number in range(pages):
+        page = doc.new_page()
+        y = 72
+        for line in receipt_lines(index * 10_000 + page_number, seed):
+            page.insert_text((72, y), line, fontname='cour', fontsize=10)
+            y += 14
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+def make_scanned_receipt_pdf(index=0, dpi=300, blank_pages=0, duplicate_pages=0, seed=0, quality=92):
+    """
+    Returns the bytes of a receipt that looks like a phone scan: each page is a single
+    JPEG of the rendered text at `dpi`, on a slightly noisy grey background so it
+    compresses like a photo. blank_pages (paper texture only) and duplicate_pages
+    (repeats of the receipt page) are appended after it.
+    """
+    rng = random.Random(seed * 1_000_003 + index)
+    source = fitz.open()
+    page = source.new_page()
+    texture = _paper_texture(rng, page.rect, dpi)
+    page.insert_image(page.rect, pixmap=texture)
+    y = 72
+    for line in receipt_lines(index, seed):
+        page.insert_text((72, y), line, fontname='cour', fontsize=10)
+        y += 14
+    scan = page.get_pixmap(dpi=dpi).tobytes('jpeg', jpg_quality=quality)
+    blank = fitz.Pixmap(texture, texture.width * dpi // 72 // 8, texture.height * dpi // 72 // 8, None).tobytes('jpeg', jpg_quality=quality)
+    source.close()
+
+    doc = fitz.open()
+    for image in [scan] + [blank] * blank_pages + [scan] * duplicate_pages:
+        doc.new_page().insert_image(fitz.Rect(0, 0, 612, 792), stream=image)
+    data = doc.tobytes(garbage=4) # Repeated images are stored once, like a scanner app would
+    doc.close()
+    return data
+
+def _paper_texture(rng, rect, dpi):
+    """Grey noise at 1/8 of `dpi` (scaled up when drawn), values 225-255."""
+    width, height = int(rect.width * dpi / 72 / 8), int(rect.height * dpi / 72 / 8)
+    samples = bytes(225 + value % 31 for value in rng.randbytes(width * height))
+    return fitz.Pixmap(fitz.csGRAY, width, height, samples, False)
@@ -79,10 +79,25 @@ WSGI_APPLICATION = 'receipt_manager.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# SQLite tuning for concurrent uploads
+SQLITE_JOURNAL_MODE = 'WAL' # Readers don't block the writer and commits don't rewrite a rollback journal
+SQLITE_SYNCHRONOUS = 'NORMAL' # Safe with WAL; fsyncs at checkpoints instead of on every commit
+SQLITE_BUSY_TIMEOUT = 20 # Seconds a writer waits for the lock before "database is locked"
+DATABASE_CONN_MAX_AGE = 60 # Seconds to keep a connection open between requests; 0 closes it after each request
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'receipts.sqlite3',
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': SQLITE_BUSY_TIMEOUT,
+            # Write transactions take the lock when they begin, so they queue on the busy
+            # timeout instead of failing when a read lock can't be upgraded
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}; PRAGMA synchronous={SQLITE_SYNCHRONOUS}',
+        },
     }
 }
 
@@ -134,3 +149,121 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 GEMINI_API_KEY = "YOUR_GOOGLE_GEMINI_API_KEY_HERE" # <-- REPLACE THIS WITH YOUR ACTUAL API KEY
+
+
+# --- Receipt extraction ---
+# Extraction backend: 'local' (PDF text layer first), 'gemini', 'gemini-batch' (several receipts per request)
+# or 'fake' (offline), or a dotted path to a callable.
+# See receipts.backends; provider SDKs are only imported when their backend is first used.
+RECEIPT_EXTRACTOR = 'local'
+# Used by the local-first extractor when the PDF text layer isn't good enough
+RECEIPT_FALLBACK_EXTRACTOR = 'gemini'
+LOCAL_EXTRACTION_CONFIDENCE_THRESHOLD = 0.8 # 0-1; lower trusts the text layer more often
+FAKE_EXTRACTION_LATENCY = 0 # Seconds the fake extractor sleeps per receipt
+
+# PDFs holding several receipts (see receipts.segments): 'off', 'pages' (one receipt per page)
+# or 'auto' (pages grouped by layout). Uploads can choose per file with ?split=
+RECEIPT_SPLIT_MODE = 'off'
+RECEIPT_SPLIT_MAX_WORKERS = 4 # Receipts of one PDF extracted at once, per process
+
+# Rescans of an already processed receipt reuse its extraction (see receipts.near_duplicates)
+RECEIPT_NEAR_DUPLICATE_DETECTION = False
+RECEIPT_NEAR_DUPLICATE_MAX_DISTANCE = 14 # Bits out of 256 in which first-page perceptual hashes may differ
+
+# Shrinking PDFs before they are sent to Gemini (see receipts.preprocess); the stored file is never changed
+PDF_PREPROCESS_ENABLED = True
+PDF_PREPROCESS_DROP_BLANK_PAGES = True # Also drops pages that repeat an earlier page exactly
+PDF_PREPROCESS_TARGET_DPI = 150 # Embedded images drawn at a higher resolution are downsampled to this
+PDF_PREPROCESS_JPEG_QUALITY = 75 # 0-100, for recompressed images
+PDF_PREPROCESS_RASTERIZE = False # Send the pages as one JPEG at the target DPI instead of a PDF
+
+RECEIPT_MAX_UPLOAD_SIZE = 25 * 1024 * 1024 # Bytes per PDF, enforced while the upload is streamed to disk
+
+# Background worker pool used by queued uploads (POST /api/upload/?mode=async)
+RECEIPT_WORKER_POOL_KIND = 'thread' # 'thread' or 'process'
+RECEIPT_WORKER_POOL_SIZE = 4
+
+# Extraction cache keyed by PDF SHA-256 + extractor/model/prompt version
+EXTRACTION_CACHE_ENABLED = True
+EXTRACTION_CACHE_MAX_ENTRIES = 10000 # Least recently used entries beyond this are evicted
+EXTRACTION_CACHE_MAX_AGE = 30 * 24 * 60 * 60 # Seconds; 0 keeps entries until evicted by size
+EXTRACTION_CACHE_EVICT_INTERVAL = 60 * 60 # Seconds between age sweeps in each process
+
+# Batch uploads (POST /api/upload/batch/)
+BATCH_UPLOAD_MAX_FILES = 1000 # Per request, counting zip archive entries
+BATCH_VALIDATION_WORKERS = None # Validation processes; None uses the CPU count
+
+# Receipt list pagination (GET /api/receipts/)
+RECEIPT_LIST_PAGE_SIZE = 50
+RECEIPT_LIST_MAX_PAGE_SIZE = 500
+RECEIPT_TOMBSTONE_RETENTION_DAYS = 30 # Deletions stay in the change feed (GET /api/receipts/changes/) this long; older cursors must resync
+RECEIPT_EXPORT_CHUNK_SIZE = 2000 # Rows fetched and encoded at a time by GET /api/receipts/export/
+
+# Gemini client limits, shared by every worker process on this host
+GEMINI_RATE_LIMIT_PER_MINUTE = 60 # Requests per minute across processes; 0 disables the limiter
+GEMINI_RATE_LIMIT_BURST = 10 # Requests allowed back-to-back before the per-minute rate applies
+GEMINI_RATE_LIMIT_DB = os.path.join(BASE_DIR, 'ratelimit.sqlite3') # Token bucket state
+GEMINI_MAX_IN_FLIGHT = 4 # Concurrent Gemini calls per process
+GEMINI_MAX_IN_FLIGHT_ASYNC = 64 # Concurrent Gemini calls per event loop on the async endpoints; waiting coroutines are cheap
+GEMINI_MAX_RETRIES = 4 # Retries for 429/5xx/connection errors, with jittered exponential backoff
+GEMINI_RETRY_BASE_DELAY = 1.0 # Seconds
+GEMINI_RETRY_MAX_DELAY = 30.0 # Seconds
+GEMINI_CIRCUIT_FAILURE_THRESHOLD = 5 # Consecutive failures before calls fail fast
+GEMINI_CIRCUIT_RESET_TIMEOUT = 60 # Seconds before a trial call is let through
+
+# Packing receipts extracted at the same time into one Gemini request (the 'gemini-batch' backend, see receipts.batching)
+GEMINI_BATCH_MAX_ITEMS = 8 # Receipts per request
+GEMINI_BATCH_MAX_WAIT_MS = 50 # How long the first receipt of a request waits for others to join
+GEMINI_BATCH_MAX_PAYLOAD_BYTES = 512 * 1024 # Larger payloads are sent on their own
+
+# Full-text search (GET /api/receipts/search/)
+SEARCH_MAX_RANKED_HITS = 10000 # Only the newest matches of a broad query are ranked; bounds latency at 1M+ rows
+
+# Receipt file storage: content-addressed, identical PDFs are stored once (see receipts.storage)
+RECEIPT_STORAGE_BACKEND = 'sharded' # 'sharded' (hash-prefix directories under MEDIA_ROOT), 's3', or a dotted path
+RECEIPT_STORAGE_S3_BUCKET = None
+RECEIPT_STORAGE_S3_PREFIX = '' # Prepended to every object key
+RECEIPT_STORAGE_S3_ENDPOINT_URL = None # For S3-compatible services such as MinIO; None uses AWS
+
+# First-page thumbnails (GET /api/receipts/<id>/thumbnail/, see receipts.thumbnails)
+RECEIPT_THUMBNAIL_WIDTH = 320 # Pixels
+RECEIPT_THUMBNAIL_FORMAT = 'png' # 'png', 'jpeg' or 'webp' (needs Pillow)
+RECEIPT_THUMBNAIL_DIR = None # Disk cache keyed by content hash; None uses MEDIA_ROOT/receipts/thumbnails
+
+# Server-side cache of serialized receipt list/detail payloads (see receipts.response_cache).
+# Swap the backend for 'django.core.cache.backends.filebased.FileBasedCache' with a directory
+# LOCATION to share it between worker processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'receipt_responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'receipt-responses',
+        'TIMEOUT': 300, # Seconds
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+}
+RECEIPT_RESPONSE_CACHE = 'receipt_responses' # CACHES alias; None disables the server-side cache (ETags still work)
+
+# Stage timing for the upload and process endpoints (see receipts.metrics); Prometheus metrics at /metrics
+RECEIPT_SERVER_TIMING = True # Add a Server-Timing header with the stage durations
+RECEIPT_PROFILE_SLOW_REQUESTS = False # Sample the stacks of instrumented requests and report slow ones (receipts.profiling)
+RECEIPT_SLOW_REQUEST_SECONDS = 5.0
+RECEIPT_PROFILE_INTERVAL = 0.005 # Seconds between stack samples
+RECEIPT_PROFILE_DIR = None # Directory for collapsed-stack profiles of slow requests; None only logs them
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '{asctime} {levelname} {name}: {message}', 'style': '{'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        # DEBUG also logs every raw model response
+        'receipts': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
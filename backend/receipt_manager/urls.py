@@ -18,10 +18,12 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from receipts.views import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('receipts.urls')), # Include receipts app URLs under /api/
+    path('metrics', metrics_view, name='metrics'), # Prometheus scrape target
 ]
 
 if settings.DEBUG:
@@ -0,0 +1,194 @@
+"""
+Native async versions of the upload and process endpoints, for ASGI servers (uvicorn).
+
+While the provider is working, a request waits as a coroutine instead of holding a
+worker thread, so one worker process can keep hundreds of extractions in flight.
+Blocking steps (writing the upload, PDF checks) run in worker threads and ORM writes
+go through Django's async adapters (acreate/asave, sync_to_async). Responses match the
+synchronous endpoints.
+"""
+import json
+import sys
+from contextlib import asynccontextmanager
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from .models import ReceiptFile
+from .serializers import ReceiptFileSerializer, ReceiptSerializer
+from .pipeline import create_validated_receipt_file, aextract_and_save, ExtractionFailed, EmptyExtraction
+from .ingest import open_mapped, UploadTooLarge
+from .client import ProviderUnavailable
+from .storage import get_receipt_storage
+from .segments import parse_split_mode
+from .metrics import instrumented, stage, fail
+
+
+def _in_thread(func):
+    return sync_to_async(func, thread_sensitive=False)
+
+@asynccontextmanager
+async def _local_path(storage, key):
+    """storage.local_path() with its setup and cleanup (a download, for remote backends) in a worker thread."""
+    manager = storage.local_path(key)
+    path = await _in_thread(manager.__enter__)()
+    try:
+        yield path
+    finally:
+        await _in_thread(manager.__exit__)(*sys.exc_info())
+
+def _request_data(request):
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError:
+            return {}
+    return request.POST
+
+def provider_unavailable_response(exc, receipt_file):
+    response = JsonResponse(
+        {
+            'error': f'Extraction provider is temporarily unavailable: {str(exc)}',
+            'receipt_file': ReceiptFileSerializer(receipt_file).data,
+        },
+        status=503
+    )
+    if exc.retry_after:
+        response['Retry-After'] = str(max(1, round(exc.retry_after)))
+    return response
+
+async def _extract_response(receipt_file, full_file_path, pdf_data, failed_message):
+    """Runs extraction and maps its outcome to the same responses as the sync views; None on success."""
+    try:
+        return await aextract_and_save(receipt_file, full_file_path, pdf_data=pdf_data), None
+    except ExtractionFailed:
+        fail('extraction_failed')
+        return None, JsonResponse({'message': failed_message, 'receipt_file': ReceiptFileSerializer(receipt_file).data}, status=500)
+    except EmptyExtraction:
+        fail('empty_extraction')
+        return None, JsonResponse(
+            {'message': 'AI extracted text, but parsing yielded no meaningful data.', 'receipt_file': ReceiptFileSerializer(receipt_file).data},
+            status=500
+        )
+    except ProviderUnavailable as e:
+        return None, provider_unavailable_response(e, receipt_file)
+
+
+@method_decorator(csrf_exempt, name='dispatch') # Same as the DRF views, which skip CSRF for API clients
+class AsyncUploadReceiptView(View):
+    @instrumented('async_upload')
+    async def post(self, request, *args, **kwargs):
+        files = await _in_thread(lambda: request.FILES)() # Parsing the multipart body reads the spooled upload
+        if 'file' not in files:
+            return JsonResponse({'error': 'No file provided'}, status=400)
+
+        uploaded_file = files['file']
+        if not uploaded_file.name.lower().endswith('.pdf'):
+            return JsonResponse({'error': 'Only PDF files are allowed.'}, status=400)
+        if uploaded_file.size > settings.RECEIPT_MAX_UPLOAD_SIZE:
+            return JsonResponse({'error': f'File exceeds the {settings.RECEIPT_MAX_UPLOAD_SIZE} byte upload limit.'}, status=413)
+        try:
+            split_mode = parse_split_mode(request.GET.get('split', request.POST.get('split')))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        storage = get_receipt_storage()
+        stored = None
+        receipt_file = None
+        try:
+            try:
+                with stage('disk_write'):
+                    staged = await _in_thread(storage.stage)(uploaded_file.chunks(), settings.RECEIPT_MAX_UPLOAD_SIZE)
+                    stored = await sync_to_async(storage.commit)(staged) # Takes a reference in the database
+            except UploadTooLarge as e:
+                return JsonResponse({'error': str(e)}, status=413)
+
+            async with _local_path(storage, stored.key) as full_file_path:
+                with open_mapped(full_file_path) as pdf_data:
+                    receipt_file = await sync_to_async(create_validated_receipt_file)(
+                        pdf_data,
+                        file_name=uploaded_file.name,
+                        file_path=stored.key,
+                        content_hash=stored.content_hash,
+                        file_size=stored.size,
+                        split_mode=split_mode,
+                    )
+                    if not receipt_file.is_valid:
+                        fail('invalid_pdf')
+                        return JsonResponse(
+                            {'message': 'File uploaded but is invalid.', 'receipt_file': ReceiptFileSerializer(receipt_file).data},
+                            status=400
+                        )
+                    receipts, error_response = await _extract_response(
+                        receipt_file, full_file_path, pdf_data, 'File is valid but AI extraction failed.'
+                    )
+            if error_response is not None:
+                return error_response
+
+            return JsonResponse(
+                {
+                    'message': 'File uploaded, validated, and processed successfully!',
+                    'receipt_file': ReceiptFileSerializer(receipt_file).data,
+                    'extracted_receipt': ReceiptSerializer(receipts[0]).data,
+                    'extracted_receipts': ReceiptSerializer(receipts, many=True).data, # Several when the PDF was split
+                },
+                status=201
+            )
+
+        except Exception as e:
+            fail('exception')
+            if receipt_file:
+                receipt_file.is_valid = False
+                receipt_file.is_processed = False
+                receipt_file.invalid_reason = f"Processing failed: {str(e)}"
+                await receipt_file.asave(update_fields=['is_valid', 'is_processed', 'invalid_reason', 'updated_at'])
+            elif stored:
+                await sync_to_async(storage.release)(stored.key)
+            return JsonResponse({'error': f'An unexpected error occurred during receipt processing: {str(e)}'}, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncProcessReceiptView(View):
+    @instrumented('async_process')
+    async def post(self, request, *args, **kwargs):
+        data = await _in_thread(_request_data)(request)
+        receipt_file_id = data.get('receipt_file_id')
+        if not receipt_file_id:
+            return JsonResponse({'error': 'receipt_file_id is required'}, status=400)
+
+        try:
+            receipt_file = await ReceiptFile.objects.aget(id=receipt_file_id)
+        except (ReceiptFile.DoesNotExist, ValueError):
+            return JsonResponse({'error': 'ReceiptFile not found'}, status=404)
+        try:
+            split_mode = parse_split_mode(request.GET.get('split', data.get('split')))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        if not receipt_file.is_valid:
+            return JsonResponse({'error': f'File is not valid: {receipt_file.invalid_reason}'}, status=400)
+        if receipt_file.is_processed:
+            return JsonResponse({'message': 'Receipt already processed.'}, status=200)
+        if split_mode is not None and split_mode != receipt_file.split_mode:
+            receipt_file.split_mode = split_mode
+            await receipt_file.asave(update_fields=['split_mode', 'updated_at'])
+
+        try:
+            async with _local_path(get_receipt_storage(), receipt_file.file_path) as full_file_path:
+                with open_mapped(full_file_path) as pdf_data:
+                    receipts, error_response = await _extract_response(
+                        receipt_file, full_file_path, pdf_data, 'AI extraction failed.'
+                    )
+            if error_response is not None:
+                return error_response
+            if len(receipts) > 1: # A split PDF
+                return JsonResponse({'extracted_receipts': ReceiptSerializer(receipts, many=True).data}, status=200)
+            return JsonResponse(ReceiptSerializer(receipts[0]).data, status=200)
+        except Exception as e:
+            fail('exception')
+            receipt_file.is_processed = False
+            receipt_file.invalid_reason = f"Processing failed: {str(e)}"
+            await receipt_file.asave(update_fields=['is_processed', 'invalid_reason', 'updated_at'])
+            return JsonResponse({'error': f'Receipt processing failed: {str(e)}'}, status=500)
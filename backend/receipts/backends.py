@@ -0,0 +1,79 @@
+"""
+Registry of extraction backends, selected by name with settings.RECEIPT_EXTRACTOR
+and settings.RECEIPT_FALLBACK_EXTRACTOR.
+
+Backends are registered as dotted paths and imported on first use, so a
+provider's SDK (google.generativeai, PyMuPDF) is only loaded by processes that
+actually extract receipts, not by every manage.py command or list request.
+The same goes for the modules that handle PDFs: they get PyMuPDF from get_fitz()
+inside the functions that need it, never with a module-level import.
+"""
+import threading
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+EXTRACTION_BACKENDS = {
+    'local': 'receipts.local_extraction.extract_details_local_first', # Text layer, falling back to RECEIPT_FALLBACK_EXTRACTOR
+    'gemini': 'receipts.utils.extract_details_with_gemini',
+    'gemini-batch': 'receipts.utils.extract_details_with_gemini_batched', # Concurrent receipts share one request
+    'fake': 'receipts.utils.fake_extract_details', # Offline, for tests and benchmarks
+}
+
+# Native coroutine versions used by the async endpoints
+ASYNC_EXTRACTION_BACKENDS = {
+    'receipts.local_extraction.extract_details_local_first': 'receipts.local_extraction.aextract_details_local_first',
+    'receipts.utils.extract_details_with_gemini': 'receipts.utils.aextract_details_with_gemini',
+    'receipts.utils.extract_details_with_gemini_batched': 'receipts.utils.aextract_details_with_gemini_batched',
+    'receipts.utils.fake_extract_details': 'receipts.utils.afake_extract_details',
+}
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def get_fitz():
+    """PyMuPDF, imported on first use (see the module docstring)."""
+    import fitz
+    return fitz
+
+def get_backend_path(name):
+    """
+    Resolves a backend name to its dotted path. Dotted paths are passed through,
+    so custom extractors can still be configured directly.
+    """
+    if name in EXTRACTION_BACKENDS:
+        return EXTRACTION_BACKENDS[name]
+    if '.' in name:
+        return name
+    raise ImproperlyConfigured(
+        f"Unknown extraction backend {name!r}. Use one of {', '.join(sorted(EXTRACTION_BACKENDS))} or a dotted path."
+    )
+
+def _load(path, wrap=None):
+    key = (path, wrap)
+    backend = _loaded.get(key)
+    if backend is None:
+        with _loaded_lock:
+            backend = _loaded.get(key)
+            if backend is None:
+                backend = import_string(path)
+                backend = _loaded[key] = wrap(backend) if wrap else backend
+    return backend
+
+def _in_thread(func):
+    return sync_to_async(func, thread_sensitive=False)
+
+def get_backend(name):
+    """Returns the extraction callable for a backend name or dotted path, importing it on first use."""
+    return _load(get_backend_path(name))
+
+def get_async_backend(name):
+    """
+    Coroutine version of get_backend. Backends without a native async version
+    (e.g. custom dotted paths) run in a worker thread.
+    """
+    path = get_backend_path(name)
+    if path in ASYNC_EXTRACTION_BACKENDS:
+        return _load(ASYNC_EXTRACTION_BACKENDS[path])
+    return _load(path, wrap=_in_thread)
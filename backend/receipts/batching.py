@@ -0,0 +1,103 @@
+"""
+Request batching for extraction providers: several small receipts in one model call.
+
+Every generate_content call pays a fixed cost on top of the work per document:
+connection setup, the prompt's tokens, queueing at the provider, and one slot of
+GEMINI_MAX_IN_FLIGHT and of the rate limit. RequestBatcher collects the documents
+submitted by concurrent callers (worker pool threads, the segments of a split
+PDF, async requests) until it has max_items of them or the first has waited
+max_wait seconds, then passes them to a single send() call on a thread of its
+own. Each caller waits on a Future for its own result.
+
+A receipt that arrives alone waits max_wait for company, so an idle server pays
+a little latency for the throughput gained under load. The Gemini side (the
+multi-document prompt, and retrying documents whose answer doesn't parse) is
+utils.extract_details_with_gemini_batched.
+"""
+import threading
+from concurrent.futures import Future
+
+_stats_lock = threading.Lock()
+_stats = {'requests': 0, 'documents': 0, 'retried': 0}
+
+
+def count_batch(documents):
+    with _stats_lock:
+        _stats['requests'] += 1
+        _stats['documents'] += documents
+
+def count_retry():
+    """A document of a batch that had to be extracted on its own."""
+    with _stats_lock:
+        _stats['retried'] += 1
+
+def get_batching_stats():
+    """Batched requests sent by this process, the documents in them and how many were retried alone."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['documents_per_request'] = round(stats['documents'] / stats['requests'], 2) if stats['requests'] else None
+    return stats
+
+def reset_batching_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+class RequestBatcher:
+    """
+    Groups items submitted from any thread (or event loop) into calls of
+    send(items), which returns one result per item in the same order. A batch
+    goes out when it has max_items items or max_wait seconds after its first
+    item arrived. If send raises, every item of the batch gets the exception.
+    """
+
+    def __init__(self, send, max_items, max_wait):
+        self.send = send
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._pending = [] # [(item, future)]
+        self._timer = None
+
+    def submit(self, item):
+        """Queues item and returns a concurrent.futures.Future of its result. Never blocks on send."""
+        future = Future()
+        with self._lock:
+            self._pending.append((item, future))
+            if len(self._pending) >= self.max_items:
+                self._dispatch(self._take())
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    def flush(self):
+        """Sends whatever is pending now."""
+        with self._lock:
+            batch = self._take()
+            if batch:
+                self._dispatch(batch)
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel() # Harmless if it is the timer that is running this
+            self._timer = None
+        return batch
+
+    def _dispatch(self, batch):
+        # A thread per batch: callers on an event loop must not block, and the call is mostly waiting anyway
+        threading.Thread(target=self._send, args=(batch,), name='request-batch', daemon=True).start()
+
+    def _send(self, batch):
+        count_batch(len(batch))
+        try:
+            results = self.send([item for item, _ in batch])
+        except BaseException as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,193 @@
+import hashlib
+import threading
+import time
+from asgiref.sync import sync_to_async
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db.models import F, Sum
+from django.utils import timezone
+from .models import ExtractionCacheEntry
+from .backends import get_backend_path
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+_evict_lock = threading.Lock()
+_last_age_sweep = None # time.monotonic() of this process's last age sweep
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """Returns the hex SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_cache_version():
+    """
+    Fingerprint of everything that changes the extractor's answer for the same bytes:
+    the configured extractors, the local confidence threshold, the model name, the prompt text and what preprocessing sends.
+    """
+    from .utils import GEMINI_MODEL_NAME, RECEIPT_PROMPT, BATCH_RECEIPT_PROMPT
+    from .preprocess import preprocess_fingerprint
+    extractors = [get_backend_path(settings.RECEIPT_EXTRACTOR), get_backend_path(settings.RECEIPT_FALLBACK_EXTRACTOR)]
+    parts = extractors + [ # Names and dotted paths for the same backend share entries
+        str(settings.LOCAL_EXTRACTION_CONFIDENCE_THRESHOLD),
+        GEMINI_MODEL_NAME,
+        RECEIPT_PROMPT,
+        preprocess_fingerprint(),
+    ]
+    if get_backend_path('gemini-batch') in extractors: # Only then, so other setups keep their cached entries
+        parts.append(BATCH_RECEIPT_PROMPT)
+    fingerprint = "\n".join(parts)
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()[:16]
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+def get_cache_stats():
+    """Hit/miss counters for this process plus totals stored in the cache table."""
+    with _stats_lock:
+        hits, misses = _stats['hits'], _stats['misses']
+    lookups = hits + misses
+    return {
+        'enabled': settings.EXTRACTION_CACHE_ENABLED,
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / lookups, 4) if lookups else None,
+        'entries': ExtractionCacheEntry.objects.count(),
+        'stored_hits': ExtractionCacheEntry.objects.aggregate(total=Sum('hit_count'))['total'] or 0,
+    }
+
+def reset_cache_stats():
+    with _stats_lock:
+        _stats['hits'] = 0
+        _stats['misses'] = 0
+
+def _dump_parsed(parsed_data):
+    # JSONField can't hold datetimes, so purchased_at is stored as ISO text
+    data = dict(parsed_data)
+    if isinstance(data.get('purchased_at'), datetime):
+        data['purchased_at'] = data['purchased_at'].isoformat()
+    return data
+
+def _load_parsed(data):
+    parsed_data = dict(data)
+    if parsed_data.get('purchased_at'):
+        parsed_data['purchased_at'] = datetime.fromisoformat(parsed_data['purchased_at'])
+    return parsed_data
+
+def evict_expired():
+    """Drops entries older than EXTRACTION_CACHE_MAX_AGE and trims the table to EXTRACTION_CACHE_MAX_ENTRIES, least recently used first."""
+    # Runs after every store. The age sweep scans created_at, so it runs at most once per
+    # EXTRACTION_CACHE_EVICT_INTERVAL in each process; the size trim only reads the oldest
+    # rows through the last_used_at index, and only when the table is over the limit.
+    global _last_age_sweep
+    max_age = settings.EXTRACTION_CACHE_MAX_AGE
+    if max_age:
+        now = time.monotonic()
+        with _evict_lock:
+            due = _last_age_sweep is None or now - _last_age_sweep >= settings.EXTRACTION_CACHE_EVICT_INTERVAL
+            if due:
+                _last_age_sweep = now
+        if due:
+            ExtractionCacheEntry.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=max_age)).delete()
+    max_entries = settings.EXTRACTION_CACHE_MAX_ENTRIES
+    if max_entries:
+        excess = ExtractionCacheEntry.objects.count() - max_entries
+        if excess > 0:
+            stale_ids = list(ExtractionCacheEntry.objects.order_by('last_used_at', 'id').values_list('id', flat=True)[:excess])
+            ExtractionCacheEntry.objects.filter(id__in=stale_ids).delete()
+
+def _cache_key(pdf_path, content_hash=None, pdf_data=None):
+    if not content_hash:
+        content_hash = hashlib.sha256(pdf_data).hexdigest() if pdf_data is not None else hash_file(pdf_path)
+    return content_hash, get_cache_version()
+
+def _lookup(content_hash, version):
+    """Returns the cached (parsed_data, raw_response) and records the hit, or None on a miss."""
+    entry = ExtractionCacheEntry.objects.filter(content_hash=content_hash, version=version).first()
+    if entry is not None:
+        max_age = settings.EXTRACTION_CACHE_MAX_AGE
+        if not max_age or entry.created_at >= timezone.now() - timedelta(seconds=max_age):
+            _count('hits')
+            ExtractionCacheEntry.objects.filter(id=entry.id).update(
+                hit_count=F('hit_count') + 1, last_used_at=timezone.now()
+            )
+            return _load_parsed(entry.parsed_data), entry.raw_response
+    _count('misses')
+    return None
+
+def cached_extract(extractor, pdf_path, content_hash=None, pdf_data=None):
+    """
+    Calls extractor(pdf_path, pdf_data) unless the same bytes were already extracted
+    with the current cache version. Returns (parsed_data, raw_response) like the extractor.
+    Pass the content_hash computed at upload time to avoid hashing the file again.
+    Failed extractions are never cached.
+    """
+    if not settings.EXTRACTION_CACHE_ENABLED:
+        return extractor(pdf_path, pdf_data)
+
+    content_hash, version = _cache_key(pdf_path, content_hash, pdf_data)
+    cached = _lookup(content_hash, version)
+    if cached is not None:
+        return cached
+
+    parsed_data, raw_response = extractor(pdf_path, pdf_data)
+    if parsed_data is not None:
+        _store(content_hash, version, parsed_data, raw_response)
+    return parsed_data, raw_response
+
+def cached_extract_many(extractor, pdf_path, parts, map_func=map):
+    """
+    cached_extract for several parts of one PDF, e.g. the receipts split out of it.
+    parts are (content_hash, pdf_data) pairs. The cache is read and written on this
+    thread; the extractor calls for the misses go through map_func (an executor's
+    map runs them concurrently). Returns [(parsed_data, raw_response)] in parts order.
+    """
+    results = [None] * len(parts)
+    misses = []
+    for index, (content_hash, pdf_data) in enumerate(parts):
+        key = _cache_key(pdf_path, content_hash, pdf_data) if settings.EXTRACTION_CACHE_ENABLED else None
+        results[index] = _lookup(*key) if key else None
+        if results[index] is None:
+            misses.append((index, key))
+
+    extracted = map_func(lambda miss: extractor(pdf_path, parts[miss[0]][1]), misses)
+    for (index, key), (parsed_data, raw_response) in zip(misses, extracted):
+        results[index] = parsed_data, raw_response
+        if key and parsed_data is not None:
+            _store(*key, parsed_data, raw_response)
+    return results
+
+async def acached_extract(extractor, pdf_path, content_hash=None, pdf_data=None):
+    """
+    cached_extract for async extractors. The cache's ORM work runs through
+    sync_to_async; only the extractor call itself is awaited on the event loop.
+    """
+    if not settings.EXTRACTION_CACHE_ENABLED:
+        return await extractor(pdf_path, pdf_data)
+
+    content_hash, version = await sync_to_async(_cache_key, thread_sensitive=False)(pdf_path, content_hash, pdf_data)
+    cached = await sync_to_async(_lookup)(content_hash, version)
+    if cached is not None:
+        return cached
+
+    parsed_data, raw_response = await extractor(pdf_path, pdf_data)
+    if parsed_data is not None:
+        await sync_to_async(_store)(content_hash, version, parsed_data, raw_response)
+    return parsed_data, raw_response
+
+def _store(content_hash, version, parsed_data, raw_response):
+    ExtractionCacheEntry.objects.update_or_create(
+        content_hash=content_hash,
+        version=version,
+        defaults={
+            'parsed_data': _dump_parsed(parsed_data),
+            'raw_response': raw_response,
+            'created_at': timezone.now(),
+            'last_used_at': timezone.now(),
+        }
+    )
+    evict_expired()
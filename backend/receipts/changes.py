@@ -0,0 +1,82 @@
+"""
+Change feed for GET /api/receipts/changes/: the receipts created, updated or
+deleted since a cursor, so clients can sync deltas instead of the whole list.
+
+Every Receipt save moves the receipt to the end of one global sequence
+(Receipt.change_seq, indexed), and every delete leaves a ReceiptTombstone
+numbered from the same sequence. The number is computed in SQL (max of both
+tables + 1) as part of the row's own INSERT/UPDATE (see
+signals.sequence_saved_receipt), so no two rows share one. SQLite runs one
+writer at a time, so numbers are handed out in commit order and a reader that
+stops at the current head can't skip a change that commits later.
+
+Tombstones are kept for RECEIPT_TOMBSTONE_RETENTION_DAYS. A cursor older than
+that may have missed deletions, so it is refused and the client resyncs.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from .models import Receipt, ReceiptTombstone
+
+
+def _latest(model):
+    return Coalesce(Subquery(
+        model.objects.filter(change_seq__isnull=False).order_by('-change_seq').values('change_seq')[:1]
+    ), 0)
+
+def next_change_seq():
+    """SQL expression for the next number in the change sequence, evaluated inside the write."""
+    return Greatest(_latest(Receipt), _latest(ReceiptTombstone)) + 1
+
+def current_change_seq():
+    """The newest change number handed out so far (0 for an empty feed)."""
+    receipts = Receipt.objects.aggregate(seq=Max('change_seq'))['seq'] or 0
+    tombstones = ReceiptTombstone.objects.aggregate(seq=Max('change_seq'))['seq'] or 0
+    return max(receipts, tombstones)
+
+def mark_changed(receipts):
+    """
+    Moves the receipts in a queryset to the end of the change feed, each with a
+    number of its own: the feed pages by change number, so rows sharing one could
+    be split across a page boundary and the rest skipped.
+    """
+    with transaction.atomic():
+        for receipt_id in receipts.order_by('id').values_list('id', flat=True):
+            Receipt.objects.filter(pk=receipt_id).update(change_seq=next_change_seq())
+
+def record_deletion(receipt_id):
+    """Leaves a tombstone for a deleted receipt and prunes ones past the retention period."""
+    ReceiptTombstone.objects.create(receipt_id=receipt_id, change_seq=next_change_seq())
+    horizon = timezone.now() - timedelta(days=settings.RECEIPT_TOMBSTONE_RETENTION_DAYS)
+    ReceiptTombstone.objects.filter(deleted_at__lt=horizon).delete()
+
+def is_cursor_expired(issued_at):
+    return issued_at < timezone.now() - timedelta(days=settings.RECEIPT_TOMBSTONE_RETENTION_DAYS)
+
+def get_changes(receipts, since, limit):
+    """
+    The next `limit` changes after change number `since`, oldest first.
+    receipts is the Receipt queryset to load changed rows from (columns, joins).
+    Returns (changed receipts, deleted receipt ids, last change number covered, has_more).
+    """
+    # Everything up to the head has committed; later changes are left for the next call
+    head = current_change_seq()
+    changed = list(receipts.filter(change_seq__gt=since, change_seq__lte=head).order_by('change_seq')[:limit + 1])
+    deleted = list(
+        ReceiptTombstone.objects.filter(change_seq__gt=since, change_seq__lte=head)
+        .order_by('change_seq').values_list('change_seq', 'receipt_id')[:limit + 1]
+    )
+
+    events = sorted([(receipt.change_seq, receipt) for receipt in changed] + deleted, key=lambda event: event[0])
+    has_more = len(events) > limit
+    events = events[:limit]
+    last_seq = events[-1][0] if has_more else max(head, since)
+    return (
+        [value for _, value in events if isinstance(value, Receipt)],
+        [value for _, value in events if not isinstance(value, Receipt)],
+        last_seq,
+        has_more,
+    )
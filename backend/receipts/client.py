@@ -0,0 +1,284 @@
+"""
+Resilient wrapper around the extraction provider's API call.
+
+- SQLiteTokenBucket: request rate limit shared by every worker process on the host
+- max in-flight cap: bounds concurrent calls per process (and per event loop for async calls)
+- jittered exponential retry for throttling/5xx/connection errors
+- CircuitBreaker: fails fast while the provider keeps failing
+"""
+import asyncio
+import random
+import sqlite3
+import threading
+import time
+import weakref
+
+
+class ProviderUnavailable(Exception):
+    """
+    The provider is throttling or down (retries exhausted or circuit open).
+    This is not a problem with the receipt, so callers should retry later
+    instead of marking the file as failed.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(ProviderUnavailable):
+    pass
+
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def get_status_code(exc):
+    """Best-effort HTTP status of a provider error (google.api_core errors expose it as .code)."""
+    for attr in ('code', 'status_code'):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, 'response', None)
+    value = getattr(response, 'status_code', None)
+    return value if isinstance(value, int) else None
+
+def is_retryable(exc):
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    return get_status_code(exc) in RETRYABLE_STATUS_CODES
+
+
+class SQLiteTokenBucket:
+    """
+    Token bucket whose state lives in a small SQLite file, so every process
+    using the same path shares one budget. Refills at `rate` tokens per second
+    up to `capacity`.
+    """
+
+    def __init__(self, path, rate, capacity, name='default'):
+        self.path = str(path)
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.name = name
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS token_bucket (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)'
+            )
+            conn.execute(
+                'INSERT OR IGNORE INTO token_bucket (name, tokens, updated_at) VALUES (?, ?, ?)',
+                (self.name, self.capacity, time.time()),
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _try_take(self):
+        """Takes one token if available. Returns 0 on success, else seconds until one refills."""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE') # Serializes the read-modify-write across processes
+            tokens, updated_at = conn.execute(
+                'SELECT tokens, updated_at FROM token_bucket WHERE name = ?', (self.name,)
+            ).fetchone()
+            now = time.time()
+            tokens = min(self.capacity, tokens + max(0.0, now - updated_at) * self.rate)
+            if tokens >= 1:
+                conn.execute('UPDATE token_bucket SET tokens = ?, updated_at = ? WHERE name = ?', (tokens - 1, now, self.name))
+                wait = 0.0
+            else:
+                conn.execute('UPDATE token_bucket SET tokens = ?, updated_at = ? WHERE name = ?', (tokens, now, self.name))
+                wait = (1 - tokens) / self.rate
+            conn.execute('COMMIT')
+            return wait
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def acquire(self, timeout=None, sleep=time.sleep):
+        """Blocks until a token is available. Returns False if timeout (seconds) passes first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._try_take()
+            if wait == 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            sleep(wait)
+
+    async def aacquire(self, timeout=None, sleep=asyncio.sleep):
+        """acquire() for coroutines; the SQLite transaction runs in a worker thread so the event loop never blocks on the lock."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = await asyncio.to_thread(self._try_take)
+            if wait == 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive provider failures and rejects
+    calls for `reset_timeout` seconds, then lets one trial call through (half-open).
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=60, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if self.clock() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def retry_after(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(0.0, self.reset_timeout - (self.clock() - self._opened_at))
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = self.clock() # (Re)open; a failed trial restarts the timeout
+
+
+class ExtractionClient:
+    """
+    Calls `func` through the rate limiter, in-flight cap, retry policy and circuit breaker.
+    Non-retryable errors are raised unchanged; exhausted retries and an open circuit
+    raise ProviderUnavailable.
+    acall() does the same for the coroutine function `async_func`, sharing the rate
+    limiter and breaker; its in-flight cap is `max_in_flight_async` per event loop.
+    """
+
+    def __init__(self, func, rate_limiter=None, max_in_flight=4, max_retries=4, base_delay=1.0,
+                 max_delay=30.0, breaker=None, sleep=time.sleep, rand=random.random,
+                 async_func=None, max_in_flight_async=None, async_sleep=asyncio.sleep):
+        self.func = func
+        self.async_func = async_func
+        self.max_in_flight_async = max_in_flight_async or max_in_flight
+        self.async_sleep = async_sleep
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.sleep = sleep
+        self.rand = rand
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._async_in_flight = weakref.WeakKeyDictionary() # Event loop -> asyncio.Semaphore
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff: uniform in [0, min(max_delay, base * 2^attempt)]."""
+        return self.rand() * min(self.max_delay, self.base_delay * (2 ** attempt))
+
+    def _check_breaker(self, last_error):
+        if not self.breaker.allow():
+            raise CircuitOpenError(
+                'Extraction provider circuit is open; failing fast.', retry_after=self.breaker.retry_after()
+            ) from last_error
+
+    def _record_error(self, error):
+        """Re-raises non-retryable errors; otherwise counts the failure so the caller retries."""
+        if not is_retryable(error):
+            self.breaker.record_success() # The provider answered; the request itself was bad
+            raise error
+        self.breaker.record_failure()
+
+    def _exhausted(self, last_error):
+        return ProviderUnavailable(
+            f'Extraction provider unavailable after {self.max_retries + 1} attempts: {last_error}',
+            retry_after=self.base_delay * (2 ** self.max_retries),
+        )
+
+    def call(self, *args, **kwargs):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            self._check_breaker(last_error)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(sleep=self.sleep)
+
+            with self._in_flight:
+                try:
+                    result = self.func(*args, **kwargs)
+                except Exception as e:
+                    self._record_error(e)
+                    last_error = e
+                else:
+                    self.breaker.record_success()
+                    return result
+
+            if attempt < self.max_retries:
+                self.sleep(self.backoff(attempt))
+
+        raise self._exhausted(last_error) from last_error
+
+    def _loop_semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_in_flight.get(loop)
+        if semaphore is None:
+            semaphore = self._async_in_flight[loop] = asyncio.Semaphore(self.max_in_flight_async)
+        return semaphore
+
+    async def acall(self, *args, **kwargs):
+        if self.async_func is None:
+            raise TypeError('This client has no async_func to await.')
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            self._check_breaker(last_error)
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire(sleep=self.async_sleep)
+
+            async with self._loop_semaphore():
+                try:
+                    result = await self.async_func(*args, **kwargs)
+                except Exception as e:
+                    self._record_error(e)
+                    last_error = e
+                else:
+                    self.breaker.record_success()
+                    return result
+
+            if attempt < self.max_retries:
+                await self.async_sleep(self.backoff(attempt))
+
+        raise self._exhausted(last_error) from last_error
@@ -0,0 +1,160 @@
+"""
+Streaming receipt export for GET /api/receipts/export/.
+
+Rows come from a values_list() queryset read with .iterator(chunk_size), so the
+database cursor is consumed RECEIPT_EXPORT_CHUNK_SIZE rows at a time and each
+chunk is encoded and handed to the StreamingHttpResponse before the next one is
+fetched. Memory stays the same whether the export is a thousand rows or millions.
+
+Formats:
+  csv      header row, then one line per receipt
+  ndjson   one JSON object per line
+  parquet  one row group per chunk; needs pyarrow, which is optional
+"""
+import csv
+import json
+from itertools import islice
+from django.conf import settings
+
+# (column, queryset lookup); one row per receipt
+COLUMNS = [
+    ('id', 'id'),
+    ('receipt_file_id', 'receipt_file_id'),
+    ('file_name', 'receipt_file__file_name'),
+    ('first_page', 'first_page'), # Set for receipts split out of a multi-receipt PDF
+    ('last_page', 'last_page'),
+    ('merchant_name', 'merchant_name'),
+    ('purchased_at', 'purchased_at'),
+    ('total_amount', 'total_amount'),
+    ('amount_minor', 'amount_minor'),
+    ('currency', 'currency'),
+    ('extraction_version', 'extraction_version'),
+    ('created_at', 'created_at'),
+    ('updated_at', 'updated_at'),
+]
+COLUMN_NAMES = [name for name, _ in COLUMNS]
+DATETIME_COLUMNS = {'purchased_at', 'created_at', 'updated_at'}
+INTEGER_COLUMNS = {'id', 'receipt_file_id', 'first_page', 'last_page', 'amount_minor'}
+_datetime_indexes = [COLUMN_NAMES.index(name) for name in DATETIME_COLUMNS]
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+FORMATS = tuple(CONTENT_TYPES)
+
+
+class ExportUnavailable(Exception):
+    """The requested format needs an optional dependency that isn't installed."""
+
+
+def _format_datetime(value):
+    # Same representation as the API's serializers
+    return value.isoformat().replace('+00:00', 'Z') if value is not None else None
+
+def iter_row_chunks(queryset, chunk_size=None):
+    """Lists of up to chunk_size value tuples (in COLUMNS order), read from the database chunk by chunk."""
+    chunk_size = chunk_size or settings.RECEIPT_EXPORT_CHUNK_SIZE
+    rows = queryset.order_by('id').values_list(*(lookup for _, lookup in COLUMNS)).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def _text_rows(chunk):
+    for row in chunk:
+        row = list(row)
+        for index in _datetime_indexes:
+            row[index] = _format_datetime(row[index])
+        yield row
+
+
+class _Echo:
+    """File-like object whose write() returns what was written, so csv.writer output can be yielded."""
+
+    def write(self, value):
+        return value
+
+def stream_csv(chunks):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(COLUMN_NAMES)
+    for chunk in chunks:
+        yield ''.join(writer.writerow(row) for row in _text_rows(chunk))
+
+def stream_ndjson(chunks):
+    for chunk in chunks:
+        yield ''.join(json.dumps(dict(zip(COLUMN_NAMES, row)), ensure_ascii=False) + '\n' for row in _text_rows(chunk))
+
+
+class _ChunkSink:
+    """Write-only file object for pyarrow; what has been written so far is taken out with drain()."""
+
+    closed = False
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+def parquet_schema():
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ExportUnavailable("Parquet export requires pyarrow (pip install pyarrow).")
+
+    types = {name: pa.string() for name in COLUMN_NAMES}
+    types.update({name: pa.int64() for name in INTEGER_COLUMNS})
+    types.update({name: pa.timestamp('us', tz='UTC') for name in DATETIME_COLUMNS})
+    return pa.schema([(name, types[name]) for name in COLUMN_NAMES])
+
+def stream_parquet(chunks, schema):
+    """One row group per chunk; the file footer is written when the last chunk has been sent."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    try:
+        for chunk in chunks:
+            columns = list(zip(*chunk))
+            writer.write_batch(pa.RecordBatch.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema,
+            ))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+def stream_export(queryset, export_format):
+    """
+    The export of queryset as an iterator of str/bytes pieces for a StreamingHttpResponse.
+    Raises ExportUnavailable up front (before anything is streamed) if the format can't be produced.
+    """
+    if export_format == 'parquet':
+        schema = parquet_schema()
+        return stream_parquet(iter_row_chunks(queryset), schema)
+    if export_format == 'ndjson':
+        return stream_ndjson(iter_row_chunks(queryset))
+    return stream_csv(iter_row_chunks(queryset))
@@ -0,0 +1,76 @@
+from datetime import datetime, time, timedelta
+from decimal import InvalidOperation
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .money import to_minor_units
+
+
+def _parse_day(value):
+    try:
+        return parse_date(value)
+    except ValueError:
+        return None
+
+def _parse_bound(value, end_of_day=False):
+    """
+    Parses a YYYY-MM-DD date or an ISO datetime into an aware datetime.
+    A bare date used as an upper bound covers that whole day.
+    """
+    day = _parse_day(value)
+    if day is not None:
+        parsed = datetime.combine(day + timedelta(days=1) if end_of_day else day, time.min)
+    else:
+        try:
+            parsed = parse_datetime(value)
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise ValueError(f"Invalid date: {value!r}. Use YYYY-MM-DD or an ISO datetime.")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+def filter_receipts(queryset, params):
+    """
+    Applies the receipt list filters in SQL.
+    Supported params:
+      - purchased_after / purchased_before: date range on purchased_at (inclusive)
+      - min_amount / max_amount: total in major units, e.g. 10.50 (inclusive)
+      - currency: ISO code the amounts are in
+      - merchant: case-insensitive substring of merchant_name
+      - duplicates: 'include' (default), 'exclude' or 'only' receipts copied from an earlier scan
+    Raises ValueError with a user-facing message on bad input.
+    """
+    currency = params.get('currency')
+    if currency:
+        queryset = queryset.filter(currency=currency.upper())
+
+    if params.get('purchased_after'):
+        queryset = queryset.filter(purchased_at__gte=_parse_bound(params['purchased_after']))
+    if params.get('purchased_before'):
+        bound = params['purchased_before']
+        if _parse_day(bound) is not None:
+            queryset = queryset.filter(purchased_at__lt=_parse_bound(bound, end_of_day=True))
+        else:
+            queryset = queryset.filter(purchased_at__lte=_parse_bound(bound))
+
+    for param, lookup in (('min_amount', 'amount_minor__gte'), ('max_amount', 'amount_minor__lte')):
+        if params.get(param):
+            try:
+                amount_minor = to_minor_units(params[param], currency.upper() if currency else None)
+            except (InvalidOperation, ValueError):
+                raise ValueError(f"{param} must be a number, e.g. 12.50")
+            queryset = queryset.filter(**{lookup: amount_minor})
+
+    if params.get('merchant'):
+        queryset = queryset.filter(merchant_name__icontains=params['merchant'])
+
+    duplicates = params.get('duplicates')
+    if duplicates == 'exclude':
+        queryset = queryset.filter(receipt_file__duplicate_of__isnull=True)
+    elif duplicates == 'only':
+        queryset = queryset.filter(receipt_file__duplicate_of__isnull=False)
+    elif duplicates not in (None, '', 'include'):
+        raise ValueError("duplicates must be one of: include, exclude, only")
+
+    return queryset
@@ -0,0 +1,114 @@
+"""
+Single-pass upload ingest.
+
+Uploads are hashed and size-checked while the chunks are written to disk, and
+validated with a cheap structural check instead of a full PDF parse. The stored
+file is then memory-mapped and handed to extraction: PyMuPDF (preprocessing,
+local extraction) reads the mapping in place. The one copy left is made when the
+unmodified original is sent to Gemini, whose client only takes bytes.
+"""
+import hashlib
+import mmap
+import os
+import re
+from contextlib import contextmanager
+from .backends import get_fitz
+
+PDF_HEADER = b'%PDF-'
+HEADER_WINDOW = 1024 # The spec allows junk before the header, within the first 1KB
+TRAILER_WINDOW = 2048
+PAGE_COUNT_RE = re.compile(rb'/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b', re.DOTALL)
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def stream_to_disk(chunks, full_file_path, max_bytes=None):
+    """
+    Writes an iterable of byte chunks to full_file_path in one pass, hashing and
+    counting as it goes. Returns (sha256_hex, size).
+    Raises UploadTooLarge (and removes the partial file) once max_bytes is exceeded.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(full_file_path, 'wb') as destination:
+            for chunk in chunks:
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise UploadTooLarge(f"File exceeds the {max_bytes} byte upload limit.")
+                digest.update(chunk)
+                destination.write(chunk)
+    except BaseException:
+        if os.path.exists(full_file_path):
+            os.remove(full_file_path)
+        raise
+    return digest.hexdigest(), size
+
+def iter_file_chunks(source, chunk_size=64 * 1024):
+    """Adapts a file-like object (e.g. a zip entry) to the chunk iterable stream_to_disk expects."""
+    return iter(lambda: source.read(chunk_size), b'')
+
+@contextmanager
+def open_mapped(full_file_path):
+    """
+    Read-only memory map of a stored file. Yields b'' for empty files,
+    which can't be mapped.
+    """
+    with open(full_file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                pass # A consumer still holds a view; the map is released when that view is collected
+
+def _count_pages_with_fitz(pdf_data):
+    fitz = get_fitz()
+    view = memoryview(pdf_data)
+    try:
+        with fitz.open(stream=view, filetype='pdf') as doc:
+            return doc.page_count
+    finally:
+        view.release()
+
+def quick_validate_pdf(pdf_data):
+    """
+    Cheap structural PDF check on an in-memory/mapped buffer.
+    Checks the header, the startxref/%%EOF trailer and the first page tree
+    node's /Count without parsing the document. When the trailer or a page
+    count can't be read that way (e.g. compressed object streams, or an empty
+    page tree), PyMuPDF opens the same buffer, so the file is still never
+    re-read from disk.
+    Returns (is_valid, reason_if_invalid) like validate_pdf.
+    """
+    if not pdf_data:
+        return False, "File is empty or corrupted."
+    if PDF_HEADER not in pdf_data[:HEADER_WINDOW]:
+        return False, "Invalid PDF file structure or format."
+
+    trailer = pdf_data[-TRAILER_WINDOW:]
+    # The scan stops at the first page tree node, so a typical upload isn't read to the end.
+    # Any node counting pages means the file has some; a first node counting none is left to PyMuPDF.
+    page_count = PAGE_COUNT_RE.search(pdf_data) if b'startxref' in trailer and b'%%EOF' in trailer else None
+    if page_count and int(page_count.group(1) or page_count.group(2)) > 0:
+        return True, None
+
+    # Ambiguous structure: let PyMuPDF decide (it can also repair broken xrefs)
+    fitz = get_fitz()
+    try:
+        if _count_pages_with_fitz(pdf_data) == 0:
+            return False, "PDF contains no pages."
+        return True, None
+    except fitz.EmptyFileError:
+        return False, "File is empty or corrupted."
+    except fitz.FileDataError:
+        return False, "Invalid PDF file structure or format."
+    except Exception as e:
+        return False, f"An unexpected error occurred during PDF validation: {str(e)}"
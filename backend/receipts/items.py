@@ -0,0 +1,49 @@
+"""
+Reads the line items out of an extractor's raw response and normalizes them into
+ReceiptItem field values. Kept free of model imports so the search index can
+use it.
+"""
+import json
+import re
+from .money import parse_amount
+
+DESCRIPTION_MAX_LENGTH = 255
+PRICE_MAX_LENGTH = 32
+
+_JSON_BLOCK_RE = re.compile(r'```json\n(.*?)\n```', re.DOTALL)
+
+
+def extract_items(parsed_text):
+    """Line items from a raw extractor response (the JSON, optionally in a ```json fence). Returns [] if unreadable."""
+    if not parsed_text:
+        return []
+    match = _JSON_BLOCK_RE.search(parsed_text)
+    try:
+        data = json.loads(match.group(1) if match else parsed_text)
+    except (ValueError, TypeError):
+        return []
+    items = data.get('items') if isinstance(data, dict) else None
+    return [item for item in items if isinstance(item, dict)] if isinstance(items, list) else []
+
+def normalize_items(items, default_currency=None):
+    """
+    Returns ReceiptItem field values (position, description, price, price_minor, currency)
+    for each item that has a description or a price. Prices without a currency
+    symbol take the receipt's currency.
+    """
+    rows = []
+    for item in items:
+        description = item.get('description')
+        price = item.get('price')
+        description = str(description).strip()[:DESCRIPTION_MAX_LENGTH] if description is not None else None
+        if not description and price is None:
+            continue
+        price_minor, currency = parse_amount(price, default_currency)
+        rows.append({
+            'position': len(rows),
+            'description': description or None,
+            'price': str(price)[:PRICE_MAX_LENGTH] if price is not None else None,
+            'price_minor': price_minor,
+            'currency': currency,
+        })
+    return rows
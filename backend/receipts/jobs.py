@@ -0,0 +1,147 @@
+import atexit
+import multiprocessing
+import threading
+import django
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from .models import ExtractionJob
+
+_executor = None
+_validation_executor = None
+_segment_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the shared worker pool, creating it on first use.
+    settings.RECEIPT_WORKER_POOL_KIND picks 'thread' or 'process' workers and
+    settings.RECEIPT_WORKER_POOL_SIZE sets how many run at once.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            kind = settings.RECEIPT_WORKER_POOL_KIND
+            size = settings.RECEIPT_WORKER_POOL_SIZE
+            if kind == 'process':
+                _executor = ProcessPoolExecutor(
+                    max_workers=size,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=django.setup, # Spawned workers start with a fresh interpreter
+                )
+            elif kind == 'thread':
+                _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='receipt-worker')
+            else:
+                raise ValueError(f"Unknown RECEIPT_WORKER_POOL_KIND: {kind!r}")
+        return _executor
+
+def get_validation_executor():
+    """
+    Returns the process pool used to validate batch uploads across cores.
+    Sized by settings.BATCH_VALIDATION_WORKERS (defaults to the CPU count).
+    """
+    global _validation_executor
+    with _executor_lock:
+        if _validation_executor is None:
+            _validation_executor = ProcessPoolExecutor(
+                max_workers=settings.BATCH_VALIDATION_WORKERS or None,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+            )
+        return _validation_executor
+
+def get_segment_executor():
+    """
+    Returns the thread pool that extracts the receipts split out of one PDF
+    concurrently (see receipts.segments). Sized by settings.RECEIPT_SPLIT_MAX_WORKERS;
+    calls to Gemini are further limited by GEMINI_MAX_IN_FLIGHT.
+    """
+    global _segment_executor
+    with _executor_lock:
+        if _segment_executor is None:
+            _segment_executor = ThreadPoolExecutor(max_workers=settings.RECEIPT_SPLIT_MAX_WORKERS, thread_name_prefix='receipt-segment')
+        return _segment_executor
+
+def shutdown_executor(wait=True):
+    """Stops the worker pools, optionally waiting for queued jobs to finish."""
+    global _executor, _validation_executor, _segment_executor
+    with _executor_lock:
+        for executor in (_executor, _validation_executor, _segment_executor):
+            if executor is not None:
+                executor.shutdown(wait=wait)
+        _executor = None
+        _validation_executor = None
+        _segment_executor = None
+
+atexit.register(shutdown_executor)
+
+def enqueue_extraction(receipt_file):
+    """
+    Creates a queued ExtractionJob for a stored ReceiptFile and hands it to the
+    worker pool once the surrounding transaction commits.
+    """
+    job = ExtractionJob.objects.create(receipt_file=receipt_file)
+    transaction.on_commit(lambda: get_executor().submit(run_extraction_job, job.id))
+    return job
+
+def enqueue_extractions(receipt_files):
+    """Bulk version of enqueue_extraction for batch uploads. Returns the jobs in the same order."""
+    created_jobs = ExtractionJob.objects.bulk_create(
+        [ExtractionJob(receipt_file=receipt_file) for receipt_file in receipt_files]
+    )
+
+    def submit_all():
+        executor = get_executor()
+        for job in created_jobs:
+            executor.submit(run_extraction_job, job.id)
+
+    transaction.on_commit(submit_all)
+    return created_jobs
+
+def run_extraction_job(job_id):
+    """
+    Worker entry point: validate -> extract -> persist for one job.
+    Runs outside the request cycle, so it manages its own DB connections.
+    """
+    # Imported here so process workers only import it after django.setup()
+    from .pipeline import validate_receipt_file, extract_and_save, open_receipt_file, ExtractionFailed, EmptyExtraction
+    from .client import ProviderUnavailable
+
+    close_old_connections()
+    try:
+        job = ExtractionJob.objects.select_related('receipt_file').get(id=job_id)
+        job.status = ExtractionJob.STATUS_RUNNING
+        job.started_at = timezone.now()
+        job.save(update_fields=['status', 'started_at'])
+
+        receipt_file = job.receipt_file
+        try:
+            with open_receipt_file(receipt_file) as (full_file_path, pdf_data):
+                # Batch uploads are validated before queueing; single uploads are validated here
+                if not receipt_file.is_valid and not validate_receipt_file(receipt_file, pdf_data=pdf_data):
+                    job.status = ExtractionJob.STATUS_FAILED
+                    job.error = receipt_file.invalid_reason
+                else:
+                    extract_and_save(receipt_file, full_file_path, pdf_data=pdf_data)
+                    job.status = ExtractionJob.STATUS_SUCCEEDED
+        except (ExtractionFailed, EmptyExtraction) as e:
+            job.status = ExtractionJob.STATUS_FAILED
+            job.error = str(e)
+        except ProviderUnavailable as e:
+            # The file stays valid and unprocessed so it can be retried through /api/process/
+            job.status = ExtractionJob.STATUS_FAILED
+            job.error = f"Extraction provider temporarily unavailable: {str(e)}"
+        except Exception as e:
+            receipt_file.is_processed = False
+            receipt_file.invalid_reason = f"Processing failed: {str(e)}"
+            receipt_file.save(update_fields=['is_processed', 'invalid_reason', 'updated_at'])
+            job.status = ExtractionJob.STATUS_FAILED
+            job.error = receipt_file.invalid_reason
+
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'error', 'finished_at'])
+        return job.status
+    finally:
+        close_old_connections()
@@ -0,0 +1,231 @@
+"""
+Local extraction from a PDF's embedded text layer.
+
+Digitally generated receipts already carry their text, so merchant, date and
+total can usually be read with PyMuPDF and a few regexes in milliseconds.
+Each result carries a confidence score, and low-confidence receipts (scans,
+odd layouts) are escalated to the fallback extractor (Gemini by default).
+"""
+import asyncio
+import json
+import re
+import threading
+from datetime import datetime
+from django.conf import settings
+from .money import parse_amount
+from .backends import get_backend, get_async_backend, get_fitz
+from .metrics import stage
+
+DATE_FORMATS = (
+    '%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%d.%m.%Y', '%m-%d-%Y', '%m-%d-%y',
+    '%b %d, %Y', '%B %d, %Y', '%b %d %Y', '%d %b %Y', '%d %B %Y',
+)
+DATE_RE = re.compile(
+    r'\b(\d{4}-\d{2}-\d{2}'
+    r'|\d{1,2}[/-]\d{1,2}[/-]\d{2,4}'
+    r'|\d{1,2}\.\d{1,2}\.\d{4}'
+    r'|[A-Z][a-z]{2,8}\.? \d{1,2},? \d{4}'
+    r'|\d{1,2} [A-Z][a-z]{2,8} \d{4})\b'
+)
+AMOUNT_RE = re.compile(r'(?:[$€£¥₹]\s?|\b[A-Z]{3}\s)?-?\d{1,3}(?:,?\d{3})*[.,]\d{2}\b')
+TOTAL_RE = re.compile(r'\b(grand\s+total|total\s+due|amount\s+due|balance\s+due|total)\b', re.IGNORECASE)
+STRONG_TOTAL_RE = re.compile(r'\b(grand\s+total|total\s+due|amount\s+due|balance\s+due)\b', re.IGNORECASE)
+NOT_ITEM_RE = re.compile(r'\b(sub\s*-?\s*total|total|tax|vat|change|cash|tip|gratuity|balance|visa|mastercard|amex)\b', re.IGNORECASE)
+SUBTOTAL_RE = re.compile(r'sub\s*-?\s*total', re.IGNORECASE)
+MERCHANT_SKIP_RE = re.compile(r'\b(receipt|invoice|welcome|customer copy|tel|phone|www\.|http)\b', re.IGNORECASE)
+
+# Score for each field found; a receipt needs most of them to skip the model
+CONFIDENCE_WEIGHTS = {
+    'total_amount': 0.5,
+    'purchased_at': 0.3,
+    'merchant_name': 0.2,
+}
+MIN_TEXT_LENGTH = 20 # Less text than this means a scanned image without a usable text layer
+
+_stats_lock = threading.Lock()
+_path_counts = {'local': 0, 'fallback': 0}
+
+
+def _count(path):
+    with _stats_lock:
+        _path_counts[path] += 1
+
+def get_path_stats():
+    """How often this process answered from the text layer versus the fallback extractor."""
+    with _stats_lock:
+        local, fallback = _path_counts['local'], _path_counts['fallback']
+    total = local + fallback
+    return {
+        'local': local,
+        'fallback': fallback,
+        'local_rate': round(local / total, 4) if total else None,
+        'confidence_threshold': settings.LOCAL_EXTRACTION_CONFIDENCE_THRESHOLD,
+    }
+
+def reset_path_stats():
+    with _stats_lock:
+        _path_counts['local'] = 0
+        _path_counts['fallback'] = 0
+
+def read_text_layer(pdf_path, pdf_data=None):
+    """Returns the embedded text of every page, in reading order."""
+    fitz = get_fitz()
+    if pdf_data is None:
+        with fitz.open(pdf_path) as doc:
+            return "\n".join(page.get_text(sort=True) for page in doc)
+
+    view = memoryview(pdf_data)
+    try:
+        with fitz.open(stream=view, filetype='pdf') as doc:
+            return "\n".join(page.get_text(sort=True) for page in doc)
+    finally:
+        view.release()
+
+def _text_quality(text):
+    """Share of characters that look like normal receipt text; OCR noise lowers it."""
+    visible = [c for c in text if not c.isspace()]
+    if not visible:
+        return 0.0
+    clean = sum(1 for c in visible if c.isascii() or c in '€£¥₹')
+    return clean / len(visible)
+
+def _parse_date(lines):
+    current_year = datetime.now().year
+    for line in lines:
+        for match in DATE_RE.finditer(line):
+            candidate = match.group(1).replace('.', '') if match.group(1)[0].isalpha() else match.group(1)
+            for date_format in DATE_FORMATS:
+                try:
+                    parsed = datetime.strptime(candidate, date_format)
+                except ValueError:
+                    continue
+                if 2000 <= parsed.year <= current_year + 1:
+                    return parsed
+    return None
+
+def _parse_total(lines):
+    """Returns the display string of the receipt total, preferring 'grand total'/'amount due' lines."""
+    candidates = []
+    for index, line in enumerate(lines):
+        if not TOTAL_RE.search(line) or SUBTOTAL_RE.search(line):
+            continue
+        amounts = AMOUNT_RE.findall(line)
+        if not amounts and index + 1 < len(lines):
+            amounts = AMOUNT_RE.findall(lines[index + 1]) # Label and value in separate columns
+        if amounts:
+            amount_minor, _ = parse_amount(amounts[-1])
+            if amount_minor is not None:
+                candidates.append((bool(STRONG_TOTAL_RE.search(line)), amount_minor, amounts[-1].strip()))
+    if not candidates:
+        return None
+    return max(candidates)[2]
+
+def has_total_line(text):
+    """True if the text contains a total line with an amount, i.e. the end of a receipt."""
+    lines = [" ".join(line.split()) for line in text.splitlines()]
+    return _parse_total([line for line in lines if line]) is not None
+
+def _parse_merchant(lines):
+    for line in lines[:8]:
+        if ':' in line or MERCHANT_SKIP_RE.search(line) or DATE_RE.search(line) or AMOUNT_RE.search(line):
+            continue # Labels ("Date:"), headers, dates and amounts are not the merchant
+        letters = sum(1 for c in line if c.isalpha())
+        if letters >= 3 and letters >= len(line.replace(' ', '')) * 0.8:
+            return line
+    return None
+
+def _parse_items(lines):
+    items = []
+    for line in lines:
+        amounts = AMOUNT_RE.findall(line)
+        if not amounts or NOT_ITEM_RE.search(line):
+            continue
+        description = line[:line.rfind(amounts[-1])].strip(' .:-\t')
+        if sum(1 for c in description if c.isalpha()) >= 2:
+            items.append({'description': description, 'price': amounts[-1].strip()})
+    return items
+
+def parse_receipt_text(text):
+    """
+    Reads merchant, date, total and items from receipt text.
+    Returns (fields, confidence) where confidence is between 0 and 1.
+    """
+    lines = [" ".join(line.split()) for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    fields = {
+        'merchant_name': _parse_merchant(lines),
+        'purchased_at': _parse_date(lines),
+        'total_amount': _parse_total(lines),
+        'items': _parse_items(lines),
+    }
+    confidence = sum(weight for name, weight in CONFIDENCE_WEIGHTS.items() if fields[name])
+    return fields, round(confidence * _text_quality(text), 4)
+
+def extract_details_from_text_layer(pdf_path, pdf_data=None):
+    """
+    Extracts receipt details from the PDF text layer without calling a model.
+    Returns (parsed_data, raw_response, confidence); parsed_data is None when the
+    PDF has no usable text.
+    """
+    text = read_text_layer(pdf_path, pdf_data)
+    if len(text.strip()) < MIN_TEXT_LENGTH:
+        return None, "PDF has no usable text layer.", 0.0
+
+    with stage('parse'):
+        fields, confidence = parse_receipt_text(text)
+    amount_minor, currency = parse_amount(fields['total_amount'])
+    purchased_at = fields['purchased_at']
+
+    # Same JSON shape the model returns, so parsed_text stays uniform
+    raw = {
+        'merchant_name': fields['merchant_name'],
+        'purchase_date': purchased_at.strftime('%Y-%m-%d') if purchased_at else None,
+        'total_amount': fields['total_amount'],
+        'items': fields['items'],
+        'source': 'text_layer',
+        'confidence': confidence,
+    }
+    raw_response = f"```json\n{json.dumps(raw, indent=2, ensure_ascii=False)}\n```"
+
+    extracted_info = {
+        'merchant_name': fields['merchant_name'],
+        'total_amount': fields['total_amount'],
+        'amount_minor': amount_minor,
+        'currency': currency,
+        'purchased_at': purchased_at,
+    }
+    return extracted_info, raw_response, confidence
+
+def extract_details_local_first(pdf_path, pdf_data=None):
+    """
+    Extractor that tries the text layer first and only calls
+    settings.RECEIPT_FALLBACK_EXTRACTOR when confidence is below
+    settings.LOCAL_EXTRACTION_CONFIDENCE_THRESHOLD.
+    """
+    try:
+        parsed_data, raw_response, confidence = extract_details_from_text_layer(pdf_path, pdf_data)
+    except Exception:
+        parsed_data, confidence = None, 0.0
+
+    if parsed_data is not None and confidence >= settings.LOCAL_EXTRACTION_CONFIDENCE_THRESHOLD:
+        _count('local')
+        return parsed_data, raw_response
+
+    _count('fallback')
+    fallback = get_backend(settings.RECEIPT_FALLBACK_EXTRACTOR)
+    return fallback(pdf_path, pdf_data)
+
+async def aextract_details_local_first(pdf_path, pdf_data=None):
+    """Async extract_details_local_first: parses the text layer in a worker thread, then awaits the fallback."""
+    try:
+        parsed_data, raw_response, confidence = await asyncio.to_thread(extract_details_from_text_layer, pdf_path, pdf_data)
+    except Exception:
+        parsed_data, confidence = None, 0.0
+
+    if parsed_data is not None and confidence >= settings.LOCAL_EXTRACTION_CONFIDENCE_THRESHOLD:
+        _count('local')
+        return parsed_data, raw_response
+
+    _count('fallback')
+    fallback = get_async_backend(settings.RECEIPT_FALLBACK_EXTRACTOR)
+    return await fallback(pdf_path, pdf_data)
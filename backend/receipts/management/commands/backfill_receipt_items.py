@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from receipts.items import extract_items, normalize_items
+from receipts.models import Receipt, ReceiptItem
+
+
+class Command(BaseCommand):
+    help = "Creates ReceiptItem rows from the items stored in each receipt's raw response (parsed_text), in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Receipts per transaction')
+        parser.add_argument('--rebuild', action='store_true', help='Delete all existing items first and re-create them')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            deleted, _ = ReceiptItem.objects.all().delete()
+            self.stdout.write(f"Deleted {deleted} existing items.")
+
+        # Receipts that already have items (e.g. processed after this feature shipped) are skipped
+        pending = Receipt.objects.filter(~Exists(ReceiptItem.objects.filter(receipt=OuterRef('pk')))).order_by('id')
+        last_id, receipts_done, items_created = 0, 0, 0
+        while True:
+            batch = list(pending.filter(id__gt=last_id).values_list('id', 'parsed_text', 'currency')[:options['batch_size']])
+            if not batch:
+                break
+            items = [
+                ReceiptItem(receipt_id=receipt_id, **row)
+                for receipt_id, parsed_text, currency in batch
+                for row in normalize_items(extract_items(parsed_text), currency)
+            ]
+            with transaction.atomic():
+                # A receipt processed concurrently may already have its items
+                ReceiptItem.objects.bulk_create(items, ignore_conflicts=True)
+            last_id = batch[-1][0]
+            receipts_done += len(batch)
+            items_created += len(items)
+            self.stdout.write(f"Processed {receipts_done} receipts, {items_created} items so far (last id {last_id}).")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {items_created} items from {receipts_done} receipts."))
@@ -0,0 +1,83 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from receipts.changes import mark_changed
+from receipts.models import Receipt, ReceiptFile
+from receipts.near_duplicates import perceptual_hash_worker
+
+
+class Command(BaseCommand):
+    help = (
+        "Computes the first-page perceptual hash of every valid receipt file that doesn't have one yet, "
+        "on a process pool, so that rescans of files uploaded before near-duplicate detection was "
+        "turned on are found too. Safe to interrupt and run again: hashed files are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Hashing processes (1 hashes in this process)')
+        parser.add_argument('--batch-size', type=int, default=500, help='ReceiptFiles read from the database at a time')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['batch_size'] < 1:
+            raise CommandError("--workers and --batch-size must be at least 1.")
+
+        executor = None
+        if options['workers'] > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=options['workers'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup, # Spawned workers start with a fresh interpreter
+            )
+
+        files = ReceiptFile.objects.filter(is_valid=True, perceptual_hash__isnull=True).order_by('id')
+        last_id, hashes = 0, {} # file_path -> hash; identical uploads share a stored file
+        counts = {'hashed': 0, 'rendered': 0, 'failed': 0}
+        started = time.monotonic()
+        try:
+            while True:
+                batch = list(files.filter(id__gt=last_id).values_list('id', 'file_path')[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+
+                paths = list({file_path for _, file_path in batch if file_path not in hashes})
+                if executor:
+                    results = executor.map(perceptual_hash_worker, paths, chunksize=8)
+                else:
+                    results = map(perceptual_hash_worker, paths)
+                errors = {}
+                for file_path, (value, error) in zip(paths, results):
+                    if error:
+                        errors[file_path] = error
+                    else:
+                        hashes[file_path] = value
+                        counts['rendered'] += 1
+
+                hashed_ids = []
+                with transaction.atomic():
+                    for receipt_file_id, file_path in batch:
+                        if file_path in errors:
+                            counts['failed'] += 1
+                            self.stderr.write(f"ReceiptFile {receipt_file_id}: {errors[file_path]}")
+                            continue
+                        ReceiptFile.objects.filter(id=receipt_file_id).update(perceptual_hash=hashes[file_path], updated_at=timezone.now())
+                        hashed_ids.append(receipt_file_id)
+                    # The hash is part of receipt_file_details; moving the receipts in the change feed
+                    # is also how running servers find the newly hashed files on their next lookup
+                    mark_changed(Receipt.objects.filter(receipt_file_id__in=hashed_ids))
+                counts['hashed'] += len(hashed_ids)
+
+                done = counts['hashed'] + counts['failed']
+                self.stdout.write(f"{done} files checked, {done / (time.monotonic() - started):.1f}/s.")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Hashed {counts['hashed']} files ({counts['rendered']} distinct stored files rendered); {counts['failed']} failed."
+        ))
@@ -0,0 +1,63 @@
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from receipts.ingest import iter_file_chunks
+from receipts.models import ReceiptFile
+from receipts.storage import OBJECT_PREFIX, get_receipt_storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves receipt files stored under MEDIA_ROOT by upload year (receipts/<year>/...) into the "
+        "configured content-addressed storage backend, in batches. Identical files end up stored once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='ReceiptFiles per transaction')
+        parser.add_argument('--keep-source', action='store_true', help='Leave the old files in place after copying them')
+
+    def handle(self, *args, **options):
+        storage = get_receipt_storage()
+        # Rows already in the content-addressed layout are skipped, so the command can be re-run after an interruption
+        pending = ReceiptFile.objects.exclude(file_path__startswith=OBJECT_PREFIX + '/').order_by('id')
+        last_id, moved, missing = 0, 0, 0
+        while True:
+            batch = list(pending.filter(id__gt=last_id).only('id', 'file_path', 'content_hash', 'file_size')[:options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            updated, sources = [], []
+            for receipt_file in batch:
+                source_path = os.path.join(settings.MEDIA_ROOT, *receipt_file.file_path.replace('\\', '/').split('/'))
+                if not os.path.exists(source_path):
+                    missing += 1
+                    self.stderr.write(f"ReceiptFile {receipt_file.id}: {receipt_file.file_path} not found, skipped.")
+                    continue
+                with open(source_path, 'rb') as source:
+                    stored = storage.save(iter_file_chunks(source))
+                receipt_file.file_path = stored.key
+                receipt_file.content_hash = stored.content_hash
+                receipt_file.file_size = stored.size
+                updated.append(receipt_file)
+                sources.append(source_path)
+
+            try:
+                with transaction.atomic():
+                    ReceiptFile.objects.bulk_update(updated, ['file_path', 'content_hash', 'file_size'])
+            except Exception:
+                for receipt_file in updated:
+                    storage.release(receipt_file.file_path) # Undo the references taken above
+                raise
+
+            if not options['keep_source']:
+                for source_path in sources: # Only once the rows point at the new copies
+                    os.remove(source_path)
+            moved += len(updated)
+            self.stdout.write(f"Moved {moved} files so far (last id {last_id}).")
+
+        summary = f"Moved {moved} files into {type(storage).__name__}."
+        if missing:
+            summary += f" {missing} files were missing."
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+from receipts.models import Receipt
+from receipts.search import is_search_available, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = "Repopulates the receipt full-text search table, e.g. after bulk inserts that bypassed model signals."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if not is_search_available():
+            raise CommandError("Full-text search requires the SQLite database backend.")
+        count = rebuild_search_index(Receipt.objects.all(), batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} receipts."))
@@ -0,0 +1,86 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.core.management.base import BaseCommand, CommandError
+from receipts.models import Receipt, ReceiptFile
+from receipts.thumbnails import thumbnail_worker
+
+
+class Command(BaseCommand):
+    help = (
+        "Renders the first-page thumbnail of every valid receipt file that doesn't have one cached yet, "
+        "on a process pool, plus the first page of every receipt split out of a larger PDF. "
+        "Files with the same content share a thumbnail and are rendered once. "
+        "Safe to interrupt and run again: cached thumbnails are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Rendering processes (1 renders in this process)')
+        parser.add_argument('--batch-size', type=int, default=500, help='ReceiptFiles read from the database at a time')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['batch_size'] < 1:
+            raise CommandError("--workers and --batch-size must be at least 1.")
+
+        executor = None
+        if options['workers'] > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=options['workers'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup, # Spawned workers start with a fresh interpreter
+            )
+
+        files = ReceiptFile.objects.filter(is_valid=True).order_by('id')
+        last_id, seen = 0, set()
+        counts = {'rendered': 0, 'cached': 0, 'failed': 0}
+        started = time.monotonic()
+        try:
+            while True:
+                batch = list(files.filter(id__gt=last_id).values_list('id', 'file_path', 'content_hash')[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+
+                # Receipts split out of a PDF are shown by their own first page
+                split_pages = {}
+                for receipt_file_id, first_page in Receipt.objects.filter(
+                    receipt_file_id__in=[row[0] for row in batch], first_page__gt=1
+                ).values_list('receipt_file_id', 'first_page'):
+                    split_pages.setdefault(receipt_file_id, []).append(first_page)
+
+                tasks = []
+                for receipt_file_id, file_path, content_hash in batch:
+                    for page in [1] + sorted(split_pages.get(receipt_file_id, [])):
+                        if content_hash and (content_hash, page) in seen:
+                            counts['cached'] += 1
+                            continue
+                        if content_hash:
+                            seen.add((content_hash, page))
+                        tasks.append((receipt_file_id, file_path, content_hash, page))
+
+                paths, hashes, pages = [task[1] for task in tasks], [task[2] for task in tasks], [task[3] for task in tasks]
+                if executor:
+                    results = executor.map(thumbnail_worker, paths, hashes, pages, chunksize=8)
+                else:
+                    results = map(thumbnail_worker, paths, hashes, pages)
+                for (receipt_file_id, _, content_hash, page), (new_hash, outcome) in zip(tasks, results):
+                    if isinstance(outcome, str):
+                        counts['failed'] += 1
+                        self.stderr.write(f"ReceiptFile {receipt_file_id}: {outcome}")
+                        continue
+                    counts['rendered' if outcome else 'cached'] += 1
+                    if not content_hash:
+                        seen.add((new_hash, page))
+                        ReceiptFile.objects.filter(id=receipt_file_id).update(content_hash=new_hash)
+
+                done = sum(counts.values())
+                self.stdout.write(f"{done} thumbnails checked ({counts['rendered']} rendered), {done / (time.monotonic() - started):.1f}/s.")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rendered {counts['rendered']} thumbnails; {counts['cached']} were already cached, {counts['failed']} failed."
+        ))
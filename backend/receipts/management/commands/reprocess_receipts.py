@@ -0,0 +1,173 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, transaction
+from django.db.models import Max
+from django.utils.dateparse import parse_date
+from receipts.cache import get_cache_version
+from receipts.client import ProviderUnavailable
+from receipts.models import Receipt, ReceiptFile
+from receipts.pipeline import extract_receipts, save_extractions, ExtractionFailed, EmptyExtraction
+
+SELECTIONS = ('failed', 'unprocessed', 'outdated', 'version', 'all')
+
+
+def extract_in_worker(receipt_file):
+    """Pool task: runs the extractor for one file. Saving happens in the main thread, per batch."""
+    close_old_connections()
+    try:
+        return 'extracted', extract_receipts(receipt_file)
+    except ProviderUnavailable as e:
+        return 'unavailable', str(e)
+    except Exception as e:
+        return 'error', f"{type(e).__name__}: {e}"
+    finally:
+        close_old_connections()
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-runs extraction on the ReceiptFiles picked by a filter, e.g. after a prompt or model change "
+        "or a provider outage. Files are extracted concurrently and results saved in one transaction per batch. "
+        "Progress is checkpointed after every batch, so running the same command again resumes a killed run."
+    )
+
+    def add_arguments(self, parser):
+        selection = parser.add_mutually_exclusive_group(required=True)
+        selection.add_argument('--failed', action='store_true', help='Valid files whose extraction failed')
+        selection.add_argument('--unprocessed', action='store_true', help='Valid files without a receipt (includes failed ones)')
+        selection.add_argument('--outdated', action='store_true', help='Receipts extracted with another extractor/model/prompt version than the current one')
+        selection.add_argument('--extraction-version', metavar='VERSION', help='Receipts extracted with this extraction_version')
+        selection.add_argument('--all', action='store_true', help='Every valid file')
+        parser.add_argument('--uploaded-after', help='Only files uploaded on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--uploaded-before', help='Only files uploaded on or before this date (YYYY-MM-DD)')
+        parser.add_argument('--workers', type=int, default=settings.RECEIPT_WORKER_POOL_SIZE, help='Concurrent extractions')
+        parser.add_argument('--batch-size', type=int, default=50, help='Files per batch; results are saved and checkpointed per batch')
+        parser.add_argument('--checkpoint', default=os.path.join(settings.BASE_DIR, 'reprocess_receipts.checkpoint.json'))
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint and start over')
+
+    def get_selection(self, options):
+        """The filter as plain data, stored in the checkpoint so a resume uses the same one."""
+        kind = next(name for name in SELECTIONS if options['extraction_version' if name == 'version' else name])
+        selection = {'kind': kind, 'uploaded_after': options['uploaded_after'], 'uploaded_before': options['uploaded_before']}
+        if kind == 'version':
+            selection['version'] = options['extraction_version']
+        elif kind == 'outdated':
+            selection['version'] = get_cache_version() # Fixed for the whole run, even if the settings change
+        return selection
+
+    def get_queryset(self, selection):
+        files = ReceiptFile.objects.filter(is_valid=True)
+        kind = selection['kind']
+        if kind == 'failed':
+            files = files.filter(is_processed=False, invalid_reason__isnull=False)
+        elif kind == 'unprocessed':
+            files = files.filter(is_processed=False)
+        elif kind == 'outdated':
+            # Any receipt of the file (a split PDF has several) on another version, or on none
+            outdated = Receipt.objects.exclude(extraction_version=selection['version']).values('receipt_file_id')
+            files = files.filter(is_processed=True, id__in=outdated)
+        elif kind == 'version':
+            files = files.filter(id__in=Receipt.objects.filter(extraction_version=selection['version']).values('receipt_file_id'))
+
+        for option, lookup in (('uploaded_after', 'created_at__date__gte'), ('uploaded_before', 'created_at__date__lte')):
+            if selection[option]:
+                day = parse_date(selection[option])
+                if day is None:
+                    raise CommandError(f"--{option.replace('_', '-')} must be a date (YYYY-MM-DD).")
+                files = files.filter(**{lookup: day})
+        return files.order_by('id')
+
+    def load_checkpoint(self, path, selection, restart):
+        if restart or not os.path.exists(path):
+            return None
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint['selection'] != selection:
+            raise CommandError(
+                f"{path} belongs to a run with a different selection ({checkpoint['selection']}). "
+                "Pass --restart to discard it, or --checkpoint to use another file."
+            )
+        return checkpoint
+
+    def save_checkpoint(self, path, checkpoint):
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(temporary_path, path) # A run killed mid-write keeps the previous checkpoint
+
+    def save_batch(self, results, counts):
+        """Writes a batch of extractor results in one transaction."""
+        with transaction.atomic():
+            for receipt_file, (outcome, value) in results:
+                if outcome != 'extracted':
+                    counts[outcome] += 1
+                    self.stderr.write(f"ReceiptFile {receipt_file.id}: {value}")
+                    continue
+                try:
+                    save_extractions(receipt_file, value)
+                    counts['succeeded'] += 1
+                except (ExtractionFailed, EmptyExtraction): # The reason is recorded on the ReceiptFile
+                    counts['failed'] += 1
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['batch_size'] < 1:
+            raise CommandError("--workers and --batch-size must be at least 1.")
+        selection = self.get_selection(options)
+        files = self.get_queryset(selection)
+        path = options['checkpoint']
+
+        checkpoint = self.load_checkpoint(path, selection, options['restart'])
+        if checkpoint is None:
+            # Files uploaded after the run starts are left to the normal upload path
+            checkpoint = {
+                'selection': selection,
+                'max_id': ReceiptFile.objects.aggregate(max_id=Max('id'))['max_id'] or 0,
+                'last_id': 0,
+                'counts': {'succeeded': 0, 'failed': 0, 'unavailable': 0, 'error': 0},
+            }
+        else:
+            self.stdout.write(f"Resuming after ReceiptFile {checkpoint['last_id']} ({sum(checkpoint['counts'].values())} files done before).")
+        counts = checkpoint['counts']
+
+        pending = files.filter(id__lte=checkpoint['max_id'])
+        total = pending.filter(id__gt=checkpoint['last_id']).count()
+        self.stdout.write(f"{total} files to reprocess with {options['workers']} workers.")
+
+        done, started = 0, time.monotonic()
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='reprocess') as executor:
+            while True:
+                batch = list(pending.filter(id__gt=checkpoint['last_id'])[:options['batch_size']])
+                if not batch:
+                    break
+                results = zip(batch, executor.map(extract_in_worker, batch))
+                self.save_batch(results, counts)
+
+                checkpoint['last_id'] = batch[-1].id
+                self.save_checkpoint(path, checkpoint)
+
+                done += len(batch)
+                elapsed = time.monotonic() - started
+                rate = done / elapsed if elapsed else 0
+                eta = format_duration((total - done) / rate) if rate and total > done else '0:00'
+                self.stdout.write(
+                    f"{done}/{total} files ({counts['succeeded']} succeeded, {counts['failed']} failed, "
+                    f"{counts['unavailable'] + counts['error']} skipped), {rate:.1f} files/s, ETA {eta}"
+                )
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.stdout.write(self.style.SUCCESS(
+            f"Reprocessed {sum(counts.values())} files: {counts['succeeded']} succeeded, {counts['failed']} failed, "
+            f"{counts['unavailable']} provider unavailable, {counts['error']} errors."
+        ))
+        if counts['unavailable'] or counts['error']:
+            self.stdout.write("Skipped files were left unchanged; run the command again with the same filter to retry them.")
@@ -0,0 +1,230 @@
+"""
+Per-stage timing for the upload and process endpoints, exported as a Server-Timing
+header and in Prometheus text format at /metrics.
+
+Code on the hot path wraps each stage in `with stage('extraction'):`. Inside a view
+decorated with @instrumented(...) the duration is added to that request's timer
+(and so to its Server-Timing header); everywhere else, e.g. queued jobs, it is
+recorded under view="background". Metrics are kept per process, like the other
+stats endpoints; scrape every worker, or run one.
+"""
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from .profiling import profile_request
+
+# Seconds; extraction by a remote model sits in the upper buckets, local stages in the lower ones
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Failure reasons by status code, for responses where the view didn't name one
+STATUS_REASONS = {400: 'bad_request', 404: 'not_found', 413: 'too_large', 500: 'server_error', 503: 'provider_unavailable'}
+
+_current_timer = ContextVar('receipt_request_timer', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {} # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1 # Stored per bucket; made cumulative when rendered
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            return series[-1] if series else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, observed in zip(self.buckets, series):
+                    cumulative += observed
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, [("le", "+Inf")])} {series[-1]}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-2]:.6f}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {series[-1]}')
+        return lines
+
+
+stage_duration = Histogram(
+    'receipt_stage_duration_seconds',
+    'Time spent in each processing stage (disk_write, validate, extraction, parse, db).',
+    ['view', 'stage'],
+)
+request_duration = Histogram('receipt_request_duration_seconds', 'Time to handle an instrumented request.', ['view'])
+requests_total = Counter('receipt_requests_total', 'Instrumented requests by outcome (success or failure).', ['view', 'outcome'])
+failures_total = Counter('receipt_failures_total', 'Failed instrumented requests by reason.', ['view', 'reason'])
+
+REGISTRY = [stage_duration, request_duration, requests_total, failures_total]
+
+
+class RequestTimer:
+    """Stage durations for one request, in the order they first ran."""
+
+    def __init__(self, view):
+        self.view = view
+        self.stages = {}
+        self.failure_reason = None
+
+    def record(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def server_timing(self, total=None):
+        entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items()]
+        if total is not None:
+            entries.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(entries)
+
+
+@contextmanager
+def stage(name):
+    """Times a block as one stage of the current request (or of background work)."""
+    timer = _current_timer.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_duration.observe(elapsed, timer.view if timer else 'background', name)
+        if timer is not None:
+            timer.record(name, elapsed)
+
+def fail(reason):
+    """Names the failure reason of the current instrumented request, e.g. 'invalid_pdf'."""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.failure_reason = reason
+
+def instrumented(view):
+    """
+    Decorator for APIView handler methods: times the request and its stages, counts
+    the outcome, adds a Server-Timing header, and hands requests slower than
+    RECEIPT_SLOW_REQUEST_SECONDS to the sampling profiler when it is enabled.
+    """
+    def decorator(method):
+        if inspect.iscoroutinefunction(method):
+            return _instrumented_async(view, method)
+
+        @functools.wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            timer = RequestTimer(view)
+            token = _current_timer.set(timer)
+            started = time.perf_counter()
+            try:
+                with profile_request(view):
+                    response = method(self, request, *args, **kwargs)
+            except Exception:
+                _record_outcome(view, time.perf_counter() - started, 'exception')
+                raise
+            finally:
+                _current_timer.reset(token)
+
+            return _finish(timer, response, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+def _instrumented_async(view, method):
+    """instrumented() for async handlers. The sampling profiler is thread-based, so it is not used here."""
+    @functools.wraps(method)
+    async def wrapper(self, request, *args, **kwargs):
+        timer = RequestTimer(view)
+        token = _current_timer.set(timer) # Copied into sync_to_async threads along with the rest of the context
+        started = time.perf_counter()
+        try:
+            response = await method(self, request, *args, **kwargs)
+        except Exception:
+            _record_outcome(view, time.perf_counter() - started, 'exception')
+            raise
+        finally:
+            _current_timer.reset(token)
+        return _finish(timer, response, time.perf_counter() - started)
+    return wrapper
+
+def _finish(timer, response, elapsed):
+    failed = response.status_code >= 400
+    reason = (timer.failure_reason or STATUS_REASONS.get(response.status_code, str(response.status_code))) if failed else None
+    _record_outcome(timer.view, elapsed, reason)
+    if settings.RECEIPT_SERVER_TIMING:
+        response['Server-Timing'] = timer.server_timing(total=elapsed)
+    return response
+
+def _record_outcome(view, elapsed, failure_reason):
+    request_duration.observe(elapsed, view)
+    requests_total.inc(view, 'failure' if failure_reason else 'success')
+    if failure_reason:
+        failures_total.inc(view, failure_reason)
+
+def render_metrics():
+    """Every metric in the Prometheus text exposition format, plus the existing per-process stats."""
+    from .cache import get_cache_stats
+    from .local_extraction import get_path_stats
+    from .preprocess import get_preprocess_stats
+
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+
+    cache_stats, path_stats, preprocess_stats = get_cache_stats(), get_path_stats(), get_preprocess_stats()
+    lines += [
+        '# HELP receipt_extraction_cache_lookups_total Extraction cache lookups by result.',
+        '# TYPE receipt_extraction_cache_lookups_total counter',
+        f'receipt_extraction_cache_lookups_total{{result="hit"}} {cache_stats["hits"]}',
+        f'receipt_extraction_cache_lookups_total{{result="miss"}} {cache_stats["misses"]}',
+        '# HELP receipt_extraction_path_total Receipts answered from the PDF text layer or by the fallback extractor.',
+        '# TYPE receipt_extraction_path_total counter',
+        f'receipt_extraction_path_total{{path="local"}} {path_stats["local"]}',
+        f'receipt_extraction_path_total{{path="fallback"}} {path_stats["fallback"]}',
+        '# HELP receipt_model_payload_bytes_total Bytes of PDFs before and after preprocessing for the model.',
+        '# TYPE receipt_model_payload_bytes_total counter',
+        f'receipt_model_payload_bytes_total{{kind="original"}} {preprocess_stats["original_bytes"]}',
+        f'receipt_model_payload_bytes_total{{kind="sent"}} {preprocess_stats["payload_bytes"]}',
+    ]
+    return '\n'.join(lines) + '\n'
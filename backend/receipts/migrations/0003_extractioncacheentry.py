@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0002_extractionjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtractionCacheEntry',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('version', models.CharField(max_length=64)),
+                ('parsed_data', models.JSONField()),
+                ('raw_response', models.TextField(blank=True, null=True)),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('content_hash', 'version'), name='unique_extraction_cache_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0003_extractioncacheentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='receipt',
+            index=models.Index(fields=['created_at', 'id'], name='receipt_created_at_id_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0004_receipt_list_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='amount_minor',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='currency',
+            field=models.CharField(blank=True, max_length=3, null=True),
+        ),
+        migrations.AlterField(
+            model_name='receipt',
+            name='merchant_name',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='receipt',
+            name='purchased_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,83 @@
+import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+# A frozen copy of receipts.money.parse_amount as of this migration, for the string totals it backfills;
+# importing the live parser would change what this migration does whenever the parser changes.
+CURRENCY_SYMBOLS = {
+    '$': 'USD', 'US$': 'USD', 'C$': 'CAD', 'A$': 'AUD', '€': 'EUR', '£': 'GBP',
+    '¥': 'JPY', '₹': 'INR', 'Rs': 'INR', '₩': 'KRW', 'CHF': 'CHF',
+}
+MINOR_UNIT_EXPONENTS = {'JPY': 0, 'KRW': 0}
+
+_ISO_CODE_RE = re.compile(r'\b([A-Z]{3})\b')
+_NUMBER_RE = re.compile(r'\d[\d,.\s]*')
+
+
+def _to_minor_units(amount, currency):
+    exponent = MINOR_UNIT_EXPONENTS.get(currency, 2)
+    value = Decimal(str(amount)).quantize(Decimal(1).scaleb(-exponent), rounding=ROUND_HALF_UP)
+    return int(value.scaleb(exponent))
+
+def _normalize_number(text):
+    text = text.replace(' ', '')
+    if ',' in text and '.' in text:
+        if text.rfind(',') > text.rfind('.'):
+            text = text.replace('.', '').replace(',', '.')
+        else:
+            text = text.replace(',', '')
+    elif ',' in text:
+        whole, _, fraction = text.rpartition(',')
+        text = f"{whole.replace(',', '')}.{fraction}" if len(fraction) == 2 else text.replace(',', '')
+    return text
+
+def parse_amount(value):
+    text = str(value).strip()
+    currency = None
+    for symbol in sorted(CURRENCY_SYMBOLS, key=len, reverse=True):
+        if symbol in text:
+            currency = CURRENCY_SYMBOLS[symbol]
+            break
+    if currency is None:
+        code_match = _ISO_CODE_RE.search(text)
+        currency = code_match.group(1) if code_match else None
+
+    number_match = _NUMBER_RE.search(text)
+    if not number_match:
+        return None, None
+    negative = text.startswith('-') or (text.startswith('(') and text.endswith(')'))
+    try:
+        amount_minor = _to_minor_units(_normalize_number(number_match.group(0).strip()), currency)
+        return -amount_minor if negative else amount_minor, currency
+    except (InvalidOperation, ValueError):
+        return None, None
+
+
+def backfill_amounts(apps, schema_editor):
+    Receipt = apps.get_model('receipts', 'Receipt')
+    batch = []
+    pending = Receipt.objects.filter(amount_minor__isnull=True, total_amount__isnull=False).only('id', 'total_amount')
+    for receipt in pending.iterator(chunk_size=BATCH_SIZE):
+        receipt.amount_minor, receipt.currency = parse_amount(receipt.total_amount)
+        if receipt.amount_minor is None:
+            continue
+        batch.append(receipt)
+        if len(batch) >= BATCH_SIZE:
+            Receipt.objects.bulk_update(batch, ['amount_minor', 'currency'])
+            batch = []
+    if batch:
+        Receipt.objects.bulk_update(batch, ['amount_minor', 'currency'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0005_receipt_amount_minor_currency'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_amounts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0006_backfill_receipt_amount_minor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receiptfile',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='receiptfile',
+            name='file_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,65 @@
+import json
+import re
+
+from django.db import migrations
+
+# The schema and backfill as of this migration, not imported from receipts.search:
+# later changes to the search table go in migrations of their own.
+CREATE_TABLE_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS receipt_search USING fts5("
+    "merchant_name, items, parsed_text, "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+)
+DROP_TABLE_SQL = "DROP TABLE IF EXISTS receipt_search"
+INSERT_SQL = "INSERT INTO receipt_search (rowid, merchant_name, items, parsed_text) VALUES (%s, %s, %s, %s)"
+OPTIMIZE_SQL = "INSERT INTO receipt_search (receipt_search) VALUES ('optimize')"
+BATCH_SIZE = 2000
+
+_JSON_BLOCK_RE = re.compile(r'```json\n(.*?)\n```', re.DOTALL)
+
+
+def item_descriptions(parsed_text):
+    """The line-item descriptions in a raw extractor response, space-separated."""
+    if not parsed_text:
+        return ''
+    match = _JSON_BLOCK_RE.search(parsed_text)
+    try:
+        data = json.loads(match.group(1) if match else parsed_text)
+    except (ValueError, TypeError):
+        return ''
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return ''
+    return " ".join(str(item.get('description') or '') for item in items if isinstance(item, dict))
+
+def create_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    Receipt = apps.get_model('receipts', 'Receipt')
+    rows = Receipt.objects.using(schema_editor.connection.alias).order_by('id').values_list('id', 'merchant_name', 'parsed_text')
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(CREATE_TABLE_SQL)
+        batch = []
+        for receipt_id, merchant_name, parsed_text in rows.iterator(chunk_size=BATCH_SIZE):
+            batch.append((receipt_id, merchant_name or '', item_descriptions(parsed_text), parsed_text or ''))
+            if len(batch) >= BATCH_SIZE:
+                cursor.executemany(INSERT_SQL, batch)
+                batch = []
+        if batch:
+            cursor.executemany(INSERT_SQL, batch)
+        cursor.execute(OPTIMIZE_SQL)
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(DROP_TABLE_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0007_receiptfile_content_hash_file_size'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0008_receipt_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceiptItem',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('position', models.PositiveIntegerField()),
+                ('description', models.CharField(blank=True, max_length=255, null=True)),
+                ('price', models.CharField(blank=True, max_length=32, null=True)),
+                ('price_minor', models.BigIntegerField(blank=True, db_index=True, null=True)),
+                ('currency', models.CharField(blank=True, max_length=3, null=True)),
+                ('receipt', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='receipts.receipt')),
+            ],
+            options={
+                'ordering': ['position'],
+                'indexes': [models.Index(fields=['description', 'currency'], name='receipt_item_description_idx')],
+                'constraints': [models.UniqueConstraint(fields=('receipt', 'position'), name='receipt_item_position_uniq')],
+            },
+        ),
+    ]
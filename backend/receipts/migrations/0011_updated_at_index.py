@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0010_storedobject'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='receipt',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='receiptfile',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
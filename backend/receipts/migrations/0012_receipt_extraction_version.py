@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0011_updated_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='extraction_version',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
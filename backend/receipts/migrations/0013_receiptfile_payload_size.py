@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0012_receipt_extraction_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receiptfile',
+            name='payload_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
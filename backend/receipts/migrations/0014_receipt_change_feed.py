@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:31
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_change_seq(apps, schema_editor):
+    # Existing receipts enter the feed in id order, so a first sync from the start returns all of them
+    Receipt = apps.get_model('receipts', 'Receipt')
+    Receipt.objects.filter(change_seq__isnull=True).update(change_seq=F('id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0013_receiptfile_payload_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceiptTombstone',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('receipt_id', models.IntegerField()),
+                ('change_seq', models.BigIntegerField(db_index=True)),
+                ('deleted_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='change_seq',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(backfill_change_seq, migrations.RunPython.noop),
+    ]
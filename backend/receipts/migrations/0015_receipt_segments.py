@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0014_receipt_change_feed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='first_page',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='last_page',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='receiptfile',
+            name='split_mode',
+            field=models.CharField(blank=True, max_length=8, null=True),
+        ),
+        migrations.AlterField(
+            model_name='receipt',
+            name='receipt_file',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='extracted_receipts', to='receipts.receiptfile'),
+        ),
+        migrations.AddConstraint(
+            model_name='receipt',
+            constraint=models.UniqueConstraint(fields=('receipt_file', 'first_page'), name='receipt_file_segment_uniq'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0015_receipt_segments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receiptfile',
+            name='duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='near_duplicates', to='receipts.receiptfile'),
+        ),
+        migrations.AddField(
+            model_name='receiptfile',
+            name='perceptual_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
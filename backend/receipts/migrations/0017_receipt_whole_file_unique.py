@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:14
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def drop_extra_whole_file_receipts(apps, schema_editor):
+    # Keep the newest whole-file receipt of any file that got two before the constraint existed.
+    # Historical models fire no signals, so the search row and the tombstone are written here.
+    Receipt = apps.get_model('receipts', 'Receipt')
+    ReceiptTombstone = apps.get_model('receipts', 'ReceiptTombstone')
+    connection = schema_editor.connection
+    whole = Receipt.objects.using(connection.alias).filter(first_page__isnull=True)
+    newest = whole.values('receipt_file').annotate(newest=Max('id')).values('newest')
+    extra_ids = list(whole.exclude(id__in=newest).values_list('id', flat=True))
+    if not extra_ids:
+        return
+
+    seq = max(
+        Receipt.objects.using(connection.alias).aggregate(seq=Max('change_seq'))['seq'] or 0,
+        ReceiptTombstone.objects.using(connection.alias).aggregate(seq=Max('change_seq'))['seq'] or 0,
+    )
+    ReceiptTombstone.objects.using(connection.alias).bulk_create([
+        ReceiptTombstone(receipt_id=receipt_id, change_seq=seq + offset) for offset, receipt_id in enumerate(extra_ids, 1)
+    ])
+    if connection.vendor == 'sqlite': # The search table only exists there (see 0008)
+        with connection.cursor() as cursor:
+            cursor.executemany("DELETE FROM receipt_search WHERE rowid = %s", [(receipt_id,) for receipt_id in extra_ids])
+    Receipt.objects.using(connection.alias).filter(id__in=extra_ids).delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('receipts', '0016_receiptfile_near_duplicates'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_extra_whole_file_receipts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='receipt',
+            constraint=models.UniqueConstraint(condition=models.Q(('first_page__isnull', True)), fields=('receipt_file',), name='receipt_file_whole_uniq'),
+        ),
+    ]
@@ -5,33 +5,132 @@ class ReceiptFile(models.Model):
     id = models.AutoField(primary_key=True)
     file_name = models.CharField(max_length=255)
     file_path = models.CharField(max_length=500) # Full path to the stored PDF
+    content_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True) # SHA-256 computed while streaming the upload
+    file_size = models.BigIntegerField(blank=True, null=True) # Bytes
+    payload_size = models.BigIntegerField(blank=True, null=True) # Bytes sent to the extraction model after preprocessing; null if it wasn't called
     is_valid = models.BooleanField(default=False)
     invalid_reason = models.TextField(blank=True, null=True)
     is_processed = models.BooleanField(default=False)
+    perceptual_hash = models.CharField(max_length=64, blank=True, null=True) # 256-bit dHash of the first page, hex (see receipts.near_duplicates)
+    duplicate_of = models.ForeignKey('self', on_delete=models.SET_NULL, blank=True, null=True, related_name='near_duplicates') # Earlier upload of the same paper receipt whose extraction was reused
+    split_mode = models.CharField(max_length=8, blank=True, null=True) # 'off', 'pages' or 'auto' (see receipts.segments); null uses RECEIPT_SPLIT_MODE
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True) # max(updated_at) validates cached reads
 
     def __str__(self):
         return self.file_name
 
-    def save(self, *args, **kwargs):
-        # Update updated_at on every save
-        self.updated_at = timezone.now()
-        super().save(*args, **kwargs)
-
 class Receipt(models.Model):
     id = models.AutoField(primary_key=True)
-    receipt_file = models.OneToOneField(ReceiptFile, on_delete=models.CASCADE, related_name='extracted_receipt')
-    purchased_at = models.DateTimeField(null=True, blank=True)
-    merchant_name = models.CharField(max_length=255, blank=True, null=True)
-    total_amount = models.CharField(max_length=10, null=True, blank=True)
+    receipt_file = models.ForeignKey(ReceiptFile, on_delete=models.CASCADE, related_name='extracted_receipts') # Several when the PDF was split
+    first_page = models.PositiveIntegerField(null=True, blank=True) # 1-based pages of a split PDF this receipt came from; null for the whole file
+    last_page = models.PositiveIntegerField(null=True, blank=True)
+    purchased_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    merchant_name = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    total_amount = models.CharField(max_length=10, null=True, blank=True) # Display string, e.g. "$123.45"
+    amount_minor = models.BigIntegerField(null=True, blank=True, db_index=True) # Total in minor units, e.g. 12345
+    currency = models.CharField(max_length=3, null=True, blank=True) # ISO 4217 code, e.g. "USD"
     parsed_text = models.TextField(blank=True, null=True)
+    extraction_version = models.CharField(max_length=64, blank=True, null=True, db_index=True) # Extractor/model/prompt fingerprint, see cache.get_cache_version
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True) # max(updated_at) validates cached reads
+    change_seq = models.BigIntegerField(null=True, blank=True, db_index=True) # Position in the change feed, bumped on every save (see receipts.changes)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['receipt_file', 'first_page'], name='receipt_file_segment_uniq'),
+            # NULLs are distinct in the constraint above, so one whole-file receipt per file needs its own
+            models.UniqueConstraint(fields=['receipt_file'], condition=models.Q(first_page__isnull=True), name='receipt_file_whole_uniq'),
+        ]
+        indexes = [
+            # Keyset pagination order for the receipt list
+            models.Index(fields=['created_at', 'id'], name='receipt_created_at_id_idx'),
+        ]
 
     def __str__(self):
         return f"Receipt from {self.merchant_name} on {self.purchased_at}"
 
-    def save(self, *args, **kwargs):
-        self.updated_at = timezone.now()
-        super().save(*args, **kwargs)
\ No newline at end of file
+class ReceiptItem(models.Model):
+    id = models.AutoField(primary_key=True)
+    receipt = models.ForeignKey(Receipt, on_delete=models.CASCADE, related_name='items')
+    position = models.PositiveIntegerField() # Order on the receipt, from 0
+    description = models.CharField(max_length=255, blank=True, null=True)
+    price = models.CharField(max_length=32, blank=True, null=True) # Display string, e.g. "$10.00"
+    price_minor = models.BigIntegerField(null=True, blank=True, db_index=True) # Price in minor units, e.g. 1000
+    currency = models.CharField(max_length=3, null=True, blank=True) # ISO 4217 code, e.g. "USD"
+
+    class Meta:
+        ordering = ['position']
+        constraints = [
+            models.UniqueConstraint(fields=['receipt', 'position'], name='receipt_item_position_uniq'),
+        ]
+        indexes = [
+            # Per-item spend queries, e.g. grouping or filtering by description
+            models.Index(fields=['description', 'currency'], name='receipt_item_description_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.description} ({self.price})"
+
+class ExtractionJob(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.AutoField(primary_key=True)
+    receipt_file = models.ForeignKey(ReceiptFile, on_delete=models.CASCADE, related_name='extraction_jobs')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Job {self.id} ({self.status}) for {self.receipt_file}"
+
+
+class ExtractionCacheEntry(models.Model):
+    id = models.AutoField(primary_key=True)
+    content_hash = models.CharField(max_length=64) # SHA-256 of the PDF bytes
+    version = models.CharField(max_length=64) # Extractor/model/prompt fingerprint
+    parsed_data = models.JSONField()
+    raw_response = models.TextField(blank=True, null=True)
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_hash', 'version'], name='unique_extraction_cache_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.content_hash[:12]} ({self.version})"
+
+
+class StoredObject(models.Model):
+    id = models.AutoField(primary_key=True)
+    key = models.CharField(max_length=500, unique=True) # Content-addressed storage key, see receipts.storage
+    size = models.BigIntegerField() # Bytes
+    ref_count = models.PositiveIntegerField(default=0) # ReceiptFiles stored under this key
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.key} ({self.ref_count} refs)"
+
+
+class ReceiptTombstone(models.Model):
+    id = models.AutoField(primary_key=True)
+    receipt_id = models.IntegerField() # The deleted Receipt's id
+    change_seq = models.BigIntegerField(db_index=True) # Same sequence as Receipt.change_seq
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True) # Pruned after RECEIPT_TOMBSTONE_RETENTION_DAYS
+
+    def __str__(self):
+        return f"Receipt {self.receipt_id} deleted at change {self.change_seq}"
@@ -0,0 +1,90 @@
+"""
+Helpers for turning display amounts such as "$123.45" into integer minor units.
+Kept free of Django/model imports.
+"""
+import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+CURRENCY_SYMBOLS = {
+    '$': 'USD',
+    'US$': 'USD',
+    'C$': 'CAD',
+    'A$': 'AUD',
+    '€': 'EUR',
+    '£': 'GBP',
+    '¥': 'JPY',
+    '₹': 'INR',
+    'Rs': 'INR',
+    '₩': 'KRW',
+    'CHF': 'CHF',
+}
+
+# Currencies whose minor unit is not 1/100
+MINOR_UNIT_EXPONENTS = {
+    'JPY': 0,
+    'KRW': 0,
+}
+
+_ISO_CODE_RE = re.compile(r'\b([A-Z]{3})\b')
+_NUMBER_RE = re.compile(r'\d[\d,.\s]*')
+
+
+def minor_unit_exponent(currency):
+    return MINOR_UNIT_EXPONENTS.get(currency, 2)
+
+def to_minor_units(amount, currency=None):
+    """Converts a Decimal/str/number in major units to an integer count of minor units."""
+    exponent = minor_unit_exponent(currency)
+    quantum = Decimal(1).scaleb(-exponent)
+    value = Decimal(str(amount)).quantize(quantum, rounding=ROUND_HALF_UP)
+    return int(value.scaleb(exponent))
+
+def _normalize_number(text):
+    text = text.replace(' ', '')
+    if ',' in text and '.' in text:
+        # Whichever separator comes last is the decimal point
+        if text.rfind(',') > text.rfind('.'):
+            text = text.replace('.', '').replace(',', '.')
+        else:
+            text = text.replace(',', '')
+    elif ',' in text:
+        # "12,50" is a decimal comma, "1,250" a thousands separator
+        whole, _, fraction = text.rpartition(',')
+        text = f"{whole.replace(',', '')}.{fraction}" if len(fraction) == 2 else text.replace(',', '')
+    return text
+
+def parse_amount(value, default_currency=None):
+    """
+    Parses an extracted total into (amount_minor, currency).
+    Accepts strings like "$123.45", "EUR 1.234,56", "¥1200" or plain numbers.
+    Returns (None, None) when no amount can be read.
+    """
+    if value is None or isinstance(value, bool):
+        return None, None
+    if isinstance(value, (int, float, Decimal)):
+        currency = default_currency
+        try:
+            return to_minor_units(value, currency), currency
+        except (InvalidOperation, ValueError):
+            return None, None
+
+    text = str(value).strip()
+    currency = None
+    for symbol in sorted(CURRENCY_SYMBOLS, key=len, reverse=True):
+        if symbol in text:
+            currency = CURRENCY_SYMBOLS[symbol]
+            break
+    if currency is None:
+        code_match = _ISO_CODE_RE.search(text)
+        currency = code_match.group(1) if code_match else default_currency
+
+    number_match = _NUMBER_RE.search(text)
+    if not number_match:
+        return None, None
+    # "-$5.00" and "($5.00)" are refunds
+    negative = text.startswith('-') or (text.startswith('(') and text.endswith(')'))
+    try:
+        amount_minor = to_minor_units(_normalize_number(number_match.group(0).strip()), currency)
+        return -amount_minor if negative else amount_minor, currency
+    except (InvalidOperation, ValueError):
+        return None, None
@@ -0,0 +1,342 @@
+"""
+Near-duplicate detection for rescanned receipts.
+
+Storage and the extraction cache only catch byte-identical uploads. The same
+paper receipt scanned twice, or photographed again, has different bytes but looks
+the same. Each upload gets a 256-bit perceptual hash of its first page (a dHash of
+PyMuPDF's greyscale rendering, cropped to the inked area so margins and scan
+resolution don't matter), stored on ReceiptFile.perceptual_hash.
+
+Hashes of processed files are kept in an in-memory multi-index hash table per
+process. It is built from the database on first use and then topped up from rows
+updated since the last lookup, so files processed by other workers are found too.
+A lookup for hashes within RECEIPT_NEAR_DUPLICATE_MAX_DISTANCE bits probes 16
+table slots and takes well under a millisecond at 100k files with varied layouts;
+when most files share one template it degrades to checking every hash (about 9 ms
+at 100k). A BK-tree was tried first: at this radius it visits most of its nodes
+and was slower than the scan in both cases.
+
+When a near match is found with the same number of pages (and, if both PDFs have
+a text layer, the same first-page text), extract_and_save copies the earlier file's receipts instead of calling
+the model, and the new file is flagged with duplicate_of. Receipts of the same
+template with different amounts look alike at this resolution, which is why the
+text check exists and why detection is off unless RECEIPT_NEAR_DUPLICATE_DETECTION is set.
+"""
+import threading
+from itertools import combinations
+from django.conf import settings
+from .changes import current_change_seq
+from .backends import get_fitz
+from .models import ReceiptFile
+
+HASH_WIDTH = 17 # dHash grid: 17x16 cells give 16x16 left/right comparisons
+HASH_HEIGHT = 16
+HASH_BITS = (HASH_WIDTH - 1) * HASH_HEIGHT
+INDEX_CHUNKS = 16 # Substrings of HASH_BITS / 16 bits in the multi-index
+RENDER_WIDTH = 256 # Pixels across the page in the rendering that finds the inked area
+DETAIL_SIZE = 512 # Pixels along the longer side of the inked area in the rendering that is hashed
+INK_TRIM = 0.02 # Share of the page's ink cut off at each edge when cropping to the inked area
+PAPER_TOLERANCE = 48 # Grey levels below the paper colour that still count as paper (scanner noise, shading)
+CELL_RATIO = 1.3 # A cell must have 30% more ink than its right neighbour to set a bit,
+CELL_TOLERANCE = 3 # plus this many grey levels, so blur and JPEG noise in lines of text don't flip bits
+
+_stats_lock = threading.Lock()
+_stats = {'lookups': 0, 'matches': 0, 'rejected': 0}
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+def get_near_duplicate_stats():
+    """Lookups and matches in this process, plus the size of its index."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['enabled'] = settings.RECEIPT_NEAR_DUPLICATE_DETECTION
+    stats['indexed'] = len(_index.table) if _index.table is not None else None
+    return stats
+
+def reset_near_duplicate_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing over fixed-width integer hashes under Hamming distance.
+    The bits are cut into `chunks` substrings, each with a table from substring
+    to ids. Two hashes at most max_distance bits apart differ in at most
+    max_distance // chunks bits of at least one substring, so a search only
+    probes each table at the query's substring and its near neighbours, then
+    checks the ids it finds against the full hash.
+
+    Receipts of one template often share substrings (a blank line is all zeros),
+    which makes some slots hold a large share of the ids. When the probed slots
+    hold more ids than the table, every hash is checked instead.
+    """
+
+    def __init__(self, bits, chunks):
+        self.chunks = chunks
+        self.chunk_bits = bits // chunks
+        self._tables = [{} for _ in range(chunks)]
+        self._values = {} # id -> hash
+        self._flips = {} # radius -> every chunk_bits-wide mask with at most that many bits set
+
+    def __len__(self):
+        return len(self._values)
+
+    def _substrings(self, value):
+        mask = (1 << self.chunk_bits) - 1
+        return [(value >> (index * self.chunk_bits)) & mask for index in range(self.chunks)]
+
+    def _masks(self, radius):
+        if radius not in self._flips:
+            masks = [0]
+            for bit_count in range(1, radius + 1):
+                masks.extend(sum(1 << bit for bit in bits) for bits in combinations(range(self.chunk_bits), bit_count))
+            self._flips[radius] = masks
+        return self._flips[radius]
+
+    def add(self, value, item):
+        """Indexes item under value, replacing the hash it had before."""
+        previous = self._values.get(item)
+        if previous == value:
+            return
+        if previous is not None:
+            self.remove(item)
+        self._values[item] = value
+        for table, substring in zip(self._tables, self._substrings(value)):
+            table.setdefault(substring, []).append(item)
+
+    def remove(self, item):
+        value = self._values.pop(item)
+        for table, substring in zip(self._tables, self._substrings(value)):
+            slot = table[substring]
+            slot.remove(item)
+            if not slot:
+                del table[substring]
+
+    def search(self, value, max_distance):
+        """[(distance, item)] for every item within max_distance of value, nearest first."""
+        masks = self._masks(max_distance // self.chunks)
+        slots = []
+        for table, substring in zip(self._tables, self._substrings(value)):
+            for mask in masks:
+                slot = table.get(substring ^ mask)
+                if slot:
+                    slots.append(slot)
+        if sum(map(len, slots)) > len(self._values):
+            candidates = self._values.items()
+        else:
+            candidates = ((item, self._values[item]) for item in set().union(*slots))
+        # hamming_distance inlined; this loop is the whole cost of a scan
+        found = [(distance, item) for item, other in candidates if (distance := (value ^ other).bit_count()) <= max_distance]
+        found.sort(key=lambda match: match[0])
+        return found
+
+
+class _Index:
+    """The process-wide multi-index of processed, non-duplicate files, and how far it is up to date."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.table = None
+        self.watermark = None # Change feed position (receipts.changes) the index is up to date with
+
+    def reset(self):
+        with self.lock:
+            self.table, self.watermark = None, None
+
+    def refresh(self):
+        """
+        Loads the files whose receipts changed since the last call (all of them the
+        first time). Processing a file numbers its receipts in the change feed in
+        the same transaction, and numbers are handed out in commit order, unlike
+        updated_at, which is taken when a write starts.
+        """
+        head = current_change_seq()
+        files = ReceiptFile.objects.filter(perceptual_hash__isnull=False, is_processed=True, duplicate_of__isnull=True)
+        if self.table is None:
+            self.table = MultiIndexHash(HASH_BITS, INDEX_CHUNKS)
+        else:
+            files = files.filter(extracted_receipts__change_seq__gt=self.watermark, extracted_receipts__change_seq__lte=head).distinct()
+        for receipt_file_id, perceptual_hash in files.values_list('id', 'perceptual_hash'):
+            self.table.add(int(perceptual_hash, 16), receipt_file_id)
+        self.watermark = head
+
+    def search(self, value, max_distance):
+        with self.lock:
+            self.refresh()
+            return self.table.search(value, max_distance)
+
+    def add(self, receipt_file_id, perceptual_hash):
+        with self.lock:
+            if self.table is not None:
+                self.table.add(int(perceptual_hash, 16), receipt_file_id)
+
+_index = _Index()
+
+
+def reset_index():
+    """Drops this process's index; it is rebuilt from the database on the next lookup."""
+    _index.reset()
+
+def _mass_bounds(masses, trim):
+    """First and last index inside the central part of a profile, without `trim` of its mass at either end."""
+    total = sum(masses)
+    if not total:
+        return 0, len(masses)
+    low, running = None, 0
+    for index, mass in enumerate(masses):
+        running += mass
+        if low is None and running > total * trim:
+            low = index
+        if running >= total * (1 - trim):
+            return low, index + 1
+
+def _ink(samples):
+    """A greyscale rendering as how much darker than paper each pixel is; paper texture and noise are 0."""
+    paper = max(samples) - PAPER_TOLERANCE
+    return samples.translate(bytes(max(0, paper - value) for value in range(256)))
+
+def _ink_bounds(ink, width, height, stride, trim=INK_TRIM):
+    """
+    (left, top, right, bottom) of the inked area in pixels. Cut where the ink
+    profile of the rows and columns reaches `trim` from either end, so faint edges,
+    specks of scanner noise and different margins all give about the same crop.
+    """
+    rows = [sum(ink[y * stride:y * stride + width]) for y in range(height)]
+    columns = [sum(ink[x:height * stride:stride]) for x in range(width)]
+    top, bottom = _mass_bounds(rows, trim)
+    left, right = _mass_bounds(columns, trim)
+    return left, top, right, bottom
+
+def perceptual_hash(pdf_data):
+    """
+    256-bit dHash of the first page of a PDF (bytes or a mapping), as 64 hex digits.
+    The ink of every cell of a 17x16 grid over the inked area is averaged, and
+    each bit says whether a cell is clearly darker than its right neighbour.
+    Blank cells have no ink whatever the paper looks like, so they never set a bit.
+    """
+    fitz = get_fitz()
+    view = memoryview(pdf_data)
+    try:
+        with fitz.open(stream=view, filetype='pdf') as doc:
+            page = doc[0]
+            # A coarse look at the whole page finds roughly where the ink is...
+            zoom = RENDER_WIDTH / page.rect.width
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+            left, top, right, bottom = _ink_bounds(_ink(pixmap.samples), pixmap.width, pixmap.height, pixmap.stride, trim=0)
+            margin = 2 # Coarse pixels, for ink cut off by rounding
+            clip = fitz.Rect(left - margin, top - margin, right + margin, bottom + margin) / zoom & page.rect
+            # ...which is then rendered at the same size whatever the scale of the scan
+            zoom = DETAIL_SIZE / max(clip.width, clip.height, 1)
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, colorspace=fitz.csGRAY, alpha=False)
+    finally:
+        view.release()
+
+    ink, stride = _ink(pixmap.samples), pixmap.stride
+    left, top, right, bottom = _ink_bounds(ink, pixmap.width, pixmap.height, stride)
+    cells = []
+    for row in range(HASH_HEIGHT):
+        y0 = top + (bottom - top) * row // HASH_HEIGHT
+        y1 = max(y0 + 1, top + (bottom - top) * (row + 1) // HASH_HEIGHT)
+        for column in range(HASH_WIDTH):
+            x0 = left + (right - left) * column // HASH_WIDTH
+            x1 = max(x0 + 1, left + (right - left) * (column + 1) // HASH_WIDTH)
+            total = sum(sum(ink[y * stride + x0:y * stride + x1]) for y in range(y0, y1))
+            cells.append(total / ((y1 - y0) * (x1 - x0)))
+
+    value = 0
+    for row in range(HASH_HEIGHT):
+        for column in range(HASH_WIDTH - 1):
+            index = row * HASH_WIDTH + column
+            value = (value << 1) | (cells[index] > cells[index + 1] * CELL_RATIO + CELL_TOLERANCE)
+    return f'{value:0{HASH_BITS // 4}x}'
+
+def _describe(pdf_data):
+    """(page count, first page text with whitespace collapsed) of a PDF; the text is empty for scans."""
+    fitz = get_fitz()
+    view = memoryview(pdf_data)
+    try:
+        with fitz.open(stream=view, filetype='pdf') as doc:
+            return doc.page_count, ' '.join(doc[0].get_text('text').split())
+    finally:
+        view.release()
+
+def _same_document(original, pdf_data):
+    """
+    Whether a near match can stand in for this PDF: only the first page is
+    hashed, so the page counts must agree, and if both have a text layer the
+    first page's text must too.
+    """
+    from .local_extraction import MIN_TEXT_LENGTH
+    from .storage import get_receipt_storage
+    page_count, text = _describe(pdf_data)
+    with get_receipt_storage().local_path(original.file_path) as path, open(path, 'rb') as f:
+        original_page_count, original_text = _describe(f.read())
+    if page_count != original_page_count:
+        return False
+    return len(text) < MIN_TEXT_LENGTH or len(original_text) < MIN_TEXT_LENGTH or text == original_text
+
+def find_near_duplicate(receipt_file, pdf_data):
+    """
+    The processed ReceiptFile that receipt_file is a rescan of, or None.
+    Computes and stores receipt_file.perceptual_hash if it isn't set yet.
+    """
+    if not receipt_file.perceptual_hash:
+        receipt_file.perceptual_hash = perceptual_hash(pdf_data)
+        ReceiptFile.objects.filter(pk=receipt_file.pk).update(perceptual_hash=receipt_file.perceptual_hash)
+
+    _count('lookups')
+    matches = _index.search(int(receipt_file.perceptual_hash, 16), settings.RECEIPT_NEAR_DUPLICATE_MAX_DISTANCE)
+    candidate_ids = [receipt_file_id for _, receipt_file_id in matches if receipt_file_id != receipt_file.pk]
+    if not candidate_ids:
+        return None
+    # Entries can be stale (deleted or reprocessed files); the database has the last word
+    candidates = ReceiptFile.objects.filter(
+        id__in=candidate_ids, is_processed=True, duplicate_of__isnull=True, extracted_receipts__isnull=False,
+    ).distinct().in_bulk()
+    for receipt_file_id in candidate_ids:
+        original = candidates.get(receipt_file_id)
+        if original is None:
+            continue
+        if not _same_document(original, pdf_data):
+            _count('rejected')
+            continue
+        _count('matches')
+        return original
+    return None
+
+def add_to_index(receipt_file):
+    """Makes a freshly processed file findable in this process right away."""
+    if receipt_file.perceptual_hash and receipt_file.duplicate_of_id is None:
+        _index.add(receipt_file.pk, receipt_file.perceptual_hash)
+
+def reused_extraction(original):
+    """The extraction of original's receipts, in the form pipeline.save_extractions takes."""
+    results = []
+    for receipt in original.extracted_receipts.order_by('first_page'):
+        pages = (receipt.first_page, receipt.last_page) if receipt.first_page is not None else None
+        parsed_data = {
+            'merchant_name': receipt.merchant_name,
+            'total_amount': receipt.total_amount,
+            'amount_minor': receipt.amount_minor,
+            'currency': receipt.currency,
+            'purchased_at': receipt.purchased_at,
+        }
+        results.append((pages, parsed_data, receipt.parsed_text)) # Line items are parsed again from the raw response
+    return results
+
+def perceptual_hash_worker(file_path):
+    """Process pool task for hash_receipt_files: (perceptual hash, None) or (None, error message)."""
+    from .storage import get_receipt_storage
+    try:
+        with get_receipt_storage().local_path(file_path) as path, open(path, 'rb') as f:
+            return perceptual_hash(f.read()), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
@@ -0,0 +1,73 @@
+import base64
+import json
+from datetime import datetime, timezone as dt_timezone
+from django.db.models import Q
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _encode(values):
+    payload = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+def _decode(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+
+def encode_cursor(created_at, pk):
+    """Opaque cursor pointing just after the row with this (created_at, id)."""
+    return _encode([created_at.isoformat(), pk])
+
+def decode_cursor(cursor):
+    """Returns the (created_at, id) pair stored in a cursor from encode_cursor."""
+    try:
+        created_at, pk = _decode(cursor)
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, TypeError, UnicodeError, json.JSONDecodeError):
+        raise InvalidCursor(cursor)
+
+def encode_search_cursor(score, pk, floor=None):
+    """
+    Opaque cursor pointing just after the search hit with this (score, id).
+    floor pins the ranked window chosen for the first page, so later pages rank the same set.
+    """
+    return _encode([score, pk, floor])
+
+def decode_search_cursor(cursor):
+    """Returns the (score, id, floor) stored in a cursor from encode_search_cursor."""
+    try:
+        score, pk, floor = _decode(cursor)
+        return float(score), int(pk), None if floor is None else int(floor)
+    except (ValueError, TypeError, UnicodeError, json.JSONDecodeError):
+        raise InvalidCursor(cursor)
+
+def paginate_keyset(queryset, cursor=None, limit=50):
+    """
+    Newest-first keyset pagination on (created_at, id).
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    Raises InvalidCursor if the cursor can't be decoded.
+    """
+    queryset = queryset.order_by('-created_at', '-id')
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    rows = list(queryset[:limit + 1]) # One extra row tells us whether another page exists
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].created_at, rows[-1].id)
+
+def encode_change_cursor(seq, issued_at):
+    """Opaque change feed cursor: everything up to change `seq` has been seen, as of issued_at."""
+    return _encode([seq, int(issued_at.timestamp())])
+
+def decode_change_cursor(cursor):
+    """Returns the (seq, issued_at) stored in a cursor from encode_change_cursor."""
+    try:
+        seq, issued_at = _decode(cursor)
+        return int(seq), datetime.fromtimestamp(int(issued_at), tz=dt_timezone.utc)
+    except (ValueError, TypeError, UnicodeError, OverflowError, json.JSONDecodeError):
+        raise InvalidCursor(cursor)
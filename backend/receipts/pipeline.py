@@ -0,0 +1,318 @@
+import asyncio
+import contextvars
+import logging
+import os
+from contextlib import contextmanager
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.utils import timezone
+from .models import ReceiptFile, Receipt, ReceiptItem
+from .utils import validate_pdf
+from .ingest import quick_validate_pdf, open_mapped
+from .cache import cached_extract, cached_extract_many, acached_extract, get_cache_version
+from .money import parse_amount
+from .changes import next_change_seq
+from .items import extract_items, normalize_items
+from .backends import get_backend, get_async_backend
+from .storage import get_receipt_storage
+from .metrics import stage
+from .segments import get_split_mode, split_receipt_pdf
+from .near_duplicates import find_near_duplicate, add_to_index, reused_extraction
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractionFailed(Exception):
+    """The extractor returned no parsed data. The message is the stored invalid_reason."""
+
+
+class EmptyExtraction(Exception):
+    """The extractor answered, but none of the key fields could be read."""
+
+
+def get_extractor():
+    """
+    Returns the extraction backend configured by settings.RECEIPT_EXTRACTOR.
+    The callable takes a PDF path and an optional in-memory/mapped copy of its
+    bytes, and returns (parsed_data, raw_response).
+    """
+    return get_backend(settings.RECEIPT_EXTRACTOR)
+
+@contextmanager
+def open_receipt_file(receipt_file):
+    """Yields (local_path, mapped_bytes) for a ReceiptFile's PDF from the configured storage backend."""
+    with get_receipt_storage().local_path(receipt_file.file_path) as full_file_path, open_mapped(full_file_path) as pdf_data:
+        yield full_file_path, pdf_data
+
+def validate_receipt_file(receipt_file, full_file_path=None, pdf_data=None):
+    """
+    Validates the stored PDF and saves the result on the ReceiptFile.
+    With pdf_data (the mapped file) only a cheap structural check is run.
+    Returns True if the file is a valid PDF.
+    """
+    with stage('validate'):
+        if pdf_data is not None:
+            is_valid, invalid_reason = quick_validate_pdf(pdf_data)
+        elif full_file_path is not None:
+            is_valid, invalid_reason = validate_pdf(full_file_path)
+        else:
+            with get_receipt_storage().local_path(receipt_file.file_path) as full_file_path:
+                is_valid, invalid_reason = validate_pdf(full_file_path)
+    receipt_file.is_valid = is_valid
+    receipt_file.invalid_reason = invalid_reason
+    receipt_file.save(update_fields=['is_valid', 'invalid_reason', 'updated_at'])
+    return is_valid
+
+def create_validated_receipt_file(pdf_data, **fields):
+    """
+    Runs the structural check on the mapped upload and inserts the ReceiptFile
+    with its result, so a new upload costs one INSERT instead of an INSERT plus
+    a validation UPDATE.
+    """
+    with stage('validate'):
+        is_valid, invalid_reason = quick_validate_pdf(pdf_data)
+    with stage('db'):
+        return ReceiptFile.objects.create(is_valid=is_valid, invalid_reason=invalid_reason, is_processed=False, **fields)
+
+def validate_paths_parallel(full_file_paths):
+    """
+    Validates many stored PDFs on the batch validation process pool.
+    Returns a list of (is_valid, reason_if_invalid) in the same order as the paths.
+    """
+    from .jobs import get_validation_executor
+    if not full_file_paths:
+        return []
+    executor = get_validation_executor()
+    workers = settings.BATCH_VALIDATION_WORKERS or os.cpu_count() or 1
+    chunksize = max(1, len(full_file_paths) // (4 * workers))
+    return list(executor.map(validate_pdf, full_file_paths, chunksize=chunksize))
+
+def extract_and_save(receipt_file, full_file_path=None, pdf_data=None):
+    """
+    Runs the configured extractor on a validated ReceiptFile and stores its Receipts:
+    one, or one per receipt found when the file's split mode is on (see receipts.segments).
+    Identical PDFs are served from the extraction cache instead of calling the model again.
+    Line items from the raw response are stored as ReceiptItem rows in the same transaction.
+    With RECEIPT_NEAR_DUPLICATE_DETECTION, a rescan of an earlier upload gets a copy
+    of its receipts and is flagged with duplicate_of (see receipts.near_duplicates).
+    Returns the list of Receipt instances. Raises ExtractionFailed or EmptyExtraction after
+    recording the reason on the ReceiptFile. ProviderUnavailable is passed through
+    without touching the ReceiptFile, so it can be processed again later.
+    """
+    if not settings.RECEIPT_NEAR_DUPLICATE_DETECTION:
+        return save_extractions(receipt_file, extract_receipts(receipt_file, full_file_path, pdf_data))
+    if full_file_path is None:
+        with open_receipt_file(receipt_file) as (full_file_path, pdf_data):
+            return extract_and_save(receipt_file, full_file_path, pdf_data)
+
+    if pdf_data is None:
+        pdf_data = _read_file(full_file_path)
+    receipts = save_near_duplicate(receipt_file, pdf_data)
+    if receipts is None:
+        receipts = save_extractions(receipt_file, extract_receipts(receipt_file, full_file_path, pdf_data))
+        add_to_index(receipt_file)
+    return receipts
+
+def save_near_duplicate(receipt_file, pdf_data):
+    """
+    If the file is a rescan of a processed upload, stores a copy of that upload's
+    Receipts on it, flags it with duplicate_of and returns the copies; otherwise None.
+    """
+    with stage('near_duplicate'):
+        original = find_near_duplicate(receipt_file, pdf_data)
+    if original is None:
+        return None
+    receipts = save_extractions(receipt_file, reused_extraction(original), duplicate_of=original)
+    logger.info("ReceiptFile %s is a rescan of %s; reused its extraction", receipt_file.pk, original.pk)
+    return receipts
+
+def _map_concurrently(function, items):
+    """map() on the segment thread pool; each call keeps the caller's context (the request's stage timer)."""
+    from .jobs import get_segment_executor
+    executor = get_segment_executor()
+    futures = [executor.submit(contextvars.copy_context().run, function, item) for item in items]
+    return [future.result() for future in futures]
+
+def extract_receipts(receipt_file, full_file_path=None, pdf_data=None):
+    """
+    Runs the configured extractor (through the extraction cache) on every receipt
+    in a ReceiptFile, concurrently when the PDF is split, without saving anything.
+    Returns [(pages, parsed_data, raw_response)], where pages is the (first, last)
+    page range of a split receipt or None for the whole file; pass it to save_extractions.
+    """
+    if full_file_path is None:
+        with open_receipt_file(receipt_file) as (full_file_path, pdf_data):
+            return extract_receipts(receipt_file, full_file_path, pdf_data)
+
+    segments = None
+    mode = get_split_mode(receipt_file)
+    if mode != 'off':
+        with stage('split'):
+            if pdf_data is None:
+                with open(full_file_path, 'rb') as f:
+                    pdf_data = f.read()
+            segments = split_receipt_pdf(pdf_data, mode, receipt_file.content_hash)
+    if not segments:
+        return [(None, *extract_receipt_file(receipt_file, full_file_path, pdf_data))]
+
+    with stage('extraction'):
+        results = cached_extract_many(
+            get_extractor(),
+            full_file_path,
+            [(segment.content_hash, segment.data) for segment in segments],
+            map_func=_map_concurrently,
+        )
+    return [((segment.first_page, segment.last_page), *result) for segment, result in zip(segments, results)]
+
+def extract_receipt_file(receipt_file, full_file_path=None, pdf_data=None):
+    """
+    Runs the configured extractor (through the extraction cache) on a whole ReceiptFile
+    without saving anything on it. Returns (parsed_data, raw_response).
+    Opens the file from storage if no path is given.
+    """
+    if full_file_path is None:
+        with open_receipt_file(receipt_file) as (full_file_path, pdf_data):
+            return extract_receipt_file(receipt_file, full_file_path, pdf_data)
+
+    with stage('extraction'):
+        return cached_extract(
+            get_extractor(),
+            full_file_path,
+            content_hash=receipt_file.content_hash,
+            pdf_data=pdf_data,
+        )
+
+async def aextract_and_save(receipt_file, full_file_path, pdf_data=None):
+    """
+    extract_and_save for the async endpoints: awaits the async version of the
+    configured extractor and does the database writes through sync_to_async.
+    The receipts of a split PDF are awaited together, at most RECEIPT_SPLIT_MAX_WORKERS at once.
+    Rescans of earlier uploads are handled as in extract_and_save.
+    full_file_path is the local path from the storage backend (see open_receipt_file).
+    """
+    if settings.RECEIPT_NEAR_DUPLICATE_DETECTION:
+        if pdf_data is None:
+            pdf_data = await asyncio.to_thread(_read_file, full_file_path)
+        receipts = await sync_to_async(save_near_duplicate)(receipt_file, pdf_data)
+        if receipts is not None:
+            return receipts
+
+    extractor = get_async_backend(settings.RECEIPT_EXTRACTOR)
+    mode = get_split_mode(receipt_file)
+    segments = None
+    if mode != 'off':
+        with stage('split'):
+            if pdf_data is None:
+                pdf_data = await asyncio.to_thread(_read_file, full_file_path)
+            segments = await asyncio.to_thread(split_receipt_pdf, pdf_data, mode, receipt_file.content_hash)
+
+    with stage('extraction'):
+        if not segments:
+            parsed_data, raw_response = await acached_extract(
+                extractor,
+                full_file_path,
+                content_hash=receipt_file.content_hash,
+                pdf_data=pdf_data,
+            )
+            results = [(None, parsed_data, raw_response)]
+        else:
+            limit = asyncio.Semaphore(settings.RECEIPT_SPLIT_MAX_WORKERS)
+
+            async def extract_segment(segment):
+                async with limit:
+                    return await acached_extract(extractor, full_file_path, content_hash=segment.content_hash, pdf_data=segment.data)
+
+            extracted = await asyncio.gather(*(extract_segment(segment) for segment in segments))
+            results = [((segment.first_page, segment.last_page), *result) for segment, result in zip(segments, extracted)]
+    receipts = await sync_to_async(save_extractions)(receipt_file, results)
+    if settings.RECEIPT_NEAR_DUPLICATE_DETECTION:
+        add_to_index(receipt_file)
+    return receipts
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _has_key_fields(parsed_data):
+    return bool(parsed_data.get('merchant_name') or parsed_data.get('total_amount') or parsed_data.get('purchased_at'))
+
+def save_extraction(receipt_file, parsed_data, raw_response):
+    """Stores an extractor result for a whole file: the Receipt and its items, or the failure reason on the ReceiptFile."""
+    return save_extractions(receipt_file, [(None, parsed_data, raw_response)])[0]
+
+def save_extractions(receipt_file, results, duplicate_of=None):
+    """
+    Stores the results of extract_receipts: a Receipt with its items for every
+    segment that yielded data, replacing the file's earlier Receipts. Segments
+    without data (a cover sheet, a torn-off page) are skipped; if none has any,
+    the failure reason is recorded on the ReceiptFile instead.
+    duplicate_of is the earlier upload the results were copied from, if any.
+    Returns the Receipts in page order.
+    """
+    usable = [(pages, parsed_data, raw_response) for pages, parsed_data, raw_response in results if parsed_data is not None and _has_key_fields(parsed_data)]
+    if not usable:
+        failed = [raw_response for _, parsed_data, raw_response in results if parsed_data is None]
+        receipt_file.is_processed = False
+        if len(failed) == len(results): # If extraction failed or returned null
+            receipt_file.invalid_reason = f"Gemini extraction failed: {failed[0]}"
+        else: # Basic check if the model yielded meaningful data
+            receipt_file.invalid_reason = "AI extracted text, but parsing yielded no meaningful data or key fields are missing."
+        receipt_file.save(update_fields=['is_processed', 'invalid_reason', 'updated_at'])
+        raise (ExtractionFailed if len(failed) == len(results) else EmptyExtraction)(receipt_file.invalid_reason)
+    if len(usable) < len(results):
+        logger.info("ReceiptFile %s: %d of %d segments yielded no receipt", receipt_file.pk, len(results) - len(usable), len(results))
+
+    receipts = []
+    with stage('db'), transaction.atomic():
+        payload_sizes = [parsed_data.get('payload_size') for _, parsed_data, _ in usable if parsed_data.get('payload_size') is not None]
+        payload_size = sum(payload_sizes) if payload_sizes else None
+        # One UPDATE of the columns that change, instead of rewriting the whole row. It comes
+        # before the receipts, whose saves invalidate cached lists and move them in the change feed.
+        receipt_file.updated_at = timezone.now()
+        ReceiptFile.objects.filter(pk=receipt_file.pk).update(
+            is_processed=True, invalid_reason=None, updated_at=receipt_file.updated_at, payload_size=payload_size,
+            duplicate_of=duplicate_of,
+        )
+        receipt_file.is_processed = True
+        receipt_file.invalid_reason = None # Left over from a failed earlier attempt
+        receipt_file.payload_size = payload_size
+        receipt_file.duplicate_of = duplicate_of
+
+        # Receipts from an earlier extraction whose pages are no longer a segment of their own
+        first_pages = [pages[0] if pages else None for pages, _, _ in usable]
+        stale = Receipt.objects.filter(receipt_file=receipt_file).exclude(first_page__in=[page for page in first_pages if page is not None])
+        if None in first_pages:
+            stale = stale.exclude(first_page__isnull=True)
+        stale.delete()
+
+        for pages, parsed_data, raw_response in usable:
+            if 'amount_minor' in parsed_data:
+                amount_minor, currency = parsed_data['amount_minor'], parsed_data.get('currency')
+            else: # Cached results from before amounts were normalized
+                amount_minor, currency = parse_amount(parsed_data.get('total_amount'))
+
+            receipt_instance, created = Receipt.objects.update_or_create(
+                receipt_file=receipt_file,
+                first_page=pages[0] if pages else None,
+                defaults={
+                    'last_page': pages[1] if pages else None,
+                    'purchased_at': parsed_data.get('purchased_at'),
+                    'merchant_name': parsed_data.get('merchant_name'),
+                    'total_amount': parsed_data.get('total_amount'),
+                    'amount_minor': amount_minor,
+                    'currency': currency,
+                    'parsed_text': raw_response, # Store raw model JSON response here
+                    'extraction_version': get_cache_version(),
+                    'change_seq': next_change_seq(), # Set in the same write; an update only saves the fields listed here
+                }
+            )
+            if not created:
+                receipt_instance.items.all().delete() # Reprocessing replaces the previous items
+            ReceiptItem.objects.bulk_create([
+                ReceiptItem(receipt=receipt_instance, **row)
+                for row in normalize_items(extract_items(raw_response), currency)
+            ])
+            receipts.append(receipt_instance)
+
+    return receipts
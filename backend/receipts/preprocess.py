@@ -0,0 +1,188 @@
+"""
+Shrinks a receipt PDF before it is sent to the extraction model.
+
+Phone scans are often several megabytes of 300+ DPI images, sometimes with
+blank or repeated pages, and upload time and model latency grow with that size.
+prepare_payload() makes a smaller copy with PyMuPDF:
+- blank pages and exact repeats of an earlier page are dropped
+- embedded images above PDF_PREPROCESS_TARGET_DPI are downsampled and recompressed as JPEG
+- with PDF_PREPROCESS_RASTERIZE, the kept pages are sent as one stacked JPEG instead of a PDF
+
+The original file is never modified, and it is sent unchanged whenever the
+copy would not be smaller. Bytes saved are counted per process (get_preprocess_stats)
+and the payload size is stored on each ReceiptFile.
+"""
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from django.conf import settings
+from .backends import get_fitz
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DPI = 18 # Resolution blank/duplicate detection looks at
+INK_LEVEL = 200 # Grey values below this count as ink
+BLANK_INK_RATIO = 0.002 # Pages with less ink than this share of pixels are blank
+MAX_RASTER_HEIGHT = 12000 # Pixels; longer stacks are scaled down to fit
+
+_ink_table = bytes(1 if value < INK_LEVEL else 0 for value in range(256))
+
+Payload = namedtuple('Payload', ['data', 'mime_type', 'original_size', 'pages_dropped', 'images_resampled'])
+
+_stats_lock = threading.Lock()
+_stats = {'receipts': 0, 'original_bytes': 0, 'payload_bytes': 0, 'pages_dropped': 0, 'images_resampled': 0}
+
+
+def _count(payload):
+    with _stats_lock:
+        _stats['receipts'] += 1
+        _stats['original_bytes'] += payload.original_size
+        _stats['payload_bytes'] += len(payload.data)
+        _stats['pages_dropped'] += payload.pages_dropped
+        _stats['images_resampled'] += payload.images_resampled
+
+def get_preprocess_stats():
+    """Payload sizes before and after preprocessing for the receipts this process sent to the model."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['bytes_saved'] = stats['original_bytes'] - stats['payload_bytes']
+    stats['saved_rate'] = round(stats['bytes_saved'] / stats['original_bytes'], 4) if stats['original_bytes'] else None
+    stats['enabled'] = settings.PDF_PREPROCESS_ENABLED
+    return stats
+
+def reset_preprocess_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+def preprocess_fingerprint():
+    """The settings that change what the model sees, for the extraction cache version."""
+    if not settings.PDF_PREPROCESS_ENABLED:
+        return 'off'
+    return (
+        f"dpi={settings.PDF_PREPROCESS_TARGET_DPI},quality={settings.PDF_PREPROCESS_JPEG_QUALITY},"
+        f"blank={settings.PDF_PREPROCESS_DROP_BLANK_PAGES},raster={settings.PDF_PREPROCESS_RASTERIZE}"
+    )
+
+def page_thumbnail(page):
+    """Greyscale samples of a page at THUMBNAIL_DPI, for blank/duplicate detection."""
+    fitz = get_fitz()
+    return page.get_pixmap(dpi=THUMBNAIL_DPI, colorspace=fitz.csGRAY, alpha=False).samples
+
+def is_blank_page(samples, text):
+    """A page with no text and almost no ink."""
+    return not text.strip() and samples.translate(_ink_table).count(1) < BLANK_INK_RATIO * len(samples)
+
+def _pages_to_drop(doc):
+    """Indexes of blank pages and of pages that render exactly like an earlier page."""
+    drop, seen = [], set()
+    for page in doc:
+        samples, text = page_thumbnail(page), page.get_text('text')
+        if is_blank_page(samples, text):
+            drop.append(page.number)
+            continue
+        fingerprint = hashlib.sha256(samples + text.encode('utf-8')).digest()
+        if fingerprint in seen:
+            drop.append(page.number)
+        else:
+            seen.add(fingerprint)
+    return drop
+
+def _downsample_images(doc, target_dpi, quality):
+    """Re-encodes images drawn at more than target_dpi as JPEGs at target_dpi. Returns how many were replaced."""
+    fitz = get_fitz()
+    resampled, done = 0, set()
+    for page in doc:
+        for image in page.get_images(full=True):
+            xref, smask, width, height = image[0], image[1], image[2], image[3]
+            if xref in done or smask: # Images with transparency are left alone
+                continue
+            done.add(xref)
+            # Looked up by resource name; get_image_rects would decode the image to hash it
+            drawn_width = page.get_image_bbox(image).width / 72 # Inches
+            if not 0 < drawn_width < float('inf') or width / drawn_width <= target_dpi * 1.1:
+                continue
+
+            scale = target_dpi / (width / drawn_width)
+            pixmap = fitz.Pixmap(doc, xref)
+            if pixmap.alpha:
+                pixmap = fitz.Pixmap(pixmap, 0)
+            if pixmap.colorspace is None or pixmap.colorspace.n not in (1, 3): # CMYK, indexed, masks
+                pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+            pixmap = fitz.Pixmap(pixmap, max(1, round(width * scale)), max(1, round(height * scale)), None)
+            page.replace_image(xref, stream=pixmap.tobytes('jpeg', jpg_quality=quality))
+            resampled += 1
+    return resampled
+
+def _rasterize(doc, dpi, quality):
+    """Renders every page at dpi and stacks them into one JPEG."""
+    fitz = get_fitz()
+    pages = [page.get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False) for page in doc]
+    width, height = max(pixmap.width for pixmap in pages), sum(pixmap.height for pixmap in pages)
+    if height > MAX_RASTER_HEIGHT:
+        return _rasterize(doc, max(1, int(dpi * MAX_RASTER_HEIGHT / height)), quality)
+
+    sheet = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, width, height), False)
+    sheet.clear_with(255)
+    y = 0
+    for pixmap in pages:
+        pixmap.set_origin(0, y)
+        sheet.copy(pixmap, pixmap.irect)
+        y += pixmap.height
+    return sheet.tobytes('jpeg', jpg_quality=quality)
+
+def shrink_pdf(pdf_bytes, target_dpi=150, quality=75, drop_blank_pages=True, rasterize=False):
+    """
+    Returns a Payload with a smaller copy of pdf_bytes, or with pdf_bytes itself
+    (mime type application/pdf) when preprocessing would not make it smaller.
+    pdf_bytes can be any buffer, e.g. a memory-mapped file; it is read in place.
+    """
+    view = memoryview(pdf_bytes) # PyMuPDF opens bytes and memoryviews without copying them
+    try:
+        return _shrink_pdf(pdf_bytes, view, target_dpi, quality, drop_blank_pages, rasterize)
+    finally:
+        view.release()
+
+def _shrink_pdf(pdf_bytes, view, target_dpi, quality, drop_blank_pages, rasterize):
+    fitz = get_fitz()
+    original = Payload(pdf_bytes, 'application/pdf', len(pdf_bytes), 0, 0)
+    with fitz.open(stream=view, filetype='pdf') as doc:
+        # Downsampling first makes the thumbnails for page detection cheaper to render
+        resampled = 0 if rasterize else _downsample_images(doc, target_dpi, quality)
+        dropped = _pages_to_drop(doc) if drop_blank_pages else []
+        if len(dropped) == doc.page_count:
+            dropped = [] # Nothing but blank pages: let the model see what there is
+        if dropped:
+            doc.delete_pages(dropped)
+
+        if rasterize:
+            data = _rasterize(doc, target_dpi, quality)
+            payload = Payload(data, 'image/jpeg', len(pdf_bytes), len(dropped), 0)
+        else:
+            if not dropped and not resampled:
+                return original
+            data = doc.tobytes(garbage=4, deflate=True) # Drops the replaced image streams
+            payload = Payload(data, 'application/pdf', len(pdf_bytes), len(dropped), resampled)
+    return payload if len(payload.data) < len(pdf_bytes) else original
+
+def prepare_payload(pdf_bytes):
+    """
+    The bytes to send to the model for a receipt, shrunk according to the
+    PDF_PREPROCESS_* settings. A PDF that PyMuPDF can't process is sent as is.
+    """
+    if not settings.PDF_PREPROCESS_ENABLED:
+        return Payload(pdf_bytes, 'application/pdf', len(pdf_bytes), 0, 0)
+    try:
+        payload = shrink_pdf(
+            pdf_bytes,
+            target_dpi=settings.PDF_PREPROCESS_TARGET_DPI,
+            quality=settings.PDF_PREPROCESS_JPEG_QUALITY,
+            drop_blank_pages=settings.PDF_PREPROCESS_DROP_BLANK_PAGES,
+            rasterize=settings.PDF_PREPROCESS_RASTERIZE,
+        )
+    except Exception as e:
+        logger.warning("PDF preprocessing failed, sending the original: %s", e)
+        payload = Payload(pdf_bytes, 'application/pdf', len(pdf_bytes), 0, 0)
+    _count(payload)
+    return payload
@@ -0,0 +1,109 @@
+"""
+Sampling profiler for slow requests.
+
+With RECEIPT_PROFILE_SLOW_REQUESTS on, one background thread samples the Python
+stack of every thread that is inside an instrumented view (see metrics.instrumented)
+every RECEIPT_PROFILE_INTERVAL seconds. When a request takes longer than
+RECEIPT_SLOW_REQUEST_SECONDS, its samples are logged (hottest stacks first) and,
+if RECEIPT_PROFILE_DIR is set, written there in collapsed-stack format
+(one "frame;frame;frame count" line per stack), which flamegraph.pl and speedscope read.
+Fast requests' samples are dropped. The sampler costs nothing while the setting is off.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MAX_STACK_DEPTH = 64
+
+
+def collapse_stack(frame):
+    """'module:function;module:function' from the outermost frame to `frame`."""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """Samples the registered threads' stacks on one daemon thread."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._samples = {} # thread id -> Counter of collapsed stacks
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, thread_id):
+        with self._lock:
+            self._samples[thread_id] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='receipt-profiler', daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id):
+        with self._lock:
+            return self._samples.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._samples:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, counts in self._samples.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        counts[collapse_stack(frame)] += 1
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler():
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = StackSampler(settings.RECEIPT_PROFILE_INTERVAL)
+        return _sampler
+
+def write_profile(view, elapsed, samples):
+    """Logs the hottest stacks of a slow request and saves all of them to RECEIPT_PROFILE_DIR."""
+    top = '\n'.join(f"  {count:5d}  ...;{';'.join(stack.split(';')[-3:])}" for stack, count in samples.most_common(5))
+    logger.warning("Slow %s request: %.0f ms, %d samples. Hottest stacks:\n%s", view, elapsed * 1000, sum(samples.values()), top)
+
+    if settings.RECEIPT_PROFILE_DIR:
+        os.makedirs(settings.RECEIPT_PROFILE_DIR, exist_ok=True)
+        path = os.path.join(settings.RECEIPT_PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{view}-{elapsed * 1000:.0f}ms.folded")
+        with open(path, 'w') as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in samples.most_common())
+        return path
+    return None
+
+@contextmanager
+def profile_request(view):
+    """Samples the calling thread for the duration of the block if slow-request profiling is on."""
+    if not settings.RECEIPT_PROFILE_SLOW_REQUESTS:
+        yield
+        return
+
+    sampler, thread_id = get_sampler(), threading.get_ident()
+    sampler.start(thread_id)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        samples = sampler.stop(thread_id)
+        elapsed = time.perf_counter() - started
+        if elapsed >= settings.RECEIPT_SLOW_REQUEST_SECONDS and samples:
+            write_profile(view, elapsed, samples)
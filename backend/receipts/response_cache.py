@@ -0,0 +1,103 @@
+"""
+Conditional GET and a server-side cache for the receipt read endpoints.
+
+Each response gets an ETag derived from the request path and a cheap fingerprint
+of the rows behind it (max(updated_at), the change feed head and a row count for
+the list, the row's own timestamps for a detail). A client sending that ETag back in If-None-Match gets a
+304 without the page being queried or serialized.
+
+Serialized payloads are kept in the Django cache named by settings.RECEIPT_RESPONSE_CACHE
+(local memory or file-based, see CACHES), keyed by the same ETag, so a changed row can
+never be served from it. Saves and deletes of Receipt and ReceiptFile also bump a
+generation number, which drops every cached payload at once.
+"""
+import hashlib
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+from .models import Receipt, ReceiptFile, ReceiptTombstone
+
+GENERATION_KEY = 'receipts:generation'
+
+
+def get_response_cache():
+    """The configured cache for serialized receipt payloads, or None when disabled."""
+    alias = settings.RECEIPT_RESPONSE_CACHE
+    return caches[alias] if alias else None
+
+def _generation(cache):
+    return cache.get_or_set(GENERATION_KEY, 1, timeout=None)
+
+def invalidate_receipt_responses():
+    """Drops every cached receipt payload in this cache (new generation)."""
+    cache = get_response_cache()
+    if cache is None:
+        return
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError: # Not set yet, or evicted
+        cache.set(GENERATION_KEY, 2, timeout=None)
+
+def list_fingerprint(include_files=True):
+    """
+    (last_modified, validators, change_seq) for the receipt list. The validators are
+    the newest updated_at, the newest deletion, the row count and the change feed
+    head, so inserts, updates and deletes all change them, and each is answered from
+    an index. With include_files, ReceiptFile changes (shown in receipt_file_details)
+    count too. change_seq is the head (see receipts.changes.current_change_seq).
+    """
+    receipts = Receipt.objects.aggregate(last=Max('updated_at'), count=Count('id'), seq=Max('change_seq'))
+    # A delete doesn't move max(updated_at); without the tombstones If-Modified-Since would keep the row alive
+    tombstones = ReceiptTombstone.objects.aggregate(last=Max('deleted_at'), seq=Max('change_seq'))
+    change_seq = max(receipts['seq'] or 0, tombstones['seq'] or 0)
+    timestamps = [receipts['last'], tombstones['last']]
+    if include_files:
+        timestamps.append(ReceiptFile.objects.aggregate(last=Max('updated_at'))['last'])
+    present = [timestamp for timestamp in timestamps if timestamp is not None]
+    return (max(present) if present else None), (receipts['count'], change_seq, *timestamps), change_seq
+
+def detail_fingerprint(receipt_id):
+    """(last_modified, validators) for one receipt, or None if it doesn't exist."""
+    row = Receipt.objects.filter(id=receipt_id).values_list('updated_at', 'receipt_file__updated_at').first()
+    if row is None:
+        return None
+    return max(row), row
+
+def conditional_response(request, last_modified, validators, build, fresh=None):
+    """
+    Returns 304 when the client's ETag/Last-Modified is current; otherwise a 200
+    Response with the payload from the cache, or from build() on a miss.
+    build() must return the data to serialize (it is only called on a miss).
+    fresh is a dict of keys added to the payload after the cache lookup; they are never cached.
+    """
+    digest = hashlib.sha256(repr((request.get_full_path(), validators)).encode('utf-8')).hexdigest()
+    etag = quote_etag(digest[:32])
+    last_modified_ts = int(last_modified.timestamp()) if last_modified else None
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified_ts)
+    if not_modified is not None:
+        not_modified['ETag'] = etag
+        return not_modified
+
+    cache = get_response_cache()
+    data = None
+    if cache is not None:
+        key = f'receipts:response:{digest}'
+        generation = _generation(cache)
+        data = cache.get(key, version=generation)
+    if data is None:
+        data = build()
+        if cache is not None:
+            cache.set(key, data, version=generation)
+
+    if fresh:
+        data = {**data, **fresh}
+    response = Response(data)
+    response['ETag'] = etag
+    if last_modified_ts is not None:
+        response['Last-Modified'] = http_date(last_modified_ts)
+    response['Cache-Control'] = 'no-cache' # Browsers may keep the copy but must revalidate it (cheaply, via 304)
+    return response
@@ -0,0 +1,122 @@
+"""
+Full-text search over receipts with an SQLite FTS5 table.
+
+receipt_search holds one row per Receipt (rowid = receipt id) with its merchant
+name, line-item descriptions and raw extracted text. Signal handlers keep it in
+step with Receipt saves and deletes; rebuild_search_index() repopulates it after
+bulk loads, which skip signals.
+"""
+import re
+from django.db import connection, transaction
+from .items import extract_items
+
+SEARCH_TABLE = 'receipt_search'
+RANK_WEIGHTS = (10.0, 5.0, 1.0) # bm25 column weights: merchant_name, items, parsed_text
+REBUILD_BATCH_SIZE = 2000
+
+CREATE_TABLE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+    "merchant_name, items, parsed_text, "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')" # Prefix indexes keep 'caf*' queries fast
+)
+DROP_TABLE_SQL = f"DROP TABLE IF EXISTS {SEARCH_TABLE}"
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def is_search_available(conn=None):
+    return (conn or connection).vendor == 'sqlite'
+
+def _row(receipt_id, merchant_name, parsed_text):
+    descriptions = " ".join(str(item.get('description') or '') for item in extract_items(parsed_text))
+    return (receipt_id, merchant_name or '', descriptions, parsed_text or '')
+
+def index_receipt(receipt, conn=None):
+    """Adds or replaces a receipt's row in the search table."""
+    conn = conn or connection
+    if not is_search_available(conn):
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [receipt.id])
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, merchant_name, items, parsed_text) VALUES (%s, %s, %s, %s)",
+            _row(receipt.id, receipt.merchant_name, receipt.parsed_text),
+        )
+
+def unindex_receipt(receipt_id, conn=None):
+    conn = conn or connection
+    if not is_search_available(conn):
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [receipt_id])
+
+def rebuild_search_index(receipts, conn=None, batch_size=REBUILD_BATCH_SIZE):
+    """
+    Repopulates the search table from a Receipt queryset (the app model or a
+    migration's historical model). Returns the number of rows indexed.
+    """
+    conn = conn or connection
+    if not is_search_available(conn):
+        return 0
+    rows = receipts.order_by('id').values_list('id', 'merchant_name', 'parsed_text')
+    count = 0
+    # One transaction: committing each batch makes FTS5 flush and merge segments every time
+    with transaction.atomic(using=conn.alias), conn.cursor() as cursor:
+        cursor.execute(DROP_TABLE_SQL) # Recreating is much cheaper than deleting every row
+        cursor.execute(CREATE_TABLE_SQL)
+        batch = []
+        for row in rows.iterator(chunk_size=batch_size):
+            batch.append(_row(*row))
+            if len(batch) >= batch_size:
+                cursor.executemany(f"INSERT INTO {SEARCH_TABLE} (rowid, merchant_name, items, parsed_text) VALUES (%s, %s, %s, %s)", batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(f"INSERT INTO {SEARCH_TABLE} (rowid, merchant_name, items, parsed_text) VALUES (%s, %s, %s, %s)", batch)
+            count += len(batch)
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')") # Merge index segments
+    return count
+
+def build_match_query(text):
+    """
+    Turns free text into a safe FTS5 query: every word must match, as a prefix.
+    Returns None when the text has no searchable words.
+    """
+    tokens = _TOKEN_RE.findall(text or '')
+    if not tokens:
+        return None
+    return " ".join(f'"{token}"*' for token in tokens)
+
+def get_rank_floor(match_query, max_ranked):
+    """
+    Smallest receipt id among the newest `max_ranked` matches, or None if nothing matches.
+    Scoring every hit of a very common word costs seconds at 1M rows, so only this
+    window is ranked; walking the doclist newest-first to find it is cheap.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT MIN(rowid) FROM (SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s ORDER BY rowid DESC LIMIT %s)",
+            [match_query, max_ranked],
+        )
+        return cursor.fetchone()[0]
+
+def search_receipt_ids(match_query, after=None, limit=50, floor=None):
+    """
+    Best matches first, ordered by (bm25 score, id), among receipts with id >= floor.
+    `after` is the (score, id) of the last row of the previous page.
+    Returns [(receipt_id, score), ...] with up to limit + 1 rows, so callers can tell if there is another page.
+    """
+    weights = ", ".join(str(weight) for weight in RANK_WEIGHTS)
+    sql = f"SELECT rowid, bm25({SEARCH_TABLE}, {weights}) AS score FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s"
+    params = [match_query]
+    if floor is not None:
+        sql += " AND rowid >= %s"
+        params.append(floor)
+    if after is not None:
+        sql += " AND (score > %s OR (score = %s AND rowid > %s))"
+        params += [after[0], after[0], after[1]]
+    sql += " ORDER BY score, rowid LIMIT %s"
+    params.append(limit + 1)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
@@ -0,0 +1,97 @@
+"""
+Splits PDFs that hold several receipts (a scanned stack, an expense report
+printout) so that each receipt is extracted into its own Receipt row.
+
+Split modes, from ReceiptFile.split_mode or else RECEIPT_SPLIT_MODE:
+  off    the whole file is one receipt
+  pages  every non-blank page is one receipt
+  auto   pages are grouped by layout: a receipt runs until a page with a total
+         line, and blank pages separate receipts. Pages without a text layer
+         (plain scans) can't be read this way, so each is a receipt of its own.
+
+Each segment is copied into a PDF of its own and extracted separately; the
+extraction cache keys it by the file's hash plus its page range. The segments
+of a file are extracted concurrently (see pipeline.extract_receipts), so a stack
+of receipts takes about as long as its slowest page instead of the sum of all.
+"""
+import hashlib
+from collections import namedtuple
+from django.conf import settings
+from .backends import get_fitz
+from .local_extraction import MIN_TEXT_LENGTH, has_total_line
+from .preprocess import page_thumbnail, is_blank_page
+
+SPLIT_MODES = ('off', 'pages', 'auto')
+
+# first_page and last_page are 1-based and inclusive; data is a PDF of just those pages
+Segment = namedtuple('Segment', ['first_page', 'last_page', 'data', 'content_hash'])
+
+
+def get_split_mode(receipt_file=None):
+    """The split mode for a ReceiptFile: its own if one was chosen at upload, otherwise RECEIPT_SPLIT_MODE."""
+    mode = (receipt_file and receipt_file.split_mode) or settings.RECEIPT_SPLIT_MODE
+    if mode not in SPLIT_MODES:
+        raise ValueError(f"Unknown split mode {mode!r}; expected one of: {', '.join(SPLIT_MODES)}")
+    return mode
+
+def parse_split_mode(value):
+    """A split mode from a request parameter: None when not given. Raises ValueError for unknown modes."""
+    if value is None or value == '':
+        return None
+    if value not in SPLIT_MODES:
+        raise ValueError(f"split must be one of: {', '.join(SPLIT_MODES)}")
+    return value
+
+def find_receipt_pages(doc, mode):
+    """(first, last) 0-based page indexes of each receipt in an open PyMuPDF document."""
+    ranges, start = [], None
+    for page in doc:
+        text = page.get_text('text')
+        if not text.strip() and is_blank_page(page_thumbnail(page), text):
+            if start is not None: # A blank sheet between receipts
+                ranges.append((start, page.number - 1))
+                start = None
+            continue
+        if mode == 'pages' or len(text.strip()) < MIN_TEXT_LENGTH:
+            if start is not None:
+                ranges.append((start, page.number - 1))
+                start = None
+            ranges.append((page.number, page.number))
+            continue
+        if start is None:
+            start = page.number
+        if has_total_line(text):
+            ranges.append((start, page.number))
+            start = None
+    if start is not None:
+        ranges.append((start, doc.page_count - 1))
+    return ranges
+
+def _segment_hash(content_hash, first_page, last_page):
+    # Stable across runs, unlike the bytes of the rebuilt PDF
+    return hashlib.sha256(f'{content_hash}:{first_page}-{last_page}'.encode('ascii')).hexdigest()
+
+def split_receipt_pdf(pdf_data, mode, content_hash=None):
+    """
+    The receipts in a PDF (bytes or a mapping) as a list of Segments, or None
+    when there is nothing to split: mode 'off', or a single receipt.
+    """
+    if mode == 'off':
+        return None
+    fitz = get_fitz()
+    view = memoryview(pdf_data)
+    try:
+        with fitz.open(stream=view, filetype='pdf') as doc:
+            ranges = find_receipt_pages(doc, mode)
+            if len(ranges) < 2:
+                return None
+            segments = []
+            for first, last in ranges:
+                with fitz.open() as part:
+                    part.insert_pdf(doc, from_page=first, to_page=last)
+                    data = part.tobytes(garbage=1)
+                segment_hash = _segment_hash(content_hash, first + 1, last + 1) if content_hash else None
+                segments.append(Segment(first + 1, last + 1, data, segment_hash))
+            return segments
+    finally:
+        view.release()
@@ -1,5 +1,7 @@
+from django.urls import reverse
 from rest_framework import serializers
-from .models import ReceiptFile, Receipt
+from .models import ReceiptFile, Receipt, ReceiptItem, ExtractionJob
+from .thumbnails import thumbnail_version
 
 class ReceiptFileSerializer(serializers.ModelSerializer):
     class Meta:
@@ -13,10 +15,57 @@ class ReceiptSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ('created_at', 'updated_at')
 
-class ReceiptDetailSerializer(serializers.ModelSerializer):
+class DynamicFieldsModelSerializer(serializers.ModelSerializer):
+    """
+    ModelSerializer that takes an optional `fields` argument listing which fields to output.
+    """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+class ReceiptItemSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ReceiptItem
+        fields = ('position', 'description', 'price', 'price_minor', 'currency')
+
+class ReceiptDetailSerializer(DynamicFieldsModelSerializer):
     receipt_file_details = ReceiptFileSerializer(source='receipt_file', read_only=True)
+    items = ReceiptItemSerializer(many=True, read_only=True)
+    thumbnail_url = serializers.SerializerMethodField()
 
     class Meta:
         model = Receipt
         fields = '__all__'
-        read_only_fields = ('created_at', 'updated_at')
\ No newline at end of file
+        read_only_fields = ('created_at', 'updated_at')
+
+    def get_thumbnail_url(self, obj):
+        # Versioned by content hash, so the thumbnail can be cached as immutable
+        url = reverse('receipt_thumbnail', args=[obj.id])
+        content_hash = obj.receipt_file.content_hash
+        return f'{url}?v={thumbnail_version(content_hash, obj.first_page)}' if content_hash else url
+
+class ExtractionJobSerializer(serializers.ModelSerializer):
+    receipt_file_details = ReceiptFileSerializer(source='receipt_file', read_only=True)
+    receipt_id = serializers.SerializerMethodField()
+    receipt_ids = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ExtractionJob
+        fields = '__all__'
+        read_only_fields = ('status', 'error', 'created_at', 'started_at', 'finished_at')
+
+    def get_receipt_id(self, obj):
+        if obj.status != ExtractionJob.STATUS_SUCCEEDED:
+            return None
+        # The first receipt of a split PDF; receipt_ids lists them all
+        receipt_ids = self.get_receipt_ids(obj)
+        return receipt_ids[0] if receipt_ids else None
+
+    def get_receipt_ids(self, obj):
+        if obj.status != ExtractionJob.STATUS_SUCCEEDED:
+            return []
+        return list(Receipt.objects.filter(receipt_file_id=obj.receipt_file_id).order_by('first_page', 'id').values_list('id', flat=True))
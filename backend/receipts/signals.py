@@ -0,0 +1,56 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .models import Receipt, ReceiptFile
+from .search import index_receipt, unindex_receipt
+from .response_cache import invalidate_receipt_responses
+from .changes import mark_changed, next_change_seq, record_deletion
+from .storage import get_receipt_storage
+
+
+@receiver(post_save, sender=Receipt)
+def index_saved_receipt(sender, instance, raw=False, **kwargs):
+    if not raw: # Skip fixture loading
+        index_receipt(instance)
+
+@receiver(post_delete, sender=Receipt)
+def unindex_deleted_receipt(sender, instance, **kwargs):
+    unindex_receipt(instance.id)
+
+@receiver(pre_save, sender=Receipt)
+def sequence_saved_receipt(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Numbered inside the row's own INSERT/UPDATE, like auto_now: included unless update_fields leaves it out
+    if not raw and (update_fields is None or 'change_seq' in update_fields):
+        instance.change_seq = next_change_seq()
+
+@receiver(post_save, sender=Receipt)
+def load_change_seq(sender, instance, **kwargs):
+    # The attribute still holds the SQL expression; a primary key read, not a write
+    if hasattr(instance.change_seq, 'resolve_expression'):
+        instance.refresh_from_db(fields=['change_seq'])
+
+@receiver(post_save, sender=ReceiptFile)
+def sequence_receipt_of_saved_file(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    # receipt_file_details is part of a receipt's representation. A new file has no receipt yet,
+    # and neither do most files saved while being validated or failing extraction; checking is a read.
+    if created or raw or (update_fields is not None and set(update_fields) <= {'updated_at'}):
+        return
+    receipts = Receipt.objects.filter(receipt_file_id=instance.pk)
+    if receipts.exists():
+        mark_changed(receipts)
+
+@receiver(post_delete, sender=Receipt)
+def tombstone_deleted_receipt(sender, instance, **kwargs):
+    record_deletion(instance.id)
+
+@receiver(post_delete, sender=ReceiptFile)
+def release_deleted_file(sender, instance, **kwargs):
+    # After commit, so a rolled-back delete never loses the file; the file goes with its last reference
+    transaction.on_commit(lambda: get_receipt_storage().release(instance.file_path))
+
+@receiver(post_save, sender=Receipt)
+@receiver(post_delete, sender=Receipt)
+@receiver(post_save, sender=ReceiptFile)
+@receiver(post_delete, sender=ReceiptFile)
+def invalidate_cached_responses(sender, **kwargs):
+    invalidate_receipt_responses()
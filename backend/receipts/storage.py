@@ -0,0 +1,270 @@
+"""
+Storage backends for uploaded receipt PDFs.
+
+Files are content-addressed: the key is derived from the SHA-256 computed while
+the upload streams in, e.g. receipts/objects/3f/a2/3fa2...e1.pdf. The hash-prefix
+shards keep every directory small, and identical PDFs are stored once. The
+StoredObject table counts the ReceiptFiles pointing at each key, and the file is
+only removed when the last of them is released.
+
+Backends are selected with settings.RECEIPT_STORAGE_BACKEND:
+- 'sharded': ShardedFileSystemStorage under MEDIA_ROOT (default)
+- 's3': S3Storage, for any S3-compatible service (boto3 is imported on first use)
+- or a dotted path to a ReceiptStorage subclass
+"""
+import os
+import tempfile
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .ingest import stream_to_disk
+from .models import StoredObject
+
+STORAGE_BACKENDS = {
+    'sharded': 'receipts.storage.ShardedFileSystemStorage',
+    's3': 'receipts.storage.S3Storage',
+}
+OBJECT_PREFIX = 'receipts/objects'
+
+StagedFile = namedtuple('StagedFile', ['path', 'content_hash', 'size'])
+StoredFile = namedtuple('StoredFile', ['key', 'content_hash', 'size'])
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def object_key(content_hash, shard_depth=2, shard_width=2):
+    """receipts/objects/<h[0:2]>/<h[2:4]>/<hash>.pdf for the default two levels of two hex characters."""
+    shards = [content_hash[i * shard_width:(i + 1) * shard_width] for i in range(shard_depth)]
+    return '/'.join([OBJECT_PREFIX, *shards, f'{content_hash}.pdf'])
+
+def is_object_key(key):
+    return key.startswith(OBJECT_PREFIX + '/')
+
+
+class ReceiptStorage:
+    """
+    Interface used by the upload and process views. Subclasses implement the
+    blob operations (exists, _put, _remove, local_path); reference counting
+    is shared and lives in the database.
+    """
+
+    def staging_dir(self):
+        """Directory uploads are streamed into before they are hashed and committed."""
+        return None # The system temp directory
+
+    def stage(self, chunks, max_bytes=None):
+        """
+        Streams byte chunks to a staging file, hashing them on the way. Returns a
+        StagedFile for commit(). Raises UploadTooLarge once max_bytes is exceeded.
+        Touches no database, so it can run in any worker thread.
+        """
+        staging_dir = self.staging_dir()
+        if staging_dir:
+            os.makedirs(staging_dir, exist_ok=True)
+        fd, staged_path = tempfile.mkstemp(suffix='.pdf', dir=staging_dir)
+        os.close(fd)
+        content_hash, size = stream_to_disk(chunks, staged_path, max_bytes) # Removes the file on failure
+        return StagedFile(staged_path, content_hash, size)
+
+    def commit(self, staged):
+        """
+        Stores a staged file under its content address and returns a StoredFile.
+        An identical file that is already stored is reused and gains a reference.
+        """
+        try:
+            key = object_key(staged.content_hash)
+            self._acquire(key, staged.size)
+            try:
+                # Checked after taking the reference, so a concurrent release of the last
+                # reference either sees ours and keeps the file, or has already removed it
+                if not self.exists(key):
+                    self._put(staged.path, key)
+            except BaseException:
+                self.release(key)
+                raise
+            return StoredFile(key, staged.content_hash, staged.size)
+        finally:
+            if os.path.exists(staged.path):
+                os.remove(staged.path)
+
+    def save(self, chunks, max_bytes=None):
+        """stage() and commit() in one call."""
+        return self.commit(self.stage(chunks, max_bytes))
+
+    def _acquire(self, key, size):
+        """Adds one reference to key in a single upsert."""
+        table = connection.ops.quote_name(StoredObject._meta.db_table)
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({quote('key')}, {quote('size')}, {quote('ref_count')}, {quote('created_at')}) "
+                f"VALUES (%s, %s, 1, %s) "
+                f"ON CONFLICT ({quote('key')}) DO UPDATE SET {quote('ref_count')} = {table}.{quote('ref_count')} + 1",
+                [key, size, timezone.now()],
+            )
+
+    def release(self, key):
+        """
+        Drops one reference to key and removes the file with the last one.
+        Keys without a StoredObject row (files stored before content addressing)
+        are left alone. Returns True if the file was removed.
+        """
+        with transaction.atomic():
+            stored = StoredObject.objects.select_for_update().filter(key=key).first()
+            if stored is None:
+                return False
+            if stored.ref_count > 1:
+                StoredObject.objects.filter(pk=stored.pk).update(ref_count=F('ref_count') - 1)
+                return False
+            stored.delete()
+            self._remove(key) # Inside the transaction, so a concurrent save() waits and then re-puts the file
+            return True
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def _put(self, staged_path, key):
+        """Moves or uploads a staged file to key."""
+        raise NotImplementedError
+
+    def _remove(self, key):
+        raise NotImplementedError
+
+    def local_path(self, key):
+        """Context manager yielding a local filesystem path with the file's bytes."""
+        raise NotImplementedError
+
+
+class ShardedFileSystemStorage(ReceiptStorage):
+    """Content-addressed files under `root` (MEDIA_ROOT), in hash-prefix shard directories."""
+
+    def __init__(self, root):
+        self.root = str(root)
+
+    @classmethod
+    def from_settings(cls):
+        return cls(settings.MEDIA_ROOT)
+
+    def path(self, key):
+        return os.path.join(self.root, *key.replace('\\', '/').split('/')) # Older rows may hold Windows-style paths
+
+    def staging_dir(self):
+        return os.path.join(self.root, 'receipts', 'tmp') # Same filesystem as the objects, so _put is a rename
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def _put(self, staged_path, key):
+        destination = self.path(key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(staged_path, destination) # Atomic; concurrent puts of the same bytes are harmless
+
+    def _remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def local_path(self, key):
+        # Keys are relative to MEDIA_ROOT, so paths stored before content addressing still resolve
+        yield self.path(key)
+
+
+class S3Storage(ReceiptStorage):
+    """
+    Content-addressed objects in an S3-compatible bucket (AWS S3, MinIO, ...).
+    `client` is anything with boto3's head_object/upload_file/download_file/delete_object;
+    by default a boto3 client is created on first use.
+    """
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, client=None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.endpoint_url = endpoint_url
+        self._client = client
+        self._client_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        if not settings.RECEIPT_STORAGE_S3_BUCKET:
+            raise ImproperlyConfigured("RECEIPT_STORAGE_S3_BUCKET must be set to use the 's3' storage backend.")
+        return cls(
+            settings.RECEIPT_STORAGE_S3_BUCKET,
+            prefix=settings.RECEIPT_STORAGE_S3_PREFIX,
+            endpoint_url=settings.RECEIPT_STORAGE_S3_ENDPOINT_URL,
+        )
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import boto3  # Only needed for this backend
+                    self._client = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self._client
+
+    def object_name(self, key):
+        return f'{self.prefix}/{key}' if self.prefix else key
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_name(key))
+        except Exception as e:
+            code = str(getattr(e, 'response', {}).get('Error', {}).get('Code', ''))
+            if code in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def _put(self, staged_path, key):
+        self.client.upload_file(staged_path, self.bucket, self.object_name(key), ExtraArgs={'ContentType': 'application/pdf'})
+
+    def _remove(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_name(key))
+
+    @contextmanager
+    def local_path(self, key):
+        """Downloads the object to a temporary file for the duration of the block."""
+        fd, path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self.object_name(key), path)
+            yield path
+        finally:
+            os.remove(path)
+
+
+def get_storage_backend_path(name):
+    if name in STORAGE_BACKENDS:
+        return STORAGE_BACKENDS[name]
+    if '.' in name:
+        return name
+    raise ImproperlyConfigured(
+        f"Unknown storage backend {name!r}. Use one of {', '.join(sorted(STORAGE_BACKENDS))} or a dotted path."
+    )
+
+def get_receipt_storage():
+    """
+    Returns the storage backend configured by settings.RECEIPT_STORAGE_BACKEND.
+    Instances are reused while the settings they are built from stay the same.
+    """
+    path = get_storage_backend_path(settings.RECEIPT_STORAGE_BACKEND)
+    key = (
+        path, str(settings.MEDIA_ROOT), settings.RECEIPT_STORAGE_S3_BUCKET,
+        settings.RECEIPT_STORAGE_S3_PREFIX, settings.RECEIPT_STORAGE_S3_ENDPOINT_URL,
+    )
+    storage = _storages.get(key)
+    if storage is None:
+        with _storages_lock:
+            storage = _storages.get(key)
+            if storage is None:
+                storage = _storages[key] = import_string(path).from_settings()
+    return storage
@@ -1,3 +1,1522 @@
-from django.test import TestCase
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from unittest import mock
+from datetime import datetime, timezone as dt_timezone
+import fitz  # PyMuPDF
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import CommandError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models.signals import post_save
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from .models import ReceiptFile, Receipt, ReceiptItem, ReceiptTombstone, ExtractionJob, ExtractionCacheEntry, StoredObject
+from .pagination import decode_change_cursor, encode_change_cursor
+from .utils import fake_extract_details
+from .pipeline import extract_and_save
+from .money import parse_amount
+from .items import normalize_items
+from .ingest import open_mapped, quick_validate_pdf, stream_to_disk, UploadTooLarge
+from .client import ExtractionClient, SQLiteTokenBucket, CircuitBreaker, ProviderUnavailable, CircuitOpenError
+from .backends import get_backend, get_backend_path
+from .storage import S3Storage
+from . import batching, cache, jobs, local_extraction, metrics, preprocess, thumbnails, utils
 
-# Create your tests here.
+FAKE_EXTRACTOR = 'fake'
+
+
+def make_pdf_bytes(lines=("TEST STORE", "2025-07-29", "TOTAL $12.34"), pages=1):
+    """Builds a small text PDF in memory."""
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        y = 72
+        for line in lines:
+            page.insert_text((72, y), line)
+            y += 18
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+extractor_calls = []
+
+def counting_extractor(pdf_path, pdf_data=None):
+    """Fake extractor that records every call."""
+    extractor_calls.append(pdf_path)
+    return fake_extract_details(pdf_path, pdf_data)
+
+def unavailable_extractor(pdf_path, pdf_data=None):
+    raise ProviderUnavailable('Gemini is throttling', retry_after=7)
+
+def make_upload(name='receipt.pdf', data=None):
+    return SimpleUploadedFile(name, data if data is not None else make_pdf_bytes(), content_type='application/pdf')
+
+
+def make_receipts(count, **overrides):
+    """Creates `count` processed ReceiptFile/Receipt pairs directly in the database."""
+    receipts = []
+    for i in range(count):
+        receipt_file = ReceiptFile.objects.create(
+            file_name=f'receipt_{i}.pdf', file_path=f'receipts/2025/receipt_{i}.pdf', is_valid=True, is_processed=True
+        )
+        fields = {
+            'merchant_name': f'Store {i}',
+            'total_amount': f'${i}.99',
+            'parsed_text': '{"items": []}',
+        }
+        fields.update(overrides)
+        receipts.append(Receipt.objects.create(receipt_file=receipt_file, **fields))
+    return receipts
+
+
+def make_multi_receipt_pdf(pages):
+    """A PDF with one page per entry of `pages` (lines of text; an empty tuple is a blank page)."""
+    doc = fitz.open()
+    for lines in pages:
+        page = doc.new_page()
+        for i, line in enumerate(lines):
+            page.insert_text((72, 72 + 18 * i), line)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+split_barrier = threading.Barrier(3)
+
+def barrier_extractor(pdf_path, pdf_data=None):
+    """Fake extractor that only returns once three calls are running at the same time."""
+    split_barrier.wait(timeout=5) # Raises BrokenBarrierError if the segments run one after another
+    return fake_extract_details(pdf_path, pdf_data)
+
+
+class MediaRootMixin:
+    """Points MEDIA_ROOT at a throwaway directory and swaps in an offline extractor."""
+    extractor = FAKE_EXTRACTOR
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.media_override = override_settings(MEDIA_ROOT=self.media_root, RECEIPT_EXTRACTOR=self.extractor)
+        self.media_override.enable()
+        self.client = APIClient()
+
+    def tearDown(self):
+        self.media_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        super().tearDown()
+
+
+class UploadReceiptViewTests(MediaRootMixin, TestCase):
+    def test_upload_extracts_and_stores_receipt(self):
+        response = self.client.post(reverse('upload_receipt'), {'file': make_upload()}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        receipt = Receipt.objects.get()
+        self.assertEqual(receipt.merchant_name, 'Fake Merchant')
+        self.assertEqual((receipt.amount_minor, receipt.currency), (1234, 'USD'))
+        self.assertTrue(receipt.receipt_file.is_valid)
+        self.assertTrue(receipt.receipt_file.is_processed)
+
+    def test_upload_is_hashed_while_streaming_and_not_reparsed(self):
+        data = make_pdf_bytes()
+        with mock.patch('receipts.pipeline.validate_pdf') as full_validation:
+            response = self.client.post(reverse('upload_receipt'), {'file': make_upload(data=data)}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        full_validation.assert_not_called()
+        receipt_file = ReceiptFile.objects.get()
+        self.assertEqual(receipt_file.content_hash, hashlib.sha256(data).hexdigest())
+        self.assertEqual(receipt_file.file_size, len(data))
+
+    @override_settings(RECEIPT_MAX_UPLOAD_SIZE=100)
+    def test_upload_over_size_limit(self):
+        response = self.client.post(reverse('upload_receipt'), {'file': make_upload()}, format='multipart')
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(ReceiptFile.objects.exists())
+
+    def test_upload_rejects_invalid_pdf(self):
+        response = self.client.post(reverse('upload_receipt'), {'file': make_upload(data=b'not a pdf')}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ReceiptFile.objects.get().is_valid)
+        self.assertFalse(Receipt.objects.exists())
+
+    def test_upload_writes_receipt_file_once_and_updates_only_status(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('upload_receipt'), {'file': make_upload()}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        file_writes = [
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith(('INSERT', 'UPDATE')) and '"receipts_receiptfile"' in query['sql'].split(' SET ')[0]
+        ]
+        self.assertEqual(len(file_writes), 2) # INSERT with the validation result, then the processed flag
+        self.assertTrue(file_writes[0].startswith('INSERT'))
+        self.assertIn('SET "is_processed" = 1, "invalid_reason" = NULL, "updated_at" =', file_writes[1])
+        self.assertTrue(ReceiptFile.objects.get().is_processed)
+
+
+class ExtractionJobTests(MediaRootMixin, TransactionTestCase):
+    def tearDown(self):
+        jobs.shutdown_executor()
+        super().tearDown()
+
+    def test_async_upload_returns_job_and_worker_completes_it(self):
+        response = self.client.post(reverse('upload_receipt') + '?mode=async', {'file': make_upload()}, format='multipart')
+        self.assertEqual(response.status_code, 202)
+        job_id = response.data['job_id']
+
+        jobs.shutdown_executor(wait=True) # Drain the pool
+
+        response = self.client.get(reverse('extraction_job_detail', args=[job_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], ExtractionJob.STATUS_SUCCEEDED)
+        self.assertEqual(response.data['receipt_id'], Receipt.objects.get().id)
+
+    def test_async_upload_of_invalid_pdf_fails_job(self):
+        response = self.client.post(reverse('upload_receipt') + '?mode=async', {'file': make_upload(data=b'junk')}, format='multipart')
+        jobs.shutdown_executor(wait=True)
+        job = ExtractionJob.objects.get(id=response.data['job_id'])
+        self.assertEqual(job.status, ExtractionJob.STATUS_FAILED)
+        self.assertIsNotNone(job.error)
+
+    def test_unknown_job_returns_404(self):
+        response = self.client.get(reverse('extraction_job_detail', args=[999]))
+        self.assertEqual(response.status_code, 404)
+
+
+class ExtractionCacheTests(MediaRootMixin, TestCase):
+    extractor = 'receipts.tests.counting_extractor'
+
+    def setUp(self):
+        super().setUp()
+        extractor_calls.clear()
+        cache.reset_cache_stats()
+
+    def test_identical_bytes_skip_second_extraction(self):
+        data = make_pdf_bytes()
+        for name in ('first.pdf', 'second.pdf'):
+            response = self.client.post(reverse('upload_receipt'), {'file': make_upload(name, data)}, format='multipart')
+            self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(len(extractor_calls), 1)
+        self.assertEqual(Receipt.objects.count(), 2)
+        self.assertEqual(Receipt.objects.last().purchased_at.year, 2025)
+        stats = self.client.get(reverse('extraction_cache_stats')).data
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 1, 1))
+
+    def test_different_bytes_miss(self):
+        for total in ('TOTAL $1.00', 'TOTAL $2.00'):
+            data = make_pdf_bytes(lines=('STORE', total))
+            self.client.post(reverse('upload_receipt'), {'file': make_upload(data=data)}, format='multipart')
+        self.assertEqual(len(extractor_calls), 2)
+
+    @override_settings(EXTRACTION_CACHE_MAX_ENTRIES=2)
+    def test_size_eviction_keeps_most_recent_entries(self):
+        for total in ('TOTAL $1.00', 'TOTAL $2.00', 'TOTAL $3.00'):
+            data = make_pdf_bytes(lines=('STORE', total))
+            self.client.post(reverse('upload_receipt'), {'file': make_upload(data=data)}, format='multipart')
+        self.assertEqual(ExtractionCacheEntry.objects.count(), 2)
+
+    @override_settings(EXTRACTION_CACHE_MAX_ENTRIES=5, EXTRACTION_CACHE_MAX_AGE=60, EXTRACTION_CACHE_EVICT_INTERVAL=3600)
+    def test_eviction_under_the_limit_only_counts(self):
+        for index in range(3):
+            ExtractionCacheEntry.objects.create(content_hash=f'{index:064x}', version='v', parsed_data={})
+        with mock.patch.object(cache, '_last_age_sweep', None):
+            with self.assertNumQueries(2): # Age sweep, then the count
+                cache.evict_expired()
+            with self.assertNumQueries(1): # Age sweep not due again yet
+                cache.evict_expired()
+        self.assertEqual(ExtractionCacheEntry.objects.count(), 3)
+
+
+class BatchUploadTests(MediaRootMixin, TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        jobs.shutdown_executor()
+        super().tearDownClass()
+
+    def test_multiple_files_get_per_file_manifest(self):
+        files = [make_upload('a.pdf'), make_upload('b.pdf'), make_upload('broken.pdf', b'junk'), make_upload('notes.txt', b'hi')]
+        response = self.client.post(reverse('batch_upload_receipt'), {'files': files}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['summary'], {'received': 4, 'stored': 3, 'valid': 2, 'rejected': 1})
+
+        by_name = {entry['file_name']: entry for entry in response.data['files']}
+        self.assertTrue(by_name['a.pdf']['is_valid'])
+        self.assertFalse(by_name['broken.pdf']['is_valid'])
+        self.assertEqual(by_name['notes.txt']['status'], 'rejected')
+        self.assertEqual(ReceiptFile.objects.count(), 3)
+        self.assertEqual(ReceiptFile.objects.get(id=by_name['b.pdf']['receipt_file_id']).file_name, 'b.pdf')
+
+    def test_zip_archive_entries_are_stored(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zf:
+            zf.writestr('scans/one.pdf', make_pdf_bytes())
+            zf.writestr('scans/two.pdf', make_pdf_bytes(pages=2))
+            zf.writestr('scans/readme.md', 'ignored')
+        archive = SimpleUploadedFile('scans.zip', buffer.getvalue(), content_type='application/zip')
+
+        response = self.client.post(reverse('batch_upload_receipt'), {'archive': archive}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['summary']['valid'], 2)
+        self.assertEqual(ReceiptFile.objects.filter(is_valid=True).count(), 2)
+
+    @override_settings(BATCH_UPLOAD_MAX_FILES=1)
+    def test_batch_limit(self):
+        response = self.client.post(reverse('batch_upload_receipt'), {'files': [make_upload('a.pdf'), make_upload('b.pdf')]}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ReceiptFile.objects.exists())
+
+
+class MetricsTests(MediaRootMixin, TestCase):
+    def test_upload_reports_stage_timings(self):
+        successes = metrics.requests_total.value('upload', 'success')
+        response = self.client.post(reverse('upload_receipt'), {'file': make_upload()}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+
+        stages = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['disk_write', 'validate', 'db', 'extraction', 'total']) # The fake extractor has no parse stage
+        self.assertEqual(metrics.requests_total.value('upload', 'success'), successes + 1)
+
+    def test_failures_are_counted_by_reason(self):
+        invalid = metrics.failures_total.value('upload', 'invalid_pdf')
+        response = self.client.post(reverse('upload_receipt'), {'file': make_upload(data=b'not a pdf')}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(metrics.failures_total.value('upload', 'invalid_pdf'), invalid + 1)
+
+        not_found = metrics.failures_total.value('process', 'not_found')
+        self.client.post(reverse('process_receipt'), {'receipt_file_id': 999})
+        self.assertEqual(metrics.failures_total.value('process', 'not_found'), not_found + 1)
+
+    def test_metrics_endpoint_uses_prometheus_text_format(self):
+        self.client.post(reverse('upload_receipt'), {'file': make_upload()}, format='multipart')
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE receipt_stage_duration_seconds histogram', body)
+        self.assertIn('receipt_stage_duration_seconds_bucket{view="upload",stage="extraction",le="+Inf"}', body)
+        self.assertRegex(body, r'receipt_requests_total\{view="upload",outcome="success"\} \d+')
+
+    def test_slow_requests_are_profiled(self):
+        profile_dir = os.path.join(self.media_root, 'profiles')
+        with override_settings(RECEIPT_PROFILE_SLOW_REQUESTS=True, RECEIPT_SLOW_REQUEST_SECONDS=0, RECEIPT_PROFILE_DIR=profile_dir, FAKE_EXTRACTION_LATENCY=0.1):
+            with self.assertLogs('receipts.profiling', 'WARNING'):
+                self.client.post(reverse('upload_receipt'), {'file': make_upload()}, format='multipart')
+        [profile] = os.listdir(profile_dir)
+        with open(os.path.join(profile_dir, profile)) as f:
+            self.assertIn('receipts.utils:fake_extract_details', f.read())
+
+
+@override_settings(RECEIPT_LIST_PAGE_SIZE=3)
+class ReceiptListViewTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_pages_cover_every_receipt_once_newest_first(self):
+        receipts = make_receipts(7)
+        # Force timestamp ties so the id tiebreaker is exercised
+        Receipt.objects.filter(id__in=[r.id for r in receipts[2:5]]).update(created_at=receipts[2].created_at)
+
+        seen, cursor = [], None
+        while True:
+            params = {'cursor': cursor} if cursor else {}
+            response = self.client.get(reverse('receipt_list'), params)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 3)
+            seen.extend(row['id'] for row in response.data['results'])
+            cursor = response.data['next_cursor']
+            if cursor is None:
+                break
+
+        expected = list(Receipt.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_parsed_text_is_deferred_unless_requested(self):
+        make_receipts(2)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('receipt_list'))
+        self.assertNotIn('parsed_text', response.data['results'][0])
+        self.assertIn('receipt_file_details', response.data['results'][0])
+        self.assertFalse(any('parsed_text' in query['sql'] for query in queries.captured_queries))
+
+        response = self.client.get(reverse('receipt_list'), {'fields': 'id,parsed_text'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'parsed_text'})
+
+    def test_projection_without_file_details_skips_join(self):
+        make_receipts(1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('receipt_list'), {'fields': 'id,merchant_name'})
+        self.assertEqual(response.data['results'], [{'id': Receipt.objects.get().id, 'merchant_name': 'Store 0'}])
+        self.assertFalse(any('JOIN' in query['sql'] for query in queries.captured_queries))
+
+    def test_filters_run_on_typed_columns(self):
+        cheap, mid, pricey = make_receipts(3)
+        Receipt.objects.filter(id=cheap.id).update(merchant_name='SHAKE SHACK', amount_minor=2064, currency='USD', purchased_at=datetime(2018, 12, 2, tzinfo=dt_timezone.utc))
+        Receipt.objects.filter(id=mid.id).update(merchant_name='SAFEWAY', amount_minor=903, currency='USD', purchased_at=datetime(2018, 7, 23, tzinfo=dt_timezone.utc))
+        Receipt.objects.filter(id=pricey.id).update(merchant_name='THE VENETIAN', amount_minor=217462, currency='USD', purchased_at=datetime(2018, 12, 2, 18, tzinfo=dt_timezone.utc))
+
+        def ids(**params):
+            response = self.client.get(reverse('receipt_list'), dict(params, fields='id', limit=10))
+            self.assertEqual(response.status_code, 200, response.data)
+            return {row['id'] for row in response.data['results']}
+
+        self.assertEqual(ids(min_amount='10', max_amount='1000'), {cheap.id})
+        self.assertEqual(ids(purchased_after='2018-12-01', purchased_before='2018-12-02'), {cheap.id, pricey.id})
+        self.assertEqual(ids(merchant='shack'), {cheap.id})
+        self.assertEqual(ids(currency='eur'), set())
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.client.get(reverse('receipt_list'), {'min_amount': 'lots'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('receipt_list'), {'purchased_after': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('receipt_list'), {'fields': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('receipt_list'), {'cursor': '!!'}).status_code, 400)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        caches[settings.RECEIPT_RESPONSE_CACHE].clear()
+
+    def test_unchanged_list_revalidates_with_304(self):
+        make_receipts(2)
+        response = self.client.get(reverse('receipt_list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertIn('Last-Modified', response)
+
+        with CaptureQueriesContext(connection) as queries:
+            revalidated = self.client.get(reverse('receipt_list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated['ETag'], response['ETag'])
+        self.assertEqual(len(queries.captured_queries), 3) # The fingerprint aggregates only (receipts, tombstones, files)
+
+        self.assertEqual(self.client.get(reverse('receipt_list'), HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+    def test_delete_moves_last_modified(self):
+        first, _ = make_receipts(2)
+        long_ago = datetime(2020, 1, 1, tzinfo=dt_timezone.utc) # Last-Modified has one-second resolution
+        Receipt.objects.update(updated_at=long_ago)
+        ReceiptFile.objects.update(updated_at=long_ago)
+        last_modified = self.client.get(reverse('receipt_list'))['Last-Modified']
+        first.delete()
+        response = self.client.get(reverse('receipt_list'), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_etag_changes_with_the_data(self):
+        first, _ = make_receipts(2)
+        etag = self.client.get(reverse('receipt_list'))['ETag']
+
+        first.merchant_name = 'Renamed'
+        first.save()
+        response = self.client.get(reverse('receipt_list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('Renamed', [row['merchant_name'] for row in response.data['results']])
+
+        etag = response['ETag']
+        make_receipts(1)
+        self.assertEqual(self.client.get(reverse('receipt_list'), HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # ETags are per URL, so another page or projection never matches
+        self.assertEqual(self.client.get(reverse('receipt_list'), {'limit': 1}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_repeat_request_is_served_from_the_cache(self):
+        make_receipts(3)
+        url = reverse('receipt_list')
+        first = self.client.get(url, {'fields': 'id,merchant_name,items'})
+        later = datetime(2030, 1, 1, tzinfo=dt_timezone.utc)
+        with CaptureQueriesContext(connection) as queries, mock.patch('receipts.views.timezone.now', return_value=later):
+            second = self.client.get(url, {'fields': 'id,merchant_name,items'})
+        self.assertEqual(second.data['results'], first.data['results'])
+        self.assertEqual(len(queries.captured_queries), 2) # Fingerprint only; no page or items query
+        # The change feed cursor isn't cached with the page: it is issued for this request
+        self.assertEqual(decode_change_cursor(second.data['changes_cursor']), (decode_change_cursor(first.data['changes_cursor'])[0], later))
+
+        with override_settings(RECEIPT_RESPONSE_CACHE=None):
+            with CaptureQueriesContext(connection) as queries:
+                uncached = self.client.get(url, {'fields': 'id,merchant_name,items'})
+        self.assertEqual(uncached.data, first.data)
+        self.assertGreater(len(queries.captured_queries), 1)
+
+    def test_detail_conditional_get(self):
+        receipt = make_receipts(1)[0]
+        url = reverse('receipt_detail', args=[receipt.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        receipt.receipt_file.file_name = 'renamed.pdf'
+        receipt.receipt_file.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['receipt_file_details']['file_name'], 'renamed.pdf')
+
+        self.assertEqual(self.client.get(reverse('receipt_detail', args=[receipt.id + 1])).status_code, 404)
+
+
+@override_settings(RECEIPT_EXPORT_CHUNK_SIZE=2)
+class ReceiptExportTests(TestCase):
+    def setUp(self):
+        self.receipts = make_receipts(5, currency='USD')
+        for i, receipt in enumerate(self.receipts):
+            receipt.purchased_at = datetime(2025, 7, 1 + i, 12, tzinfo=dt_timezone.utc)
+            receipt.amount_minor = i * 100 + 99
+            receipt.save()
+
+    def export(self, **params):
+        response = self.client.get(reverse('receipt_export'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode('utf-8')
+
+    def test_csv_streams_every_receipt_in_id_order(self):
+        response, body = self.export()
+        self.assertTrue(response['Content-Type'].startswith('text/csv'))
+        self.assertIn('attachment; filename="receipts-', response['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(body)))
+        self.assertEqual([int(row['id']) for row in rows], [receipt.id for receipt in self.receipts])
+        self.assertEqual(rows[0]['file_name'], 'receipt_0.pdf')
+        self.assertEqual(rows[0]['purchased_at'], '2025-07-01T12:00:00Z')
+        self.assertEqual(rows[2]['amount_minor'], '299')
+
+    def test_ndjson_with_date_filters(self):
+        response, body = self.export(format='ndjson', purchased_after='2025-07-02', purchased_before='2025-07-04')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([row['merchant_name'] for row in rows], ['Store 1', 'Store 2', 'Store 3'])
+        self.assertEqual(rows[0]['currency'], 'USD')
+        self.assertEqual(rows[0]['amount_minor'], 199)
+
+    def test_reads_the_table_in_chunks(self):
+        with CaptureQueriesContext(connection) as queries:
+            _, body = self.export(format='ndjson')
+        self.assertEqual(len(body.splitlines()), 5)
+        self.assertEqual(len([q for q in queries.captured_queries if 'receipts_receipt' in q['sql']]), 1)
+
+    def test_bad_requests(self):
+        response = self.client.get(reverse('receipt_export'), {'format': 'xlsx'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('format', response.json()['error'])
+        response = self.client.get(reverse('receipt_export'), {'purchased_after': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_parquet_without_pyarrow(self):
+        with mock.patch.dict(sys.modules, {'pyarrow': None}):
+            response = self.client.get(reverse('receipt_export'), {'format': 'parquet'})
+        self.assertEqual(response.status_code, 501)
+        self.assertIn('pyarrow', response.json()['error'])
+
+class ThumbnailTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        thumbnails.reset_thumbnail_stats()
+
+    def upload(self, data=None):
+        response = self.client.post(reverse('upload_receipt'), {'file': make_upload(data=data)}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        return Receipt.objects.select_related('receipt_file').latest('id')
+
+    def test_rendered_once_and_cached_by_content_hash(self):
+        data = make_pdf_bytes()
+        receipt = self.upload(data)
+        url = reverse('receipt_thumbnail', args=[receipt.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'\x89PNG'))
+        response.close()
+        self.assertTrue(os.path.exists(thumbnails.thumbnail_path(receipt.receipt_file.content_hash)))
+
+        duplicate = self.upload(data) # Same bytes, same thumbnail
+        self.client.get(reverse('receipt_thumbnail', args=[duplicate.id])).close()
+        self.assertEqual(thumbnails.get_thumbnail_stats(), {'hits': 1, 'rendered': 1})
+
+        not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(thumbnails.get_thumbnail_stats()['hits'], 1) # Answered without touching the file
+
+    def test_list_includes_versioned_thumbnail_url(self):
+        receipt = self.upload()
+        result = self.client.get(reverse('receipt_list'), {'fields': 'id,thumbnail_url'}).json()['results'][0]
+        self.assertEqual(result['thumbnail_url'], f"/api/receipts/{receipt.id}/thumbnail/?v={receipt.receipt_file.content_hash[:16]}-320-png")
+
+    def test_missing_receipt(self):
+        self.assertEqual(self.client.get(reverse('receipt_thumbnail', args=[999])).status_code, 404)
+
+    def test_render_thumbnails_command(self):
+        data = make_pdf_bytes()
+        first = self.upload(data)
+        self.upload(data)
+        self.upload(make_pdf_bytes(lines=("OTHER STORE", "TOTAL $1.00")))
+        ReceiptFile.objects.filter(id=first.receipt_file_id).update(content_hash=None) # Stored before hashes were kept
+
+        output = io.StringIO()
+        call_command('render_thumbnails', workers=1, stdout=output)
+        self.assertIn('Rendered 2 thumbnails; 1 were already cached, 0 failed.', output.getvalue())
+        self.assertEqual(ReceiptFile.objects.get(id=first.receipt_file_id).content_hash, first.receipt_file.content_hash)
+
+        output = io.StringIO()
+        call_command('render_thumbnails', workers=1, stdout=output)
+        self.assertIn('Rendered 0 thumbnails; 3 were already cached', output.getvalue())
+
+class ReceiptChangesTests(TestCase):
+    def changes(self, since=None, **params):
+        if since:
+            params['since'] = since
+        response = self.client.get(reverse('receipt_changes'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_sync_then_deltas_and_tombstones(self):
+        receipts = make_receipts(3)
+        first = self.changes()
+        self.assertEqual([row['id'] for row in first['results']], [receipt.id for receipt in receipts])
+        self.assertEqual((first['deleted'], first['has_more']), ([], False))
+        self.assertEqual(self.changes(first['next_cursor'])['results'], [])
+
+        receipts[0].merchant_name = 'Renamed'
+        receipts[0].save()
+        deleted_id = receipts[1].id
+        receipts[1].delete()
+        delta = self.changes(first['next_cursor'])
+        self.assertEqual([(row['id'], row['merchant_name']) for row in delta['results']], [(receipts[0].id, 'Renamed')])
+        self.assertEqual(delta['deleted'], [deleted_id])
+        self.assertEqual(ReceiptTombstone.objects.get().receipt_id, deleted_id)
+
+    def test_file_changes_and_paging(self):
+        receipts = make_receipts(3)
+        cursor = self.changes()['next_cursor']
+        receipts[2].receipt_file.file_name = 'renamed.pdf'
+        receipts[2].receipt_file.save()
+        receipts[0].save()
+
+        page = self.changes(cursor, limit=1, fields='id,receipt_file_details')
+        self.assertEqual([row['id'] for row in page['results']], [receipts[2].id])
+        self.assertEqual(page['results'][0]['receipt_file_details']['file_name'], 'renamed.pdf')
+        self.assertTrue(page['has_more'])
+        page = self.changes(page['next_cursor'], limit=1)
+        self.assertEqual(([row['id'] for row in page['results']], page['has_more']), ([receipts[0].id], False))
+
+    def test_paging_through_receipts_changed_together(self):
+        receipt_file = ReceiptFile.objects.create(file_name='stack.pdf', file_path='stack.pdf', is_processed=True)
+        receipts = [Receipt.objects.create(receipt_file=receipt_file, first_page=page, last_page=page) for page in range(1, 9)]
+        cursor = self.changes()['next_cursor']
+        receipt_file.save() # Moves all eight in the feed at once
+
+        seen = []
+        while True:
+            page = self.changes(cursor, limit=5, fields='id')
+            seen += [row['id'] for row in page['results']]
+            cursor = page['next_cursor']
+            if not page['has_more']:
+                break
+        self.assertEqual(seen, [receipt.id for receipt in receipts])
+
+    def test_numbered_in_the_row_write(self):
+        receipt_file = ReceiptFile.objects.create(file_name='a.pdf', file_path='a.pdf')
+        with CaptureQueriesContext(connection) as queries:
+            receipt = Receipt.objects.create(receipt_file=receipt_file, merchant_name='Shop')
+            receipt_file.save(update_fields=['is_processed', 'updated_at'])
+            receipt.save()
+        writes = [
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith(('INSERT INTO "receipts_receipt"', 'UPDATE "receipts_receipt"'))
+        ]
+        self.assertEqual(len(writes), 3) # One statement per save; the file save marks its receipt
+        self.assertTrue(all('SELECT U0."change_seq"' in sql for sql in writes))
+        self.assertEqual((receipt.change_seq, Receipt.objects.get().change_seq), (3, 3))
+
+        other = ReceiptFile.objects.create(file_name='b.pdf', file_path='b.pdf')
+        with CaptureQueriesContext(connection) as queries:
+            other.save(update_fields=['is_valid', 'invalid_reason', 'updated_at']) # No receipt to mark
+        self.assertFalse([query for query in queries.captured_queries if query['sql'].startswith('UPDATE "receipts_receipt"')])
+
+    def test_list_gives_a_starting_cursor(self):
+        make_receipts(2)
+        listing = self.client.get(reverse('receipt_list')).json()
+        created = make_receipts(1)[0]
+        self.assertEqual([row['id'] for row in self.changes(listing['changes_cursor'])['results']], [created.id])
+
+    def test_bad_and_expired_cursors(self):
+        self.assertEqual(self.client.get(reverse('receipt_changes'), {'since': 'nope'}).status_code, 400)
+        expired = encode_change_cursor(0, datetime(2020, 1, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(self.client.get(reverse('receipt_changes'), {'since': expired}).status_code, 410)
+
+@override_settings(RECEIPT_FALLBACK_EXTRACTOR='receipts.tests.counting_extractor')
+class ReceiptSplitTests(MediaRootMixin, TestCase):
+    extractor = 'local'
+    stack = [
+        ('ACME Hardware', 'Date: 03/14/2024', 'Hammer 12.99'), # Continues on the next page
+        ('Nails 4.50', 'TOTAL $17.49'),
+        (),
+        ('Corner Bakery', 'Date: 03/15/2024', 'Bread 3.20', 'TOTAL $3.20'),
+        ('Night Pharmacy', 'Date: 03/16/2024', 'Aspirin 6.10', 'TOTAL $6.10'),
+    ]
+
+    def upload(self, data, **params):
+        return self.client.post(reverse('upload_receipt'), {'file': make_upload(data=data), **params}, format='multipart')
+
+    def test_find_receipt_pages(self):
+        from .segments import find_receipt_pages
+        with fitz.open(stream=make_multi_receipt_pdf(self.stack), filetype='pdf') as doc:
+            self.assertEqual(find_receipt_pages(doc, 'auto'), [(0, 1), (3, 3), (4, 4)])
+            self.assertEqual(find_receipt_pages(doc, 'pages'), [(0, 0), (1, 1), (3, 3), (4, 4)])
+
+    def test_upload_creates_a_receipt_per_segment(self):
+        response = self.upload(make_multi_receipt_pdf(self.stack), split='auto')
+        self.assertEqual(response.status_code, 201)
+        found = [(r['merchant_name'], r['total_amount'], r['first_page'], r['last_page']) for r in response.data['extracted_receipts']]
+        self.assertEqual(found, [
+            ('ACME Hardware', '$17.49', 1, 2), ('Corner Bakery', '$3.20', 4, 4), ('Night Pharmacy', '$6.10', 5, 5),
+        ])
+        self.assertEqual(response.data['extracted_receipt']['first_page'], 1)
+        receipt_file = ReceiptFile.objects.get()
+        self.assertEqual((receipt_file.split_mode, receipt_file.extracted_receipts.count()), ('auto', 3))
+
+        last = Receipt.objects.get(first_page=5)
+        detail = self.client.get(reverse('receipt_detail', args=[last.id])).json()
+        self.assertIn('-p5-320-png', detail['thumbnail_url']) # The receipt's own page
+
+        # Extracting again without splitting replaces the three receipts with one for the whole file
+        receipt_file.split_mode = 'off'
+        extract_and_save(receipt_file)
+        self.assertEqual(list(receipt_file.extracted_receipts.values_list('first_page', 'merchant_name')), [(None, 'ACME Hardware')])
+
+    @override_settings(RECEIPT_EXTRACTOR='receipts.tests.barrier_extractor', RECEIPT_SPLIT_MODE='pages')
+    def test_segments_are_extracted_concurrently(self):
+        split_barrier.reset()
+        response = self.upload(make_multi_receipt_pdf([('Page one',), ('Page two',), ('Page three',)]))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['extracted_receipts']), 3)
+
+    def test_single_receipt_is_not_split(self):
+        response = self.upload(make_pdf_bytes(lines=self.stack[3]), split='auto')
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(Receipt.objects.get().first_page)
+
+    def test_one_whole_file_receipt_per_file(self):
+        receipt_file = ReceiptFile.objects.create(file_name='a.pdf', file_path='a.pdf')
+        Receipt.objects.create(receipt_file=receipt_file)
+        Receipt.objects.create(receipt_file=receipt_file, first_page=1, last_page=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Receipt.objects.create(receipt_file=receipt_file)
+
+    def test_unknown_split_mode(self):
+        response = self.upload(make_pdf_bytes(), split='sideways')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ReceiptFile.objects.exists())
+
+def make_rescan(data, dpi=150, offset=(20, 30), scale=0.95):
+    """The first page of a PDF printed and scanned again: a JPEG with no text layer, shifted and shrunk."""
+    with fitz.open(stream=data, filetype='pdf') as doc:
+        image = doc[0].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False).tobytes('jpeg', jpg_quality=70)
+        width, height = doc[0].rect.width, doc[0].rect.height
+    with fitz.open() as doc:
+        x, y = offset
+        doc.new_page(width=width, height=height).insert_image(fitz.Rect(x, y, x + width * scale, y + height * scale), stream=image)
+        return doc.tobytes()
+
+
+class NearDuplicateTests(MediaRootMixin, TestCase):
+    extractor = 'receipts.tests.counting_extractor'
+    lines = ('CORNER BAKERY', '2025-03-15', 'Sourdough loaf 4.50', 'Croissant x2 5.00', 'TOTAL $9.50')
+
+    def setUp(self):
+        super().setUp()
+        from . import near_duplicates
+        near_duplicates.reset_index()
+        near_duplicates.reset_near_duplicate_stats()
+        extractor_calls.clear()
+
+    def upload(self, data):
+        return self.client.post(reverse('upload_receipt'), {'file': make_upload(data=data)}, format='multipart')
+
+    def test_hash_is_stable_across_rescans(self):
+        from .near_duplicates import perceptual_hash, hamming_distance
+        original = make_pdf_bytes(lines=self.lines)
+        other = make_pdf_bytes(lines=('Night Pharmacy', 'Aspirin 6.10', 'Plasters 2.00', 'Tax 0.81', 'Total 8.91', 'Thank you'))
+        value = int(perceptual_hash(original), 16)
+        for rescan in (make_rescan(original), make_rescan(original, dpi=100, offset=(50, 5), scale=0.8)):
+            self.assertLessEqual(hamming_distance(value, int(perceptual_hash(rescan), 16)), settings.RECEIPT_NEAR_DUPLICATE_MAX_DISTANCE)
+        self.assertGreater(hamming_distance(value, int(perceptual_hash(other), 16)), settings.RECEIPT_NEAR_DUPLICATE_MAX_DISTANCE)
+
+    def test_multi_index_search_matches_brute_force(self):
+        import random
+        from .near_duplicates import MultiIndexHash, hamming_distance
+        rng = random.Random(7)
+        base, table, values = rng.getrandbits(256), MultiIndexHash(256, 16), []
+        for i in range(2000):
+            if i % 2:
+                value = rng.getrandbits(256)
+            else: # Half of them near base, so there is something to find
+                value = base ^ sum(1 << bit for bit in rng.sample(range(256), rng.randrange(30)))
+            values.append(value)
+            table.add(value, i)
+        self.assertEqual(len(table), 2000)
+        query = base ^ 0b1011
+        expected = sorted((hamming_distance(query, value), i) for i, value in enumerate(values) if hamming_distance(query, value) <= 20)
+        self.assertEqual(sorted(table.search(query, 20)), expected)
+        self.assertGreater(len(expected), 10)
+
+    def test_index_follows_the_change_feed(self):
+        from .near_duplicates import MultiIndexHash, _index
+        table = MultiIndexHash(256, 16)
+        table.add(0b1111, 'a')
+        table.add(1 << 200, 'a') # Recomputed hash
+        self.assertEqual((table.search(1 << 200, 0), table.search(0b1111, 3)), ([(0, 'a')], []))
+
+        _index.search(0, 0) # Loaded, empty
+        # Committed after a newer write started: its updated_at is older than anything indexed since
+        receipt_file = ReceiptFile.objects.create(file_name='a.pdf', file_path='a.pdf', is_processed=True, perceptual_hash='f' * 64)
+        ReceiptFile.objects.filter(pk=receipt_file.pk).update(updated_at=datetime(2020, 1, 1, tzinfo=dt_timezone.utc))
+        Receipt.objects.create(receipt_file=receipt_file)
+        self.assertEqual(_index.search(2 ** 256 - 1, 0), [(0, receipt_file.pk)])
+
+    @override_settings(RECEIPT_NEAR_DUPLICATE_DETECTION=True)
+    def test_rescan_reuses_the_extraction(self):
+        original = make_pdf_bytes(lines=self.lines)
+        first = self.upload(original)
+        self.assertEqual(first.status_code, 201)
+        cursor = self.client.get(reverse('receipt_list'), {'duplicates': 'exclude'}).json()['changes_cursor'] # Cached until a receipt changes
+        second = self.upload(make_rescan(original))
+        self.assertEqual(second.status_code, 201)
+
+        self.assertEqual(len(extractor_calls), 1) # The rescan didn't reach the model
+        self.assertEqual(second.data['receipt_file']['duplicate_of'], first.data['receipt_file']['id'])
+        copy = Receipt.objects.get(id=second.data['extracted_receipt']['id'])
+        self.assertEqual(copy.merchant_name, first.data['extracted_receipt']['merchant_name'])
+        self.assertEqual(copy.parsed_text, Receipt.objects.get(id=first.data['extracted_receipt']['id']).parsed_text)
+
+        listed = self.client.get(reverse('receipt_list'), {'duplicates': 'exclude'}).json()['results']
+        self.assertEqual([r['id'] for r in listed], [first.data['extracted_receipt']['id']])
+        listed = self.client.get(reverse('receipt_list'), {'duplicates': 'only'}).json()['results']
+        self.assertEqual([r['id'] for r in listed], [copy.id])
+        self.assertEqual(self.client.get(reverse('receipt_list'), {'duplicates': 'maybe'}).status_code, 400)
+        changes = self.client.get(reverse('receipt_changes'), {'since': cursor}).json()['results']
+        self.assertEqual([r['receipt_file_details']['duplicate_of'] for r in changes], [first.data['receipt_file']['id']])
+        stats = self.client.get(reverse('extraction_stats')).json()['near_duplicates']
+        self.assertEqual((stats['lookups'], stats['matches'], stats['indexed']), (2, 1, 1))
+
+    @override_settings(RECEIPT_NEAR_DUPLICATE_DETECTION=True)
+    def test_flagged_before_the_copies_are_saved(self):
+        original = make_pdf_bytes(lines=self.lines)
+        first = self.upload(original)
+        seen = []
+
+        def record(sender, instance, **kwargs): # What a reader would see when the copy's save invalidates caches
+            seen.append(ReceiptFile.objects.get(pk=instance.receipt_file_id).duplicate_of_id)
+        post_save.connect(record, sender=Receipt)
+        try:
+            self.upload(make_rescan(original))
+        finally:
+            post_save.disconnect(record, sender=Receipt)
+        self.assertEqual(seen, [first.data['receipt_file']['id']])
+
+    @override_settings(RECEIPT_NEAR_DUPLICATE_DETECTION=True)
+    def test_same_layout_with_different_text_is_extracted(self):
+        self.upload(make_pdf_bytes(lines=self.lines))
+        response = self.upload(make_pdf_bytes(lines=self.lines[:-1] + ('TOTAL $9.60',)))
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(response.data['receipt_file']['duplicate_of'])
+        self.assertEqual(len(extractor_calls), 2)
+        from .near_duplicates import get_near_duplicate_stats
+        self.assertEqual(get_near_duplicate_stats()['rejected'], 1)
+
+    def test_hash_command_makes_earlier_uploads_findable(self):
+        original = make_pdf_bytes(lines=self.lines)
+        first = self.upload(original) # Uploaded before detection was turned on
+        self.assertIsNone(ReceiptFile.objects.get().perceptual_hash)
+        call_command('hash_receipt_files', workers=1, stdout=io.StringIO())
+        self.assertEqual(len(ReceiptFile.objects.get().perceptual_hash), 64)
+
+        with override_settings(RECEIPT_NEAR_DUPLICATE_DETECTION=True):
+            second = self.upload(make_rescan(original, dpi=100, offset=(50, 5), scale=0.8))
+        self.assertEqual(second.data['receipt_file']['duplicate_of'], first.data['receipt_file']['id'])
+        self.assertEqual(len(extractor_calls), 1)
+
+class FakeGeminiResponse:
+    def __init__(self, text):
+        self.text = text
+
+    def resolve(self):
+        pass
+
+class FakeBatchClient:
+    """
+    Stands in for the Gemini client. Answers single requests with the merchant
+    the document's bytes were registered under, and batched requests with a JSON
+    array, except that documents listed in `broken` get no usable answer.
+    """
+
+    def __init__(self, merchants, broken=()):
+        self.merchants, self.broken = merchants, broken
+        self.requests = [] # Documents per request
+        self.lock = threading.Lock()
+
+    def answer(self, data):
+        return {'merchant_name': self.merchants[data], 'purchase_date': '2025-07-29', 'total_amount': '$5.00'}
+
+    def call(self, contents):
+        documents = [part['inline_data']['data'] for part in contents if 'inline_data' in part]
+        with self.lock:
+            self.requests.append(len(documents))
+        if len(documents) == 1:
+            return FakeGeminiResponse(json.dumps(self.answer(documents[0])))
+        answers = []
+        for index, data in enumerate(documents):
+            answer = dict(self.answer(data), document=index)
+            if self.merchants[data] in self.broken:
+                if index % 2:
+                    continue # Left out of the array
+                answer['purchase_date'] = 20250729 # Not a date string
+            answers.append(answer)
+        return FakeGeminiResponse('```json\n' + json.dumps(answers) + '\n```')
+
+    async def acall(self, contents):
+        return self.call(contents)
+
+
+@override_settings(PDF_PREPROCESS_ENABLED=False, GEMINI_BATCH_MAX_ITEMS=4, GEMINI_BATCH_MAX_WAIT_MS=5000)
+class RequestBatchingTests(TestCase):
+    def setUp(self):
+        batching.reset_batching_stats()
+        self.documents = {make_pdf_bytes(lines=(f'Shop {i}', 'TOTAL $5.00')): f'Shop {i}' for i in range(4)}
+
+    def extract_concurrently(self, client):
+        results = {}
+
+        def extract(data):
+            results[data] = utils.extract_details_with_gemini_batched(None, data)
+
+        with mock.patch('receipts.utils.get_gemini_client', return_value=client), mock.patch('receipts.utils._gemini_batcher', None):
+            threads = [threading.Thread(target=extract, args=(data,)) for data in self.documents]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=10)
+        return results
+
+    def test_batcher_sends_full_batches_and_flushes_stragglers(self):
+        sizes = []
+
+        def send(items):
+            sizes.append(len(items))
+            return [item * 2 for item in items]
+
+        batcher = batching.RequestBatcher(send, max_items=3, max_wait=0.05)
+        futures = [batcher.submit(item) for item in (1, 2, 3, 4)]
+        self.assertEqual([future.result(timeout=5) for future in futures], [2, 4, 6, 8])
+        self.assertEqual(sizes, [3, 1]) # The fourth went out on its own after max_wait
+
+        failing = batching.RequestBatcher(lambda items: 1 / 0, max_items=2, max_wait=5)
+        futures = [failing.submit(item) for item in (1, 2)]
+        for future in futures:
+            with self.assertRaises(ZeroDivisionError):
+                future.result(timeout=5)
+
+    def test_concurrent_receipts_share_one_request(self):
+        client = FakeBatchClient(self.documents)
+        results = self.extract_concurrently(client)
+        self.assertEqual(client.requests, [4])
+        for data, merchant in self.documents.items():
+            parsed_data, raw_response = results[data]
+            self.assertEqual(parsed_data['merchant_name'], merchant)
+            self.assertEqual(parsed_data['payload_size'], len(data))
+            self.assertNotIn('"document"', raw_response) # Stored like a single-receipt answer
+        self.assertEqual(batching.get_batching_stats(), {'requests': 1, 'documents': 4, 'retried': 0, 'documents_per_request': 4.0})
+
+    def test_unparsable_answers_are_retried_alone(self):
+        client = FakeBatchClient(self.documents, broken={'Shop 1', 'Shop 2'})
+        results = self.extract_concurrently(client)
+        self.assertEqual(sorted(client.requests), [1, 1, 4])
+        self.assertEqual(sorted(parsed_data['merchant_name'] for parsed_data, _ in results.values()), ['Shop 0', 'Shop 1', 'Shop 2', 'Shop 3'])
+        self.assertEqual(batching.get_batching_stats()['retried'], 2)
+
+    @override_settings(GEMINI_BATCH_MAX_ITEMS=2)
+    def test_async_callers_are_batched(self):
+        client = FakeBatchClient(self.documents)
+        documents = list(self.documents)[:2]
+
+        async def extract_both():
+            return await asyncio.gather(*(utils.aextract_details_with_gemini_batched(None, data) for data in documents))
+
+        with mock.patch('receipts.utils.get_gemini_client', return_value=client), mock.patch('receipts.utils._gemini_batcher', None):
+            results = asyncio.run(extract_both())
+        self.assertEqual([parsed_data['merchant_name'] for parsed_data, _ in results], ['Shop 0', 'Shop 1'])
+        self.assertEqual(client.requests, [2])
+
+class ParseAmountTests(TestCase):
+    def test_display_strings(self):
+        self.assertEqual(parse_amount('$123.45'), (12345, 'USD'))
+        self.assertEqual(parse_amount('$2,174.62'), (217462, 'USD'))
+        self.assertEqual(parse_amount('EUR 1.234,56'), (123456, 'EUR'))
+        self.assertEqual(parse_amount('¥1200'), (1200, 'JPY'))
+        self.assertEqual(parse_amount('-$5.00'), (-500, 'USD'))
+
+    def test_numbers_and_garbage(self):
+        self.assertEqual(parse_amount(20.64), (2064, None))
+        self.assertEqual(parse_amount('n/a'), (None, None))
+        self.assertEqual(parse_amount(None), (None, None))
+
+
+@override_settings(RECEIPT_FALLBACK_EXTRACTOR='receipts.tests.counting_extractor', LOCAL_EXTRACTION_CONFIDENCE_THRESHOLD=0.8)
+class LocalExtractionTests(MediaRootMixin, TestCase):
+    extractor = 'local'
+    clean_receipt = ('ACME Hardware', '123 Main St', 'Date: 03/14/2024', 'Hammer 12.99', 'Nails 4.50', 'Subtotal 17.49', 'Tax 1.40', 'TOTAL $18.89')
+
+    def setUp(self):
+        super().setUp()
+        extractor_calls.clear()
+        local_extraction.reset_path_stats()
+
+    def test_parse_receipt_text(self):
+        fields, confidence = local_extraction.parse_receipt_text("\n".join(self.clean_receipt))
+        self.assertEqual(fields['merchant_name'], 'ACME Hardware')
+        self.assertEqual(fields['purchased_at'], datetime(2024, 3, 14))
+        self.assertEqual(fields['total_amount'], '$18.89')
+        self.assertEqual([item['description'] for item in fields['items']], ['Hammer', 'Nails'])
+        self.assertEqual(confidence, 1.0)
+
+    def test_text_layer_receipt_skips_fallback(self):
+        upload = make_upload(data=make_pdf_bytes(lines=self.clean_receipt))
+        response = self.client.post(reverse('upload_receipt'), {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(extractor_calls, [])
+        receipt = Receipt.objects.get()
+        self.assertEqual((receipt.merchant_name, receipt.amount_minor), ('ACME Hardware', 1889))
+        self.assertIn('"source": "text_layer"', receipt.parsed_text)
+        self.assertEqual(local_extraction.get_path_stats()['local'], 1)
+
+    def test_low_confidence_escalates(self):
+        upload = make_upload(data=make_pdf_bytes(lines=('something unreadable', 'no totals here')))
+        self.client.post(reverse('upload_receipt'), {'file': upload}, format='multipart')
+        self.assertEqual(len(extractor_calls), 1)
+        self.assertEqual(Receipt.objects.get().merchant_name, 'Fake Merchant')
+        stats = self.client.get(reverse('extraction_stats')).data['paths']
+        self.assertEqual((stats['local'], stats['fallback']), (0, 1))
+
+
+def make_scanned_pdf_bytes(dpi=300, blank_pages=0, duplicate_pages=0):
+    """A PDF whose first page is one high-resolution image, like a phone scan."""
+    width, height = 612 * dpi // 72, 792 * dpi // 72
+    samples = bytearray(b'\xf0' * (width * height))
+    for top in range(200, height - 200, 40): # Dark bars standing in for lines of text
+        for y in range(top, top + 12):
+            samples[y * width + 200:y * width + width - 200] = b'\x20' * (width - 400)
+    image = fitz.Pixmap(fitz.csGRAY, width, height, bytes(samples), False).tobytes('jpeg', jpg_quality=95)
+    blank = fitz.Pixmap(fitz.csGRAY, 100, 130, b'\xf8' * 13000, False).tobytes('png')
+    doc = fitz.open()
+    for page_image in [image] + [blank] * blank_pages + [image] * duplicate_pages:
+        doc.new_page().insert_image(fitz.Rect(0, 0, 612, 792), stream=page_image)
+    data = doc.tobytes(garbage=4)
+    doc.close()
+    return data
+
+
+class PreprocessTests(TestCase):
+    def test_scans_are_downsampled_and_blank_and_repeated_pages_dropped(self):
+        data = make_scanned_pdf_bytes(blank_pages=1, duplicate_pages=1)
+        payload = preprocess.shrink_pdf(data, target_dpi=100)
+        self.assertEqual(payload.mime_type, 'application/pdf')
+        self.assertEqual((payload.pages_dropped, payload.images_resampled), (2, 1))
+        self.assertLess(len(payload.data), len(data) / 2)
+        with fitz.open(stream=payload.data, filetype='pdf') as doc:
+            self.assertEqual(doc.page_count, 1)
+            self.assertEqual(doc[0].get_images()[0][2], 850) # 612pt wide at 100 DPI
+
+    def test_text_pdfs_are_sent_unchanged_unless_pages_repeat(self):
+        data = make_pdf_bytes()
+        self.assertIs(preprocess.shrink_pdf(data).data, data)
+
+        payload = preprocess.shrink_pdf(make_pdf_bytes(pages=2))
+        self.assertEqual(payload.pages_dropped, 1)
+        with fitz.open(stream=payload.data, filetype='pdf') as doc:
+            self.assertEqual(doc[0].get_text().split(), ['TEST', 'STORE', '2025-07-29', 'TOTAL', '$12.34'])
+
+    def test_rasterize_sends_one_jpeg(self):
+        payload = preprocess.shrink_pdf(make_scanned_pdf_bytes(duplicate_pages=1), target_dpi=72, rasterize=True)
+        self.assertEqual(payload.mime_type, 'image/jpeg')
+        self.assertTrue(payload.data.startswith(b'\xff\xd8'))
+        self.assertEqual(payload.pages_dropped, 1)
+
+    def test_gemini_payload_is_preprocessed_and_its_size_recorded(self):
+        sent = []
+
+        class FakeResponse:
+            text = '{"merchant_name": "Scan Mart", "purchase_date": "2025-07-29", "total_amount": "$5.00"}'
+
+            def resolve(self):
+                pass
+
+        class FakeClient:
+            def call(self, contents):
+                sent.append(contents[0]['inline_data'])
+                return FakeResponse()
+
+        data = make_scanned_pdf_bytes(blank_pages=1)
+        preprocess.reset_preprocess_stats()
+        with mock.patch('receipts.utils.get_gemini_client', return_value=FakeClient()):
+            parsed_data, _ = utils.extract_details_with_gemini(None, data)
+        self.assertEqual(parsed_data['merchant_name'], 'Scan Mart')
+        self.assertEqual(parsed_data['payload_size'], len(sent[0]['data']))
+        self.assertLess(parsed_data['payload_size'], len(data))
+        self.assertEqual(preprocess.get_preprocess_stats()['bytes_saved'], len(data) - parsed_data['payload_size'])
+
+        with override_settings(PDF_PREPROCESS_ENABLED=False), mock.patch('receipts.utils.get_gemini_client', return_value=FakeClient()):
+            utils.extract_details_with_gemini(None, data)
+        self.assertEqual(sent[1]['data'], data)
+
+        # A mapped file is preprocessed in place, and copied only when it is sent unchanged
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as f:
+            f.write(data)
+            f.flush()
+            with open_mapped(f.name) as mapped, mock.patch('receipts.utils.get_gemini_client', return_value=FakeClient()):
+                utils.extract_details_with_gemini(None, mapped)
+                with override_settings(PDF_PREPROCESS_ENABLED=False):
+                    utils.extract_details_with_gemini(None, mapped)
+        self.assertLess(len(sent[2]['data']), len(data)) # The shrunk copy, not the mapped original
+        self.assertEqual((type(sent[3]['data']), sent[3]['data']), (bytes, data))
+
+
+class IngestTests(TestCase):
+    def test_quick_validate_pdf(self):
+        self.assertEqual(quick_validate_pdf(make_pdf_bytes(pages=3)), (True, None))
+        self.assertEqual(quick_validate_pdf(b''), (False, "File is empty or corrupted."))
+        self.assertEqual(quick_validate_pdf(b'hello world'), (False, "Invalid PDF file structure or format."))
+
+    def test_quick_validate_falls_back_for_truncated_trailer(self):
+        # Without startxref/%%EOF PyMuPDF decides on the same buffer (it can repair the xref)
+        data = make_pdf_bytes()
+        self.assertEqual(quick_validate_pdf(data[:data.rindex(b'startxref')]), (True, None))
+        self.assertFalse(quick_validate_pdf(b'%PDF-1.7\n garbage')[0])
+
+    def test_quick_validate_checks_an_empty_page_tree_with_pymupdf(self):
+        data = make_pdf_bytes()
+        empty = data.replace(b'/Count 1/Kids[4 0 R]', b'/Count 0/Kids[]     ') # Same length, so the xref stays valid
+        self.assertNotEqual(empty, data)
+        self.assertFalse(quick_validate_pdf(empty)[0])
+
+    def test_stream_to_disk_enforces_limit_and_cleans_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'out.pdf')
+            self.assertEqual(stream_to_disk([b'ab', b'cd'], path, max_bytes=4), (hashlib.sha256(b'abcd').hexdigest(), 4))
+            with self.assertRaises(UploadTooLarge):
+                stream_to_disk([b'ab', b'cd', b'e'], path, max_bytes=4)
+            self.assertFalse(os.path.exists(path))
+
+
+class ProviderError(Exception):
+    def __init__(self, code):
+        super().__init__(f'HTTP {code}')
+        self.code = code
+
+
+def flaky(*outcomes):
+    """Callable that raises ProviderError(code) or returns each outcome in turn."""
+    outcomes = list(outcomes)
+    calls = []
+    def func():
+        calls.append(1)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, int):
+            raise ProviderError(outcome)
+        return outcome
+    func.calls = calls
+    return func
+
+
+class ExtractionClientTests(TestCase):
+    def make_client(self, func, **kwargs):
+        self.sleeps = []
+        return ExtractionClient(func, sleep=self.sleeps.append, rand=lambda: 1.0, base_delay=1, max_delay=5, **kwargs)
+
+    def test_retries_throttling_with_capped_backoff(self):
+        func = flaky(429, 503, 500, 'ok')
+        self.assertEqual(self.make_client(func).call(), 'ok')
+        self.assertEqual(len(func.calls), 4)
+        self.assertEqual(self.sleeps, [1, 2, 4])
+
+    def test_exhausted_retries_raise_provider_unavailable(self):
+        func = flaky(429, 429, 429)
+        with self.assertRaises(ProviderUnavailable):
+            self.make_client(func, max_retries=2).call()
+        self.assertEqual(len(func.calls), 3)
+
+    def test_non_retryable_error_is_raised_immediately(self):
+        func = flaky(400)
+        with self.assertRaises(ProviderError):
+            self.make_client(func).call()
+        self.assertEqual((len(func.calls), self.sleeps), (1, []))
+
+    def test_circuit_opens_and_fails_fast(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60, clock=lambda: now[0])
+        func = flaky(503, 503, 'ok')
+        client = self.make_client(func, breaker=breaker, max_retries=5)
+        with self.assertRaises(CircuitOpenError) as raised:
+            client.call()
+        self.assertEqual((len(func.calls), raised.exception.retry_after), (2, 60))
+
+        with self.assertRaises(CircuitOpenError):
+            client.call() # Still open: no provider call at all
+        self.assertEqual(len(func.calls), 2)
+
+        now[0] = 61 # Half-open: a trial call goes through and closes the circuit
+        self.assertEqual(client.call(), 'ok')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_in_flight_cap(self):
+        active, peak, lock = [0], [0], threading.Lock()
+        release = threading.Event()
+        def func():
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            release.wait(1)
+            with lock:
+                active[0] -= 1
+        client = ExtractionClient(func, max_in_flight=2)
+        threads = [threading.Thread(target=client.call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(peak[0], 2)
+
+    def test_token_bucket_is_shared_through_sqlite(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ratelimit.sqlite3')
+            bucket = SQLiteTokenBucket(path, rate=0.001, capacity=2)
+            self.assertTrue(bucket.acquire(timeout=0))
+            # A second instance (e.g. another worker process) sees the same budget
+            other = SQLiteTokenBucket(path, rate=0.001, capacity=2)
+            self.assertTrue(other.acquire(timeout=0))
+            self.assertFalse(bucket.acquire(timeout=0))
+
+
+class ProviderUnavailableViewTests(MediaRootMixin, TestCase):
+    extractor = 'receipts.tests.unavailable_extractor'
+
+    def test_upload_returns_503_and_keeps_file_retryable(self):
+        response = self.client.post(reverse('upload_receipt'), {'file': make_upload()}, format='multipart')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        receipt_file = ReceiptFile.objects.get()
+        self.assertTrue(receipt_file.is_valid)
+        self.assertFalse(receipt_file.is_processed)
+        self.assertIsNone(receipt_file.invalid_reason)
+
+
+class ExtractionBackendTests(TestCase):
+    def test_names_and_dotted_paths_resolve(self):
+        self.assertIs(get_backend('fake'), fake_extract_details)
+        self.assertIs(get_backend('receipts.utils.fake_extract_details'), fake_extract_details)
+        self.assertEqual(get_backend_path('gemini'), 'receipts.utils.extract_details_with_gemini')
+        with self.assertRaises(ImproperlyConfigured):
+            get_backend('openai')
+
+    def test_startup_does_not_import_provider_sdks(self):
+        code = (
+            "import sys, django; django.setup(); import receipt_manager.urls; "
+            "print(','.join(m for m in ('google.generativeai', 'fitz') if m in sys.modules))"
+        )
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='receipt_manager.settings', PYTHONWARNINGS='ignore')
+        result = subprocess.run([sys.executable, '-c', code], cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '')
+
+
+class ReceiptSearchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def search(self, q, **params):
+        return self.client.get(reverse('receipt_search'), {'q': q, **params})
+
+    def test_matches_merchant_items_and_text_ranked(self):
+        coffee_shop = make_receipts(1, merchant_name='Blue Bottle Coffee')[0]
+        grocery = make_receipts(1, merchant_name='Corner Grocery', parsed_text='```json\n{"items": [{"description": "Coffee beans", "price": "$9.99"}]}\n```')[0]
+        make_receipts(1, merchant_name='Hardware Depot')
+
+        response = self.search('coff')
+        self.assertEqual(response.status_code, 200)
+        # Merchant matches outrank item matches
+        self.assertEqual([row['id'] for row in response.data['results']], [coffee_shop.id, grocery.id])
+        self.assertNotIn('parsed_text', response.data['results'][0])
+        self.assertEqual([row['id'] for row in self.search('coffee beans').data['results']], [grocery.id])
+
+    def test_pages_cover_every_hit_once(self):
+        expected = {receipt.id for receipt in make_receipts(7, merchant_name='Pasta House')}
+        seen, cursor = [], None
+        while True:
+            data = self.search('pasta', limit=3, **({'cursor': cursor} if cursor else {})).data
+            seen.extend(row['id'] for row in data['results'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(sorted(seen), sorted(expected))
+
+    @override_settings(SEARCH_MAX_RANKED_HITS=3)
+    def test_broad_queries_rank_the_newest_matches(self):
+        receipts = make_receipts(5, merchant_name='Tea Room')
+        data = self.search('tea', limit=2).data
+        seen = [row['id'] for row in data['results']]
+        seen += [row['id'] for row in self.search('tea', limit=2, cursor=data['next_cursor']).data['results']]
+        self.assertEqual(sorted(seen), [receipt.id for receipt in receipts[2:]])
+
+    def test_index_follows_saves_and_deletes(self):
+        receipt = make_receipts(1, merchant_name='Old Name')[0]
+        receipt.merchant_name = 'New Name'
+        receipt.save()
+        self.assertEqual(self.search('old').data['results'], [])
+        self.assertEqual(len(self.search('new').data['results']), 1)
+
+        receipt.receipt_file.delete() # Cascades to the receipt
+        self.assertEqual(self.search('new').data['results'], [])
+
+    def test_rejects_empty_query_and_bad_cursor(self):
+        self.assertEqual(self.search('  "*" ').status_code, 400)
+        self.assertEqual(self.search('store', cursor='nope').status_code, 400)
+
+
+class ReceiptItemTests(MediaRootMixin, TestCase):
+    def test_extraction_stores_items_and_reprocessing_replaces_them(self):
+        response = self.client.post(reverse('upload_receipt'), {'file': make_upload()}, format='multipart')
+        receipt = Receipt.objects.get(id=response.data['extracted_receipt']['id'])
+        self.assertEqual(
+            list(receipt.items.values_list('position', 'description', 'price_minor', 'currency')),
+            [(0, 'Fake Item', 1234, 'USD')],
+        )
+
+        receipt.receipt_file.is_processed = False
+        receipt.receipt_file.save()
+        self.client.post(reverse('process_receipt'), {'receipt_file_id': receipt.receipt_file_id})
+        self.assertEqual(receipt.items.count(), 1)
+
+        detail = self.client.get(reverse('receipt_detail', args=[receipt.id])).data
+        self.assertEqual(detail['items'][0]['description'], 'Fake Item')
+        self.assertNotIn('items', self.client.get(reverse('receipt_list')).data['results'][0])
+
+    def test_normalize_items_uses_receipt_currency_for_bare_prices(self):
+        rows = normalize_items([{'description': 'Tea', 'price': '3.50'}, {'description': None, 'price': None}, {'price': '€2,00'}], 'GBP')
+        self.assertEqual(
+            [(row['position'], row['description'], row['price_minor'], row['currency']) for row in rows],
+            [(0, 'Tea', 350, 'GBP'), (1, None, 200, 'EUR')],
+        )
+
+    def test_backfill_command(self):
+        parsed_text = '```json\n{"items": [{"description": "Milk", "price": "$1.25"}, {"description": "Bread", "price": "$2.00"}]}\n```'
+        with_items = make_receipts(3, parsed_text=parsed_text, currency='USD')
+        make_receipts(1, parsed_text='not json')
+        call_command('backfill_receipt_items', batch_size=2, stdout=io.StringIO())
+        self.assertEqual(ReceiptItem.objects.count(), 6)
+        self.assertEqual(ReceiptItem.objects.filter(receipt=with_items[0]).aggregate(total=models.Sum('price_minor'))['total'], 325)
+
+        call_command('backfill_receipt_items', stdout=io.StringIO()) # Idempotent
+        self.assertEqual(ReceiptItem.objects.count(), 6)
+
+
+@override_settings(EXTRACTION_CACHE_ENABLED=False)
+class ReprocessCommandTests(MediaRootMixin, TransactionTestCase):
+    extractor = 'receipts.tests.counting_extractor'
+
+    def setUp(self):
+        super().setUp()
+        self.checkpoint = os.path.join(self.media_root, 'reprocess.json')
+        for i in range(3):
+            data = make_pdf_bytes(lines=(f"STORE {i}", "2025-07-29", "TOTAL $12.34"))
+            self.client.post(reverse('upload_receipt'), {'file': make_upload(data=data)}, format='multipart')
+        self.files = list(ReceiptFile.objects.order_by('id'))
+        extractor_calls.clear()
+
+    def reprocess(self, **options):
+        call_command('reprocess_receipts', checkpoint=self.checkpoint, workers=2, batch_size=1, stdout=io.StringIO(), stderr=io.StringIO(), **options)
+
+    def test_failed_files_are_reprocessed(self):
+        failed = self.files[:2]
+        ReceiptFile.objects.filter(id__in=[f.id for f in failed]).update(is_processed=False, invalid_reason='Gemini extraction failed: 503')
+        self.reprocess(failed=True)
+
+        self.assertEqual(len(extractor_calls), 2)
+        self.assertFalse(ReceiptFile.objects.filter(is_processed=False).exists())
+        self.assertFalse(ReceiptFile.objects.filter(invalid_reason__isnull=False).exists())
+        self.assertFalse(os.path.exists(self.checkpoint)) # Removed once the run completes
+
+    def test_resumes_after_the_checkpoint(self):
+        ReceiptFile.objects.update(is_processed=False)
+        with open(self.checkpoint, 'w') as f:
+            json.dump({
+                'selection': {'kind': 'unprocessed', 'uploaded_after': None, 'uploaded_before': None},
+                'max_id': self.files[-1].id,
+                'last_id': self.files[0].id,
+                'counts': {'succeeded': 1, 'failed': 0, 'unavailable': 0, 'error': 0},
+            }, f)
+        self.reprocess(unprocessed=True)
+
+        self.assertEqual(len(extractor_calls), 2)
+        self.assertEqual(list(ReceiptFile.objects.filter(is_processed=False)), [self.files[0]])
+
+    def test_checkpoint_for_another_selection_is_refused(self):
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'selection': {'kind': 'all'}, 'max_id': 0, 'last_id': 0, 'counts': {}}, f)
+        with self.assertRaises(CommandError):
+            self.reprocess(failed=True)
+        self.reprocess(failed=True, restart=True)
+
+    def test_outdated_selects_other_extraction_versions(self):
+        self.assertEqual(set(Receipt.objects.values_list('extraction_version', flat=True)), {cache.get_cache_version()})
+        Receipt.objects.filter(receipt_file=self.files[1]).update(extraction_version='old-prompt')
+        self.reprocess(outdated=True)
+
+        self.assertEqual(len(extractor_calls), 1)
+        self.assertEqual(Receipt.objects.get(receipt_file=self.files[1]).extraction_version, cache.get_cache_version())
+
+
+class FakeS3Client:
+    """In-memory stand-in for the boto3 S3 client calls S3Storage makes."""
+
+    class NotFound(Exception):
+        response = {'Error': {'Code': '404'}}
+
+    def __init__(self):
+        self.objects = {}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.NotFound()
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        with open(Filename, 'rb') as f:
+            self.objects[(Bucket, Key)] = f.read()
+
+    def download_file(self, Bucket, Key, Filename):
+        with open(Filename, 'wb') as f:
+            f.write(self.objects[(Bucket, Key)])
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+class ReceiptStorageTests(MediaRootMixin, TestCase):
+    def upload(self, data):
+        response = self.client.post(reverse('upload_receipt'), {'file': make_upload(data=data)}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        return ReceiptFile.objects.get(id=response.data['receipt_file']['id'])
+
+    def test_identical_uploads_share_one_sharded_file(self):
+        data = make_pdf_bytes()
+        first, second = self.upload(data), self.upload(data)
+        content_hash = hashlib.sha256(data).hexdigest()
+        self.assertEqual(first.file_path, f'receipts/objects/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.pdf')
+        self.assertEqual(second.file_path, first.file_path)
+        self.assertEqual(StoredObject.objects.get(key=first.file_path).ref_count, 2)
+
+        full_path = os.path.join(self.media_root, first.file_path)
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(os.path.exists(full_path))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(os.path.exists(full_path))
+        self.assertFalse(StoredObject.objects.exists())
+
+    def test_s3_backend_dedupes_and_releases(self):
+        fake_s3 = FakeS3Client()
+        storage = S3Storage('receipts-bucket', prefix='prod', client=fake_s3)
+        data = make_pdf_bytes()
+        first = storage.save([data])
+        second = storage.save([data[:100], data[100:]])
+        self.assertEqual(first, second)
+        self.assertEqual(list(fake_s3.objects), [('receipts-bucket', f'prod/{first.key}')])
+        with storage.local_path(first.key) as path, open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+        self.assertFalse(storage.release(first.key))
+        self.assertTrue(storage.release(first.key))
+        self.assertEqual(fake_s3.objects, {})
+
+    def test_migrate_command_moves_year_directory_files(self):
+        data = make_pdf_bytes()
+        legacy_dir = os.path.join(self.media_root, 'receipts', '2025')
+        os.makedirs(legacy_dir)
+        for name in ('a.pdf', 'b.pdf'):
+            with open(os.path.join(legacy_dir, name), 'wb') as f:
+                f.write(data)
+            ReceiptFile.objects.create(file_name=name, file_path=f'receipts/2025/{name}', is_valid=True)
+        ReceiptFile.objects.create(file_name='gone.pdf', file_path='receipts/2025/gone.pdf')
+
+        call_command('migrate_receipt_storage', batch_size=1, stdout=io.StringIO(), stderr=io.StringIO())
+        keys = set(ReceiptFile.objects.exclude(file_name='gone.pdf').values_list('file_path', flat=True))
+        self.assertEqual(len(keys), 1)
+        key = keys.pop()
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, key)))
+        self.assertEqual(StoredObject.objects.get(key=key).ref_count, 2)
+        self.assertEqual(os.listdir(legacy_dir), [])
+
+        call_command('migrate_receipt_storage', stdout=io.StringIO(), stderr=io.StringIO()) # Idempotent
+        self.assertEqual(StoredObject.objects.get(key=key).ref_count, 2)
+
+
+class AsyncEndpointTests(MediaRootMixin, TestCase):
+    async def test_async_upload_extracts_and_stores_receipt(self):
+        response = await self.async_client.post(reverse('async_upload_receipt'), {'file': make_upload()})
+        self.assertEqual(response.status_code, 201)
+        receipt = await Receipt.objects.select_related('receipt_file').aget(id=response.json()['extracted_receipt']['id'])
+        self.assertEqual((receipt.merchant_name, receipt.amount_minor), ('Fake Merchant', 1234))
+        self.assertTrue(receipt.receipt_file.is_processed)
+        self.assertEqual(await receipt.items.acount(), 1)
+
+    async def test_async_upload_rejects_invalid_pdf(self):
+        response = await self.async_client.post(reverse('async_upload_receipt'), {'file': make_upload(data=b'not a pdf')})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse((await ReceiptFile.objects.aget()).is_valid)
+
+    @override_settings(FAKE_EXTRACTION_LATENCY=0.3, EXTRACTION_CACHE_ENABLED=False)
+    async def test_concurrent_uploads_wait_on_the_event_loop(self):
+        uploads = [make_upload(f'r{i}.pdf', make_pdf_bytes((f'STORE {i}',))) for i in range(20)]
+        started = time.monotonic()
+        responses = await asyncio.gather(*(
+            self.async_client.post(reverse('async_upload_receipt'), {'file': upload}) for upload in uploads
+        ))
+        self.assertEqual({response.status_code for response in responses}, {201})
+        self.assertLess(time.monotonic() - started, 3) # 20 x 0.3s one after another would take 6s
+
+    @override_settings(RECEIPT_EXTRACTOR='receipts.tests.unavailable_extractor')
+    async def test_async_process_runs_sync_backends_in_a_thread(self):
+        receipt_file = await ReceiptFile.objects.acreate(file_name='r.pdf', file_path='r.pdf', is_valid=True)
+        with open(os.path.join(self.media_root, 'r.pdf'), 'wb') as f:
+            f.write(make_pdf_bytes())
+        response = await self.async_client.post(
+            reverse('async_process_receipt'), {'receipt_file_id': receipt_file.id}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+
+    def test_async_client_call_retries(self):
+        attempts = []
+        async def generate():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ProviderError(503)
+            return 'ok'
+        async def no_sleep(seconds):
+            pass
+        client = ExtractionClient(None, async_func=generate, async_sleep=no_sleep)
+        self.assertEqual(asyncio.run(client.acall()), 'ok')
+        self.assertEqual(len(attempts), 3)
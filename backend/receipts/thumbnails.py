@@ -0,0 +1,130 @@
+"""
+First-page thumbnails of receipt PDFs, for list views and galleries. A receipt
+split out of a larger PDF (see receipts.segments) shows its own first page.
+
+A thumbnail is rendered with PyMuPDF the first time it is asked for (or ahead of
+time by `manage.py render_thumbnails`) and cached on local disk under
+RECEIPT_THUMBNAIL_DIR, keyed by the PDF's content hash plus the width and format,
+e.g. thumbnails/3f/3fa2...e1-320.png. Identical PDFs share one thumbnail, and
+changing the size or format settings renders new files next to the old ones.
+The cache is disposable: delete the directory and thumbnails are rendered again.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .ingest import iter_file_chunks
+from .backends import get_fitz
+from .storage import get_receipt_storage
+
+CONTENT_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+MAX_ASPECT_RATIO = 2.0 # Long receipts are cropped to their top part, at most this many widths tall
+JPEG_QUALITY = 80
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'rendered': 0}
+
+
+def get_thumbnail_stats():
+    """Thumbnail cache hits and renders in this process."""
+    with _stats_lock:
+        return dict(_stats)
+
+def reset_thumbnail_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+def get_thumbnail_format():
+    image_format = settings.RECEIPT_THUMBNAIL_FORMAT.lower()
+    if image_format not in CONTENT_TYPES:
+        raise ImproperlyConfigured(f"RECEIPT_THUMBNAIL_FORMAT must be one of {', '.join(CONTENT_TYPES)}, not {image_format!r}.")
+    return image_format
+
+def get_thumbnail_dir():
+    return settings.RECEIPT_THUMBNAIL_DIR or os.path.join(settings.MEDIA_ROOT, 'receipts', 'thumbnails')
+
+def _page_suffix(page):
+    return f'-p{page}' if page and page > 1 else ''
+
+def thumbnail_path(content_hash, width=None, image_format=None, page=1):
+    """Where the thumbnail of (a 1-based page of) the PDF with this SHA-256 is cached."""
+    width = width or settings.RECEIPT_THUMBNAIL_WIDTH
+    image_format = image_format or get_thumbnail_format()
+    return os.path.join(get_thumbnail_dir(), content_hash[:2], f'{content_hash}{_page_suffix(page)}-{width}.{image_format}')
+
+def thumbnail_version(content_hash, page=1):
+    """Changes with the PDF and the thumbnail settings; used as the URL's ?v= and as the ETag."""
+    return f'{content_hash[:16]}{_page_suffix(page)}-{settings.RECEIPT_THUMBNAIL_WIDTH}-{get_thumbnail_format()}'
+
+def render_thumbnail(pdf_path, width, image_format, page=1):
+    """A page of a PDF (the first by default) as image bytes, width pixels wide."""
+    fitz = get_fitz()
+    with fitz.open(pdf_path) as doc:
+        page = doc[min(page or 1, doc.page_count) - 1]
+        rect = page.rect
+        clip = fitz.Rect(rect.x0, rect.y0, rect.x1, min(rect.y1, rect.y0 + rect.width * MAX_ASPECT_RATIO))
+        zoom = width / rect.width
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+
+    if image_format == 'png':
+        return pixmap.tobytes('png')
+    if image_format == 'jpeg':
+        return pixmap.tobytes('jpeg', jpg_quality=JPEG_QUALITY)
+    try:
+        return pixmap.pil_tobytes(format='WEBP', quality=JPEG_QUALITY) # MuPDF has no WebP encoder
+    except ImportError:
+        raise ImproperlyConfigured("RECEIPT_THUMBNAIL_FORMAT = 'webp' requires Pillow (pip install Pillow).")
+
+def hash_stored_file(key):
+    """SHA-256 of a stored PDF, for rows saved before content hashes were recorded."""
+    digest = hashlib.sha256()
+    with get_receipt_storage().local_path(key) as path, open(path, 'rb') as f:
+        for chunk in iter_file_chunks(f):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def ensure_thumbnail(file_path, content_hash, width=None, image_format=None, page=1):
+    """
+    Path of the cached thumbnail for a stored PDF (storage key file_path),
+    rendering it first if it isn't cached yet. Returns (path, rendered).
+    """
+    width = width or settings.RECEIPT_THUMBNAIL_WIDTH
+    image_format = image_format or get_thumbnail_format()
+    path = thumbnail_path(content_hash, width, image_format, page)
+    if os.path.exists(path):
+        _count('hits')
+        return path, False
+
+    with get_receipt_storage().local_path(file_path) as pdf_path:
+        data = render_thumbnail(pdf_path, width, image_format, page)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temporary_path, path) # Concurrent renders of the same PDF just replace each other
+    _count('rendered')
+    return path, True
+
+def get_receipt_thumbnail(receipt_file, page=1):
+    """ensure_thumbnail() for a ReceiptFile; fills in a missing content_hash on the way."""
+    if not receipt_file.content_hash:
+        receipt_file.content_hash = hash_stored_file(receipt_file.file_path)
+        # update() keeps updated_at, so cached list pages stay valid
+        type(receipt_file).objects.filter(id=receipt_file.id).update(content_hash=receipt_file.content_hash)
+    path, _ = ensure_thumbnail(receipt_file.file_path, receipt_file.content_hash, page=page)
+    return path
+
+def thumbnail_worker(file_path, content_hash, page=1):
+    """Process pool task for render_thumbnails: (content_hash, rendered) or (content_hash, error message)."""
+    try:
+        content_hash = content_hash or hash_stored_file(file_path)
+        return content_hash, ensure_thumbnail(file_path, content_hash, page=page)[1]
+    except Exception as e:
+        return content_hash, f"{type(e).__name__}: {e}"
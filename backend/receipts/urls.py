@@ -1,17 +1,36 @@
 
 from django.urls import path
+from .async_views import AsyncUploadReceiptView, AsyncProcessReceiptView
 from .views import (
     UploadReceiptView,
+    BatchUploadReceiptView,
     ValidateReceiptView,
     ProcessReceiptView,
     ReceiptListView,
-    ReceiptDetailView
+    ReceiptSearchView,
+    ReceiptChangesView,
+    ReceiptExportView,
+    ReceiptThumbnailView,
+    ReceiptDetailView,
+    ExtractionJobDetailView,
+    ExtractionCacheStatsView,
+    ExtractionStatsView
 )
 
 urlpatterns = [
     path('upload/', UploadReceiptView.as_view(), name='upload_receipt'),
+    path('upload/batch/', BatchUploadReceiptView.as_view(), name='batch_upload_receipt'),
     path('validate/', ValidateReceiptView.as_view(), name='validate_receipt'),
     path('process/', ProcessReceiptView.as_view(), name='process_receipt'),
+    path('async/upload/', AsyncUploadReceiptView.as_view(), name='async_upload_receipt'),
+    path('async/process/', AsyncProcessReceiptView.as_view(), name='async_process_receipt'),
     path('receipts/', ReceiptListView.as_view(), name='receipt_list'),
+    path('receipts/search/', ReceiptSearchView.as_view(), name='receipt_search'),
+    path('receipts/changes/', ReceiptChangesView.as_view(), name='receipt_changes'),
+    path('receipts/export/', ReceiptExportView.as_view(), name='receipt_export'),
     path('receipts/<int:id>/', ReceiptDetailView.as_view(), name='receipt_detail'),
+    path('receipts/<int:id>/thumbnail/', ReceiptThumbnailView.as_view(), name='receipt_thumbnail'),
+    path('jobs/<int:id>/', ExtractionJobDetailView.as_view(), name='extraction_job_detail'),
+    path('extraction-cache/stats/', ExtractionCacheStatsView.as_view(), name='extraction_cache_stats'),
+    path('extraction/stats/', ExtractionStatsView.as_view(), name='extraction_stats'),
 ]
\ No newline at end of file
@@ -1,56 +1,32 @@
+import asyncio
+import logging
 import os
-import fitz  # PyMuPDF
 from django.conf import settings
 from datetime import datetime
 import re
 import decimal
 import json
-import google.generativeai as genai
+import threading
+import time
+from .money import parse_amount
+from .backends import get_fitz
+from .client import ExtractionClient, SQLiteTokenBucket, CircuitBreaker, ProviderUnavailable
+from .preprocess import prepare_payload
+from .metrics import stage
+from .batching import RequestBatcher, count_retry
 
-# Configure Google Gemini API
-genai.configure(api_key=settings.GEMINI_API_KEY)
+logger = logging.getLogger(__name__)
 
 # Define the model to use
 GEMINI_MODEL_NAME = 'gemini-2.5-flash' 
-GEMINI_MODEL = genai.GenerativeModel(GEMINI_MODEL_NAME)
 
-def validate_pdf(file_path):
-    """
-    Validates if a file is a valid PDF.
-    Returns (is_valid, reason_if_invalid)
-    """
-    try:
-        doc = fitz.open(file_path)
-        if doc.page_count == 0:
-            return False, "PDF contains no pages."
-        doc.close()
-        return True, None
-    except fitz.EmptyFileError:
-        return False, "File is empty or corrupted."
-    except fitz.FileDataError:
-        return False, "Invalid PDF file structure or format."
-    except Exception as e:
-        return False, f"An unexpected error occurred during PDF validation: {str(e)}"
+_gemini_model = None
+_gemini_client = None
+_gemini_client_lock = threading.Lock()
+_gemini_batcher = None
 
-def extract_details_with_gemini(pdf_path):
-    """
-    Extracts receipt details from a PDF using Google Gemini (native PDF input).
-    Returns parsed data and the raw Gemini response text.
-    """
-    try:
-        with open(pdf_path, 'rb') as f:
-            pdf_bytes = f.read()
-
-        # Create an inline_data part for the PDF file
-        pdf_part = {
-            "inline_data": {
-                "mime_type": "application/pdf",
-                "data": pdf_bytes # Pass raw bytes directly
-            }
-        }
-
-        # Optimized Prompt for Receipt Extraction:
-        prompt_text = """
+# Optimized Prompt for Receipt Extraction:
+RECEIPT_PROMPT = """
         Analyze this receipt document. Extract the following details:
         - **Merchant Name**: The name of the store or business.
         - **Purchase Date**: The date of the transaction in YYYY-MM-DD format.
@@ -74,73 +50,391 @@ def extract_details_with_gemini(pdf_path):
         }
         ```
         """
-        # The contents list now includes the PDF part and the text prompt part
-        contents = [
-            pdf_part,
-            {"text": prompt_text} # Text is also sent as a part
+
+# Several receipts in one request (the 'gemini-batch' backend); the documents come before this text
+BATCH_RECEIPT_PROMPT = """
+        The documents above are separate receipts, numbered from 0 in the order given.
+        Extract the following details from each receipt:
+        - **Merchant Name**: The name of the store or business.
+        - **Purchase Date**: The date of the transaction in YYYY-MM-DD format.
+        - **Total Amount**: The grand total amount of the purchase, including tax, add the currency symbol (e.g., "$").
+        - **Items**: A list of items purchased. For each item, include:
+            - **Description**: The name of the item.
+            - **Price**: The price of the individual item.
+
+        Output the information strictly as a JSON array with one object per receipt. Each object has a
+        "document" key with the receipt's number, and the other keys as in the example. Never merge
+        receipts or copy details from one receipt to another. If a specific detail is not found, use
+        `null` for its value. Ensure the JSON is well-formed and can be directly parsed.
+        Example JSON structure for two receipts:
+        ```json
+        [
+          {
+            "document": 0,
+            "merchant_name": "Example Store",
+            "purchase_date": "2023-10-26",
+            "total_amount": "$123.45",
+            "items": [{"description": "Product A", "price": "$10.00"}]
+          },
+          {
+            "document": 1,
+            "merchant_name": "Corner Cafe",
+            "purchase_date": "2023-10-27",
+            "total_amount": "$4.50",
+            "items": [{"description": "Coffee", "price": "$4.50"}]
+          }
         ]
+        ```
+        """
 
-        response = GEMINI_MODEL.generate_content(contents)
-        response.resolve() # Ensure content is fully available
+def get_gemini_model():
+    """
+    Configures the Gemini SDK and builds the model on first use.
+    google.generativeai is slow to import, so processes that never call Gemini don't pay for it.
+    """
+    global _gemini_model
+    if _gemini_model is None:
+        import google.generativeai as genai
+        genai.configure(api_key=settings.GEMINI_API_KEY)
+        _gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return _gemini_model
 
-        gemini_text_response = response.text.strip()
-        print(f"DEBUG: Gemini Raw Response:\n{gemini_text_response}")
-
-        # Attempt to parse the JSON output from Gemini
-        json_match = re.search(r'```json\n(.*?)\n```', gemini_text_response, re.DOTALL)
-        if json_match:
-            json_string = json_match.group(1)
-        else:
-            json_string = gemini_text_response # Assume it's direct JSON if no markdown block
-
-        parsed_data = json.loads(json_string)
-
-        merchant_name = parsed_data.get('merchant_name')
-        total_amount = None
-        if parsed_data.get('total_amount') is not None:
-            try:
-                total_amount = parsed_data['total_amount']
-            except (decimal.InvalidOperation, TypeError):
-                total_amount = None
-
-        purchased_at = None
-        date_str = parsed_data.get('purchase_date')
-        if date_str:
-            try:
-                purchased_at = datetime.strptime(date_str, '%Y-%m-%d')
-            except ValueError:
-                purchased_at = None
-
-        extracted_info = {
-            'merchant_name': merchant_name,
-            'total_amount': total_amount,
-            'purchased_at': purchased_at,
-            # 'items_details': parsed_data.get('items') # If you add a JSONField for items
+def get_gemini_client():
+    """
+    Returns the process-wide rate-limited, retrying client around the Gemini model's
+    generate_content (call) and generate_content_async (acall).
+    Limits come from the GEMINI_* settings; the token bucket is shared with other processes
+    through GEMINI_RATE_LIMIT_DB.
+    """
+    global _gemini_client
+    with _gemini_client_lock:
+        if _gemini_client is None:
+            rate_limiter = None
+            if settings.GEMINI_RATE_LIMIT_PER_MINUTE:
+                rate_limiter = SQLiteTokenBucket(
+                    settings.GEMINI_RATE_LIMIT_DB,
+                    rate=settings.GEMINI_RATE_LIMIT_PER_MINUTE / 60,
+                    capacity=settings.GEMINI_RATE_LIMIT_BURST,
+                    name=GEMINI_MODEL_NAME,
+                )
+            model = get_gemini_model()
+            _gemini_client = ExtractionClient(
+                model.generate_content,
+                async_func=model.generate_content_async,
+                rate_limiter=rate_limiter,
+                max_in_flight=settings.GEMINI_MAX_IN_FLIGHT,
+                max_in_flight_async=settings.GEMINI_MAX_IN_FLIGHT_ASYNC,
+                max_retries=settings.GEMINI_MAX_RETRIES,
+                base_delay=settings.GEMINI_RETRY_BASE_DELAY,
+                max_delay=settings.GEMINI_RETRY_MAX_DELAY,
+                breaker=CircuitBreaker(
+                    failure_threshold=settings.GEMINI_CIRCUIT_FAILURE_THRESHOLD,
+                    reset_timeout=settings.GEMINI_CIRCUIT_RESET_TIMEOUT,
+                ),
+            )
+        return _gemini_client
+
+def validate_pdf(file_path):
+    """
+    Validates if a file is a valid PDF.
+    Returns (is_valid, reason_if_invalid)
+    """
+    fitz = get_fitz()
+    try:
+        doc = fitz.open(file_path)
+        if doc.page_count == 0:
+            return False, "PDF contains no pages."
+        doc.close()
+        return True, None
+    except fitz.EmptyFileError:
+        return False, "File is empty or corrupted."
+    except fitz.FileDataError:
+        return False, "Invalid PDF file structure or format."
+    except Exception as e:
+        return False, f"An unexpected error occurred during PDF validation: {str(e)}"
+
+def _payload_bytes(payload):
+    # The API client only accepts real bytes. This is the one copy of a mapped file on the Gemini path,
+    # made only when the original is sent because preprocessing is off or didn't make it smaller.
+    return payload.data if isinstance(payload.data, bytes) else bytes(payload.data)
+
+def _gemini_contents(payload):
+    # Create an inline_data part for the (preprocessed) PDF or page image
+    pdf_part = {
+        "inline_data": {
+            "mime_type": payload.mime_type,
+            "data": _payload_bytes(payload)
         }
+    }
 
-        return extracted_info, gemini_text_response
+    # The contents list now includes the PDF part and the text prompt part
+    return [
+        pdf_part,
+        {"text": RECEIPT_PROMPT} # Text is also sent as a part
+    ]
+
+def _read_pdf_bytes(pdf_path, pdf_data=None):
+    """The file's bytes, or pdf_data (bytes or a mapped file) as is; preprocessing reads it in place."""
+    if pdf_data is None:
+        with open(pdf_path, 'rb') as f:
+            return f.read()
+    return pdf_data
+
+def _parse_gemini_response(gemini_text_response, payload=None):
+    """
+    Turns Gemini's JSON answer into the extracted fields. Raises json.JSONDecodeError on malformed output.
+    payload is what was sent (see receipts.preprocess); its size is recorded as payload_size.
+    """
+    # Attempt to parse the JSON output from Gemini
+    json_match = re.search(r'```json\n(.*?)\n```', gemini_text_response, re.DOTALL)
+    if json_match:
+        json_string = json_match.group(1)
+    else:
+        json_string = gemini_text_response # Assume it's direct JSON if no markdown block
+
+    parsed_data = json.loads(json_string)
+
+    merchant_name = parsed_data.get('merchant_name')
+    total_amount = None
+    if parsed_data.get('total_amount') is not None:
+        try:
+            total_amount = parsed_data['total_amount']
+        except (decimal.InvalidOperation, TypeError):
+            total_amount = None
+
+    purchased_at = None
+    date_str = parsed_data.get('purchase_date')
+    if date_str:
+        try:
+            purchased_at = datetime.strptime(date_str, '%Y-%m-%d')
+        except ValueError:
+            purchased_at = None
+
+    # Normalized copy of the total for filtering/sorting in SQL
+    amount_minor, currency = parse_amount(total_amount)
+
+    return {
+        'merchant_name': merchant_name,
+        'total_amount': total_amount,
+        'amount_minor': amount_minor,
+        'currency': currency,
+        'purchased_at': purchased_at,
+        'payload_size': len(payload.data) if payload is not None else None,
+        # 'items_details': parsed_data.get('items') # If you add a JSONField for items
+    }
+
+def _gemini_error_message(e):
+    logger.warning("Gemini extraction failed: %s", e)
+    # More robust error handling for API issues
+    error_message = f"Extraction failed: {str(e)}"
+    if hasattr(e, 'response') and hasattr(e.response, 'text'):
+        try:
+            api_error_details = e.response.json()
+            error_message += f". API details: {api_error_details.get('error', {}).get('message', 'No specific message')}"
+        except json.JSONDecodeError:
+            error_message += f". Raw API response: {e.response.text}"
+    return error_message
+
+def extract_details_with_gemini(pdf_path, pdf_data=None):
+    """
+    Extracts receipt details from a PDF using Google Gemini (native PDF input).
+    pdf_data is an optional in-memory/mapped copy of the file, used instead of reading pdf_path.
+    Returns parsed data and the raw Gemini response text.
+    """
+    try:
+        payload = prepare_payload(_read_pdf_bytes(pdf_path, pdf_data))
+    except Exception as e:
+        return None, _gemini_error_message(e)
+    return _extract_payload(payload)
+
+def _extract_payload(payload):
+    """extract_details_with_gemini for an already prepared payload."""
+    gemini_text_response = None
+    try:
+        response = get_gemini_client().call(_gemini_contents(payload))
+        response.resolve() # Ensure content is fully available
+
+        gemini_text_response = response.text.strip()
+        logger.debug("Gemini raw response: %s", gemini_text_response) # Formatted only when DEBUG logging is on
+        with stage('parse'):
+            parsed_data = _parse_gemini_response(gemini_text_response, payload)
+        return parsed_data, gemini_text_response
     except json.JSONDecodeError as jde:
         # Include the raw response in the error message for debugging
         return None, f"Failed to parse Gemini's JSON response: {jde}. Raw response from Gemini: {gemini_text_response}"
+    except ProviderUnavailable:
+        raise # Transient; the caller retries later instead of failing the receipt
+    except Exception as e:
+        return None, _gemini_error_message(e)
+
+async def aextract_details_with_gemini(pdf_path, pdf_data=None):
+    """
+    Async extract_details_with_gemini: awaits the SDK's generate_content_async, so a
+    pending extraction holds a coroutine rather than a thread.
+    """
+    try:
+        payload = await _aprepare_payload(pdf_path, pdf_data)
+    except Exception as e:
+        return None, _gemini_error_message(e)
+    return await _aextract_payload(payload)
+
+async def _aprepare_payload(pdf_path, pdf_data):
+    pdf_bytes = await asyncio.to_thread(_read_pdf_bytes, pdf_path, pdf_data)
+    return await asyncio.to_thread(prepare_payload, pdf_bytes) # CPU-bound; keep it off the event loop
+
+async def _aextract_payload(payload):
+    gemini_text_response = None
+    try:
+        response = await get_gemini_client().acall(_gemini_contents(payload))
+        await response.resolve()
+
+        gemini_text_response = response.text.strip()
+        logger.debug("Gemini raw response: %s", gemini_text_response) # Formatted only when DEBUG logging is on
+        with stage('parse'):
+            parsed_data = _parse_gemini_response(gemini_text_response, payload)
+        return parsed_data, gemini_text_response
+    except json.JSONDecodeError as jde:
+        return None, f"Failed to parse Gemini's JSON response: {jde}. Raw response from Gemini: {gemini_text_response}"
+    except ProviderUnavailable:
+        raise
+    except Exception as e:
+        return None, _gemini_error_message(e)
+
+def get_gemini_batcher():
+    """The process-wide RequestBatcher that packs receipts into one Gemini request (see receipts.batching)."""
+    global _gemini_batcher
+    with _gemini_client_lock:
+        if _gemini_batcher is None:
+            _gemini_batcher = RequestBatcher(
+                _send_gemini_batch,
+                max_items=settings.GEMINI_BATCH_MAX_ITEMS,
+                max_wait=settings.GEMINI_BATCH_MAX_WAIT_MS / 1000,
+            )
+        return _gemini_batcher
+
+def _gemini_batch_contents(payloads):
+    contents = []
+    for index, payload in enumerate(payloads):
+        contents.append({"text": f"Document {index}:"})
+        contents.append({"inline_data": {"mime_type": payload.mime_type, "data": _payload_bytes(payload)}})
+    contents.append({"text": BATCH_RECEIPT_PROMPT})
+    return contents
+
+def _split_gemini_batch_response(gemini_text_response, count):
+    """
+    The answer to a batched request as {document index: raw response for that document alone},
+    in the same fenced JSON form as a single-receipt answer. Entries without a valid index are left out.
+    Raises json.JSONDecodeError if the answer as a whole isn't JSON.
+    """
+    json_match = re.search(r'```json\n(.*?)\n```', gemini_text_response, re.DOTALL)
+    documents = json.loads(json_match.group(1) if json_match else gemini_text_response)
+    if not isinstance(documents, list):
+        raise json.JSONDecodeError("Expected a JSON array of receipts", gemini_text_response, 0)
+    answers = {}
+    for document in documents:
+        if not isinstance(document, dict):
+            continue
+        index = document.pop('document', None)
+        if isinstance(index, int) and 0 <= index < count and index not in answers:
+            answers[index] = f"```json\n{json.dumps(document, indent=2)}\n```"
+    return answers
+
+def _send_gemini_batch(payloads):
+    """
+    RequestBatcher.send for Gemini: one request for all payloads. Returns
+    (parsed_data, raw_response) per payload, or None for a payload whose answer
+    is missing or doesn't parse, which its caller then extracts on its own.
+    """
+    if len(payloads) == 1:
+        return [_extract_payload(payloads[0])] # Nobody else came; a plain request
+    try:
+        response = get_gemini_client().call(_gemini_batch_contents(payloads))
+        response.resolve()
+        answers = _split_gemini_batch_response(response.text.strip(), len(payloads))
+    except ProviderUnavailable:
+        raise # Transient for every receipt in the batch
     except Exception as e:
-        print(f"Error during Gemini extraction: {e}")
-        # More robust error handling for API issues
-        error_message = f"Extraction failed: {str(e)}"
-        if hasattr(e, 'response') and hasattr(e.response, 'text'):
-            try:
-                api_error_details = e.response.json()
-                error_message += f". API details: {api_error_details.get('error', {}).get('message', 'No specific message')}"
-            except json.JSONDecodeError:
-                error_message += f". Raw API response: {e.response.text}"
-        return None, error_message
-
-def get_storage_path(filename):
-    """
-    Generates a storage path based on the current year.
-    Example: media/receipts/2025/filename.pdf
-    """
-    current_year = datetime.now().year
-    year_directory = os.path.join('receipts', str(current_year))
-    full_directory_path = os.path.join(settings.MEDIA_ROOT, year_directory)
-    os.makedirs(full_directory_path, exist_ok=True)
-    return os.path.join(year_directory, filename)
\ No newline at end of file
+        logger.warning("Batched Gemini request for %d receipts failed, extracting them one by one: %s", len(payloads), e)
+        return [None] * len(payloads)
+
+    results = []
+    for index, payload in enumerate(payloads):
+        raw_response = answers.get(index)
+        try:
+            results.append((_parse_gemini_response(raw_response, payload), raw_response) if raw_response else None)
+        except (ValueError, TypeError, AttributeError): # Malformed fields, e.g. a number where a date should be
+            results.append(None)
+    return results
+
+def _fits_batch(payload):
+    return len(payload.data) <= settings.GEMINI_BATCH_MAX_PAYLOAD_BYTES
+
+def extract_details_with_gemini_batched(pdf_path, pdf_data=None):
+    """
+    extract_details_with_gemini, with small receipts packed into one request together
+    with those of other threads (GEMINI_BATCH_* settings). A receipt whose part
+    of the answer is missing or malformed is sent again on its own.
+    """
+    try:
+        payload = prepare_payload(_read_pdf_bytes(pdf_path, pdf_data))
+    except Exception as e:
+        return None, _gemini_error_message(e)
+    if not _fits_batch(payload):
+        return _extract_payload(payload)
+    result = get_gemini_batcher().submit(payload).result()
+    if result is None:
+        count_retry()
+        return _extract_payload(payload)
+    return result
+
+async def aextract_details_with_gemini_batched(pdf_path, pdf_data=None):
+    """Async extract_details_with_gemini_batched: awaits the batch instead of blocking a thread on it."""
+    try:
+        payload = await _aprepare_payload(pdf_path, pdf_data)
+    except Exception as e:
+        return None, _gemini_error_message(e)
+    if not _fits_batch(payload):
+        return await _aextract_payload(payload)
+    result = await asyncio.wrap_future(get_gemini_batcher().submit(payload))
+    if result is None:
+        count_retry()
+        return await _aextract_payload(payload)
+    return result
+
+def _fake_result():
+    fake_response = {
+        "merchant_name": "Fake Merchant",
+        "purchase_date": "2025-01-01",
+        "total_amount": "$12.34",
+        "items": [
+            {"description": "Fake Item", "price": "$12.34"}
+        ]
+    }
+    raw_response = f"```json\n{json.dumps(fake_response, indent=2)}\n```"
+    amount_minor, currency = parse_amount(fake_response['total_amount'])
+    extracted_info = {
+        'merchant_name': fake_response['merchant_name'],
+        'total_amount': fake_response['total_amount'],
+        'amount_minor': amount_minor,
+        'currency': currency,
+        'purchased_at': datetime.strptime(fake_response['purchase_date'], '%Y-%m-%d'),
+    }
+    return extracted_info, raw_response
+
+def fake_extract_details(pdf_path, pdf_data=None):
+    """
+    Offline stand-in for extract_details_with_gemini, for tests and local runs.
+    Sleeps for FAKE_EXTRACTION_LATENCY seconds and returns a fixed receipt
+    in the same (parsed_data, raw_response) shape as the Gemini extractor.
+    """
+    latency = getattr(settings, 'FAKE_EXTRACTION_LATENCY', 0)
+    if latency:
+        time.sleep(latency)
+    return _fake_result()
+
+async def afake_extract_details(pdf_path, pdf_data=None):
+    """Async fake_extract_details; the latency is an asyncio.sleep, like awaiting a real provider."""
+    latency = getattr(settings, 'FAKE_EXTRACTION_LATENCY', 0)
+    if latency:
+        await asyncio.sleep(latency)
+    return _fake_result()
\ No newline at end of file
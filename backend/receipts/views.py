@@ -2,17 +2,67 @@ from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.utils import timezone
+from django.views import View
 from django.conf import settings
 import os
+import zipfile
+from contextlib import ExitStack, nullcontext
 from django.db import transaction
-from datetime import datetime
-from .models import ReceiptFile, Receipt
-from .serializers import ReceiptFileSerializer, ReceiptSerializer, ReceiptDetailSerializer
-from .utils import validate_pdf, extract_details_with_gemini, get_storage_path
+from .models import ReceiptFile, Receipt, ExtractionJob
+from .serializers import ReceiptFileSerializer, ReceiptSerializer, ReceiptDetailSerializer, ExtractionJobSerializer
+from .utils import validate_pdf
+from .pipeline import create_validated_receipt_file, validate_paths_parallel, extract_and_save, ExtractionFailed, EmptyExtraction
+from .jobs import enqueue_extraction, enqueue_extractions
+from .ingest import iter_file_chunks, open_mapped, UploadTooLarge
+from .cache import get_cache_stats
+from .local_extraction import get_path_stats
+from .preprocess import get_preprocess_stats
+from .near_duplicates import get_near_duplicate_stats
+from .batching import get_batching_stats
+from .pagination import (
+    paginate_keyset, decode_cursor, encode_search_cursor, decode_search_cursor, encode_change_cursor, decode_change_cursor, InvalidCursor,
+)
+from .changes import get_changes, is_cursor_expired
+from .search import build_match_query, get_rank_floor, search_receipt_ids, is_search_available
+from .filters import filter_receipts
+from .client import ProviderUnavailable
+from .storage import get_receipt_storage
+from .response_cache import conditional_response, list_fingerprint, detail_fingerprint
+from .metrics import instrumented, stage, fail, render_metrics
+from .export import stream_export, CONTENT_TYPES, FORMATS, ExportUnavailable
+from .segments import parse_split_mode
+from . import thumbnails
+
+
+def provider_unavailable_response(exc, receipt_file):
+    """503 with Retry-After; the file stays valid and unprocessed so it can go through /api/process/ later."""
+    response = Response(
+        {
+            'error': f'Extraction provider is temporarily unavailable: {str(exc)}',
+            'receipt_file': ReceiptFileSerializer(receipt_file).data,
+        },
+        status=status.HTTP_503_SERVICE_UNAVAILABLE
+    )
+    if exc.retry_after:
+        response['Retry-After'] = str(max(1, round(exc.retry_after)))
+    return response
+
+def requested_split_mode(request):
+    """
+    The ?split= (or form field) mode for a PDF holding several receipts, or None
+    to use RECEIPT_SPLIT_MODE. Raises ValueError with a user-facing message.
+    """
+    return parse_split_mode(request.query_params.get('split', request.data.get('split')))
 
 class UploadReceiptView(APIView):
     parser_classes = (MultiPartParser, FormParser)
 
+    @instrumented('upload')
     def post(self, request, *args, **kwargs):
         if 'file' not in request.FILES:
             return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
@@ -20,108 +70,237 @@ class UploadReceiptView(APIView):
         uploaded_file = request.FILES['file']
         if not uploaded_file.name.lower().endswith('.pdf'):
             return Response({'error': 'Only PDF files are allowed.'}, status=status.HTTP_400_BAD_REQUEST)
+        if uploaded_file.size > settings.RECEIPT_MAX_UPLOAD_SIZE:
+            return Response(
+                {'error': f'File exceeds the {settings.RECEIPT_MAX_UPLOAD_SIZE} byte upload limit.'},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        try:
+            split_mode = requested_split_mode(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Generate a unique file name and path
-        # Sanitize filename (remove potentially problematic characters)
-        file_name = "".join(x for x in uploaded_file.name if x.isalnum() or x in "._- ").strip()
-        # Add a timestamp to ensure uniqueness in case of same file name uploads
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
-        base_name, extension = os.path.splitext(file_name)
-        unique_file_name = f"{base_name}_{timestamp}{extension}"
-
-        relative_file_path = get_storage_path(unique_file_name)
-        full_file_path = os.path.join(settings.MEDIA_ROOT, relative_file_path)
-
+        storage = get_receipt_storage()
+        stored = None
         receipt_file = None # Initialize to None for error handling
 
         try:
-            # 1. Save the file to the local directory
-            with open(full_file_path, 'wb+') as destination:
-                for chunk in uploaded_file.chunks():
-                    destination.write(chunk)
-
-            # Create ReceiptFile entry with initial status
-            receipt_file = ReceiptFile.objects.create(
-                file_name=uploaded_file.name, # Store original name
-                file_path=relative_file_path,  # Store relative path
-                is_valid=False,  # Will be validated immediately
-                is_processed=False # Will be processed immediately if valid
-            )
-
-            # 2. Validate the uploaded file
-            is_valid, invalid_reason = validate_pdf(full_file_path)
-            receipt_file.is_valid = is_valid
-            receipt_file.invalid_reason = invalid_reason
-
-            if not is_valid:
-                receipt_file.save() # Save the validation result
+            # 1. Store the file under its content address, hashing and size-checking in the same pass
+            try:
+                with stage('disk_write'):
+                    stored = storage.save(uploaded_file.chunks(), settings.RECEIPT_MAX_UPLOAD_SIZE)
+            except UploadTooLarge as e:
+                return Response({'error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+            file_fields = {
+                'file_name': uploaded_file.name, # Store original name
+                'file_path': stored.key, # Storage key; identical uploads share one file
+                'content_hash': stored.content_hash,
+                'file_size': stored.size,
+                'split_mode': split_mode,
+            }
+
+            # Queued mode: hand validation and extraction to the worker pool and return at once
+            if request.query_params.get('mode', request.data.get('mode')) == 'async':
+                with transaction.atomic():
+                    receipt_file = ReceiptFile.objects.create(is_valid=False, is_processed=False, **file_fields)
+                    job = enqueue_extraction(receipt_file)
                 return Response(
-                    {'message': 'File uploaded but is invalid.', 'receipt_file': ReceiptFileSerializer(receipt_file).data},
-                    status=status.HTTP_400_BAD_REQUEST
+                    {
+                        'message': 'File uploaded; extraction queued.',
+                        'job_id': job.id,
+                        'receipt_file': ReceiptFileSerializer(receipt_file).data,
+                    },
+                    status=status.HTTP_202_ACCEPTED
                 )
 
-            # 3. Extract receipt details using Gemini (if valid)
-            # --- Call Gemini for extraction ---
-            parsed_data, raw_gemini_response = extract_details_with_gemini(full_file_path)
-
-            if parsed_data is None: # If Gemini extraction failed or returned null
-                receipt_file.is_processed = False
-                receipt_file.invalid_reason = f"Gemini extraction failed: {raw_gemini_response}"
-                receipt_file.save()
-                return Response(
-                    {'message': 'File is valid but AI extraction failed.', 'receipt_file': ReceiptFileSerializer(receipt_file).data},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-
-            # Basic check if Gemini yielded meaningful data
-            if not parsed_data.get('merchant_name') and not parsed_data.get('total_amount') and not parsed_data.get('purchased_at'):
-                receipt_file.is_processed = False
-                receipt_file.invalid_reason = "AI extracted text, but parsing yielded no meaningful data or key fields are missing."
-                receipt_file.save()
-                return Response(
-                    {'message': 'AI extracted text, but parsing yielded no meaningful data.', 'receipt_file': ReceiptFileSerializer(receipt_file).data},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-            
-            print(f"DEBUG: Gemini Raw Response:\n{parsed_data}")
-
-            with transaction.atomic():
-                receipt_instance, created = Receipt.objects.update_or_create(
-                    receipt_file=receipt_file,
-                    defaults={
-                        'purchased_at': parsed_data.get('purchased_at'),
-                        'merchant_name': parsed_data.get('merchant_name'),
-                        'total_amount': parsed_data.get('total_amount'),
-                        'parsed_text': raw_gemini_response, # Store raw Gemini JSON response here
-                    }
-                )
-                receipt_file.is_processed = True
-                receipt_file.save()
+            with storage.local_path(stored.key) as full_file_path, open_mapped(full_file_path) as pdf_data:
+                # 2. Validate the uploaded file (structural check on the mapped bytes) and create
+                #    the ReceiptFile entry with the result, so validation needs no extra UPDATE
+                receipt_file = create_validated_receipt_file(pdf_data, **file_fields)
+                if not receipt_file.is_valid:
+                    fail('invalid_pdf')
+                    return Response(
+                        {'message': 'File uploaded but is invalid.', 'receipt_file': ReceiptFileSerializer(receipt_file).data},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+
+                # 3. Extract receipt details (if valid) from the same mapping
+                try:
+                    receipts = extract_and_save(receipt_file, full_file_path, pdf_data=pdf_data)
+                except ExtractionFailed:
+                    fail('extraction_failed')
+                    return Response(
+                        {'message': 'File is valid but AI extraction failed.', 'receipt_file': ReceiptFileSerializer(receipt_file).data},
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                    )
+                except EmptyExtraction:
+                    fail('empty_extraction')
+                    return Response(
+                        {'message': 'AI extracted text, but parsing yielded no meaningful data.', 'receipt_file': ReceiptFileSerializer(receipt_file).data},
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                    )
+                except ProviderUnavailable as e:
+                    return provider_unavailable_response(e, receipt_file)
 
             return Response(
                 {
                     'message': 'File uploaded, validated, and processed successfully!',
                     'receipt_file': ReceiptFileSerializer(receipt_file).data,
-                    'extracted_receipt': ReceiptSerializer(receipt_instance).data
+                    'extracted_receipt': ReceiptSerializer(receipts[0]).data,
+                    'extracted_receipts': ReceiptSerializer(receipts, many=True).data, # Several when the PDF was split
                 },
                 status=status.HTTP_201_CREATED
             )
 
         except Exception as e:
+            fail('exception')
             if receipt_file:
                 receipt_file.is_valid = False
                 receipt_file.is_processed = False
                 receipt_file.invalid_reason = f"Processing failed: {str(e)}"
-                receipt_file.save()
-            else:
-                if os.path.exists(full_file_path):
-                    os.remove(full_file_path)
+                receipt_file.save(update_fields=['is_valid', 'is_processed', 'invalid_reason', 'updated_at'])
+            elif stored:
+                storage.release(stored.key)
 
             return Response(
                 {'error': f'An unexpected error occurred during receipt processing: {str(e)}'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class BatchUploadReceiptView(APIView):
+    """
+    Accepts many PDFs in one request, as repeated `files` fields and/or zip `archive` fields.
+    Entries are streamed to disk, validated in parallel and stored with a single bulk insert.
+    Responds with a per-file manifest.
+    """
+    parser_classes = (MultiPartParser, FormParser)
+    chunk_size = 64 * 1024
+
+    def _store(self, storage, source):
+        """Streams a file-like source into storage, hashing it on the way. Returns a StoredFile."""
+        return storage.save(iter_file_chunks(source, self.chunk_size), settings.RECEIPT_MAX_UPLOAD_SIZE)
+
+    def post(self, request, *args, **kwargs):
+        uploaded_files = request.FILES.getlist('files')
+        archives = request.FILES.getlist('archive')
+        if not uploaded_files and not archives:
+            return Response({'error': 'No files provided'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            split_mode = requested_split_mode(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        manifest = []
+        sources = [] # (manifest entry, original name, opener) for every PDF we will store
+        opened_archives = []
+
+        try:
+            for uploaded_file in uploaded_files:
+                entry = {'file_name': uploaded_file.name}
+                manifest.append(entry)
+                if not uploaded_file.name.lower().endswith('.pdf'):
+                    entry.update(status='rejected', error='Only PDF files are allowed.')
+                    continue
+                sources.append((entry, uploaded_file.name, lambda f=uploaded_file: nullcontext(f)))
+
+            for archive in archives:
+                if not zipfile.is_zipfile(archive):
+                    manifest.append({'file_name': archive.name, 'status': 'rejected', 'error': 'Not a zip archive.'})
+                    continue
+                zf = zipfile.ZipFile(archive)
+                opened_archives.append(zf)
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    name = os.path.basename(info.filename)
+                    entry = {'file_name': f"{archive.name}/{info.filename}"}
+                    manifest.append(entry)
+                    if not name.lower().endswith('.pdf'):
+                        entry.update(status='rejected', error='Only PDF files are allowed.')
+                        continue
+                    sources.append((entry, name, lambda zf=zf, info=info: zf.open(info)))
+
+            if len(sources) > settings.BATCH_UPLOAD_MAX_FILES:
+                return Response(
+                    {'error': f'Too many files in one batch ({len(sources)}); the limit is {settings.BATCH_UPLOAD_MAX_FILES}.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            # 1. Stream every entry into storage, hashing and size-checking as it is written
+            storage = get_receipt_storage()
+            stored = [] # (manifest entry, original name, StoredFile)
+            try:
+                for entry, original_name, opener in sources:
+                    try:
+                        with opener() as source:
+                            stored.append((entry, original_name, self._store(storage, source)))
+                    except UploadTooLarge as e:
+                        entry.update(status='rejected', error=str(e))
+
+                # 2. Validate in parallel across processes
+                with ExitStack() as local_files:
+                    paths = [local_files.enter_context(storage.local_path(stored_file.key)) for _, _, stored_file in stored]
+                    results = validate_paths_parallel(paths)
+
+                # 3. One bulk insert for all rows
+                receipt_files = [
+                    ReceiptFile(
+                        file_name=original_name,
+                        file_path=stored_file.key,
+                        content_hash=stored_file.content_hash,
+                        file_size=stored_file.size,
+                        is_valid=is_valid,
+                        invalid_reason=invalid_reason,
+                        is_processed=False,
+                        split_mode=split_mode,
+                    )
+                    for (_, original_name, stored_file), (is_valid, invalid_reason) in zip(stored, results)
+                ]
+                queue_extraction = request.query_params.get('mode', request.data.get('mode')) == 'async'
+                with transaction.atomic():
+                    receipt_files = ReceiptFile.objects.bulk_create(receipt_files)
+                    valid_files = [receipt_file for receipt_file in receipt_files if receipt_file.is_valid]
+                    created_jobs = enqueue_extractions(valid_files) if queue_extraction else []
+            except Exception:
+                for _, _, stored_file in stored:
+                    storage.release(stored_file.key)
+                raise
+
+            job_ids = {job.receipt_file_id: job.id for job in created_jobs}
+            for stored_file, receipt_file in zip(stored, receipt_files):
+                entry = stored_file[0]
+                entry.update(
+                    status='stored',
+                    receipt_file_id=receipt_file.id,
+                    is_valid=receipt_file.is_valid,
+                    invalid_reason=receipt_file.invalid_reason,
+                )
+                if queue_extraction and receipt_file.is_valid:
+                    entry['job_id'] = job_ids[receipt_file.id]
+        except Exception as e:
+            return Response(
+                {'error': f'An unexpected error occurred during batch upload: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        finally:
+            for zf in opened_archives:
+                zf.close()
+
+        summary = {
+            'received': len(manifest),
+            'stored': len(receipt_files),
+            'valid': sum(1 for receipt_file in receipt_files if receipt_file.is_valid),
+            'rejected': len(manifest) - len(receipt_files),
+        }
+        if not receipt_files:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif queue_extraction:
+            response_status = status.HTTP_202_ACCEPTED
+        else:
+            response_status = status.HTTP_201_CREATED
+        return Response({'summary': summary, 'files': manifest}, status=response_status)
+
 class ValidateReceiptView(APIView):
     def post(self, request, *args, **kwargs):
         receipt_file_id = request.data.get('receipt_file_id')
@@ -133,18 +312,18 @@ class ValidateReceiptView(APIView):
         except ReceiptFile.DoesNotExist:
             return Response({'error': 'ReceiptFile not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        full_file_path = os.path.join(settings.MEDIA_ROOT, receipt_file.file_path)
-
-        is_valid, invalid_reason = validate_pdf(full_file_path)
+        with get_receipt_storage().local_path(receipt_file.file_path) as full_file_path:
+            is_valid, invalid_reason = validate_pdf(full_file_path)
 
         receipt_file.is_valid = is_valid
         receipt_file.invalid_reason = invalid_reason
-        receipt_file.save()
+        receipt_file.save(update_fields=['is_valid', 'invalid_reason', 'updated_at'])
 
         serializer = ReceiptFileSerializer(receipt_file)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 class ProcessReceiptView(APIView):
+    @instrumented('process')
     def post(self, request, *args, **kwargs):
         receipt_file_id = request.data.get('receipt_file_id')
         if not receipt_file_id:
@@ -154,68 +333,320 @@ class ProcessReceiptView(APIView):
             receipt_file = ReceiptFile.objects.get(id=receipt_file_id)
         except ReceiptFile.DoesNotExist:
             return Response({'error': 'ReceiptFile not found'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            split_mode = requested_split_mode(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         if not receipt_file.is_valid:
             return Response({'error': f'File is not valid: {receipt_file.invalid_reason}'}, status=status.HTTP_400_BAD_REQUEST)
         if receipt_file.is_processed:
             return Response({'message': 'Receipt already processed.'}, status=status.HTTP_200_OK)
-
-        full_file_path = os.path.join(settings.MEDIA_ROOT, receipt_file.file_path)
+        if split_mode is not None and split_mode != receipt_file.split_mode:
+            receipt_file.split_mode = split_mode
+            receipt_file.save(update_fields=['split_mode', 'updated_at'])
 
         try:
-            parsed_data, raw_gemini_response = extract_details_with_gemini(full_file_path)
-
-            if parsed_data is None:
-                receipt_file.is_processed = False
-                receipt_file.invalid_reason = f"Gemini extraction failed: {raw_gemini_response}"
-                receipt_file.save()
+            try:
+                with get_receipt_storage().local_path(receipt_file.file_path) as full_file_path, open_mapped(full_file_path) as pdf_data:
+                    receipts = extract_and_save(receipt_file, full_file_path, pdf_data=pdf_data)
+            except ExtractionFailed:
+                fail('extraction_failed')
                 return Response(
                     {'message': 'AI extraction failed.', 'receipt_file': ReceiptFileSerializer(receipt_file).data},
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
-
-            # Basic check if Gemini yielded meaningful data
-            if not parsed_data.get('merchant_name') and not parsed_data.get('total_amount') and not parsed_data.get('purchased_at'):
-                receipt_file.is_processed = False
-                receipt_file.invalid_reason = "AI extracted text, but parsing yielded no meaningful data or key fields are missing."
-                receipt_file.save()
+            except EmptyExtraction:
+                fail('empty_extraction')
                 return Response(
                     {'message': 'AI extracted text, but parsing yielded no meaningful data.', 'receipt_file': ReceiptFileSerializer(receipt_file).data},
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
+            except ProviderUnavailable as e:
+                return provider_unavailable_response(e, receipt_file)
 
-            with transaction.atomic():
-                receipt_instance, created = Receipt.objects.update_or_create(
-                    receipt_file=receipt_file,
-                    defaults={
-                        'purchased_at': parsed_data.get('purchased_at'),
-                        'merchant_name': parsed_data.get('merchant_name'),
-                        'total_amount': parsed_data.get('total_amount'),
-                        'parsed_text': raw_gemini_response,
-                    }
-                )
-                receipt_file.is_processed = True
-                receipt_file.save()
-
-            serializer = ReceiptSerializer(receipt_instance)
+            if len(receipts) > 1: # A split PDF
+                return Response({'extracted_receipts': ReceiptSerializer(receipts, many=True).data}, status=status.HTTP_200_OK)
+            serializer = ReceiptSerializer(receipts[0])
             return Response(serializer.data, status=status.HTTP_200_OK)
         except Exception as e:
+            fail('exception')
             receipt_file.is_processed = False
             receipt_file.invalid_reason = f"Processing failed: {str(e)}"
-            receipt_file.save()
+            receipt_file.save(update_fields=['is_processed', 'invalid_reason', 'updated_at'])
             return Response({'error': f'Receipt processing failed: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+def requested_fields(request):
+    """
+    The receipt fields named in ?fields=, or every field except the large ones.
+    Raises ValueError with a user-facing message for unknown names.
+    """
+    available_fields = list(ReceiptDetailSerializer().fields)
+    requested = request.query_params.get('fields')
+    if not requested:
+        return [name for name in available_fields if name not in ReceiptListView.large_fields]
+    fields = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = sorted(set(fields) - set(available_fields))
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def load_fields(receipts, fields, *required_columns):
+    """Restricts a Receipt queryset to the columns and relations the serializer needs for `fields`."""
+    model_fields = {field.name for field in Receipt._meta.concrete_fields}
+    columns = set(required_columns) | (set(fields) & model_fields)
+    if 'thumbnail_url' in fields:
+        columns.add('first_page')
+    if 'receipt_file_details' in fields or 'thumbnail_url' in fields:
+        columns.add('receipt_file')
+        receipts = receipts.select_related('receipt_file')
+    if 'items' in fields:
+        receipts = receipts.prefetch_related('items')
+    return receipts.only(*columns)
+
 class ReceiptListView(APIView):
+    """
+    Newest-first receipt list with keyset pagination.
+    Query params:
+      - cursor: the `next_cursor` from the previous page
+      - limit: page size (default RECEIPT_LIST_PAGE_SIZE, capped at RECEIPT_LIST_MAX_PAGE_SIZE)
+      - fields: comma-separated fields to return; large columns such as parsed_text
+        and the line items are only loaded when asked for here
+      - purchased_after, purchased_before, min_amount, max_amount, currency, merchant:
+        filters, see receipts.filters.filter_receipts
+    """
+    large_fields = ('parsed_text', 'items')
+
+    def get(self, request, *args, **kwargs):
+        try:
+            fields = requested_fields(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            limit = int(request.query_params.get('limit', settings.RECEIPT_LIST_PAGE_SIZE))
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, settings.RECEIPT_LIST_MAX_PAGE_SIZE))
+
+        try:
+            receipts = filter_receipts(Receipt.objects.all(), request.query_params)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        with_files = 'receipt_file_details' in fields or 'thumbnail_url' in fields
+        # Only load the columns we are going to serialize (plus the pagination key)
+        receipts = load_fields(receipts, fields, 'id', 'created_at')
+
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                decode_cursor(cursor)
+            except InvalidCursor:
+                return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+
+        def build():
+            page, next_cursor = paginate_keyset(receipts, cursor, limit)
+            serializer = ReceiptDetailSerializer(page, many=True, fields=fields)
+            return {'results': serializer.data, 'next_cursor': next_cursor}
+
+        # Unchanged data: 304 when the client has it, else the cached payload
+        last_modified, validators, head = list_fingerprint(include_files=with_files)
+        fresh = None
+        if not cursor:
+            # Where to start polling GET /api/receipts/changes/. The head was read before the page,
+            # so changes racing this request show up in the feed; issued now, so never cached.
+            fresh = {'changes_cursor': encode_change_cursor(head, timezone.now())}
+        return conditional_response(request, last_modified, validators, build, fresh)
+
+class ReceiptChangesView(APIView):
+    """
+    Receipts created, updated or deleted since a cursor, oldest change first
+    (see receipts.changes). Deleted receipts are listed by id in `deleted`.
+    Query params:
+      - since: the `next_cursor` of the previous call, or the list's `changes_cursor`;
+        without it the feed starts from the beginning (a full sync)
+      - limit: changes per response (default and cap RECEIPT_LIST_MAX_PAGE_SIZE);
+        call again right away while `has_more` is true
+      - fields: as for the receipt list
+    """
+
     def get(self, request, *args, **kwargs):
-        receipts = Receipt.objects.select_related('receipt_file').all() # Use select_related for optimized queries
-        serializer = ReceiptDetailSerializer(receipts, many=True)
-        return Response(serializer.data)
+        try:
+            fields = requested_fields(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.query_params.get('limit', settings.RECEIPT_LIST_MAX_PAGE_SIZE))
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, settings.RECEIPT_LIST_MAX_PAGE_SIZE))
+
+        since = 0
+        if request.query_params.get('since'):
+            try:
+                since, issued_at = decode_change_cursor(request.query_params['since'])
+            except InvalidCursor:
+                return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+            if is_cursor_expired(issued_at):
+                return Response(
+                    {'error': 'Cursor expired: deletions this old are no longer tracked. Fetch the full list again.'},
+                    status=status.HTTP_410_GONE,
+                )
+
+        receipts = load_fields(Receipt.objects.all(), fields, 'id', 'change_seq')
+        changed, deleted, last_seq, has_more = get_changes(receipts, since, limit)
+        return Response({
+            'results': ReceiptDetailSerializer(changed, many=True, fields=fields).data,
+            'deleted': deleted,
+            'next_cursor': encode_change_cursor(last_seq, timezone.now()),
+            'has_more': has_more,
+        })
+
+class ReceiptSearchView(APIView):
+    """
+    Ranked full-text search over merchant names, line-item descriptions and
+    extracted text (SQLite FTS5). Every word in `q` must match, as a prefix.
+    Only the newest SEARCH_MAX_RANKED_HITS matches are ranked, which keeps
+    very broad queries fast on large tables.
+    Query params:
+      - q: search text
+      - cursor: the `next_cursor` from the previous page
+      - limit: page size (default RECEIPT_LIST_PAGE_SIZE, capped at RECEIPT_LIST_MAX_PAGE_SIZE)
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not is_search_available():
+            return Response({'error': 'Search requires the SQLite database backend.'}, status=status.HTTP_501_NOT_IMPLEMENTED)
+        match_query = build_match_query(request.query_params.get('q'))
+        if match_query is None:
+            return Response({'error': 'q is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            limit = int(request.query_params.get('limit', settings.RECEIPT_LIST_PAGE_SIZE))
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, settings.RECEIPT_LIST_MAX_PAGE_SIZE))
+
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                score, last_id, floor = decode_search_cursor(cursor)
+            except InvalidCursor:
+                return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+            after = (score, last_id)
+        else:
+            after, floor = None, get_rank_floor(match_query, settings.SEARCH_MAX_RANKED_HITS)
+
+        hits = search_receipt_ids(match_query, after, limit, floor)
+        next_cursor = None
+        if len(hits) > limit:
+            hits = hits[:limit]
+            next_cursor = encode_search_cursor(hits[-1][1], hits[-1][0], floor)
+
+        receipts = Receipt.objects.select_related('receipt_file').defer('parsed_text').in_bulk([receipt_id for receipt_id, _ in hits])
+        page = [receipts[receipt_id] for receipt_id, _ in hits if receipt_id in receipts]
+        fields = [name for name in ReceiptDetailSerializer().fields if name not in ReceiptListView.large_fields]
+        serializer = ReceiptDetailSerializer(page, many=True, fields=fields)
+        return Response({'results': serializer.data, 'next_cursor': next_cursor})
+
+class ReceiptExportView(View):
+    """
+    Every receipt matching the filters, streamed as a file download in id order.
+    A plain Django view: DRF would treat ?format= as a renderer choice.
+    Query params:
+      - format: csv (default), ndjson or parquet (needs pyarrow)
+      - purchased_after, purchased_before, min_amount, max_amount, currency, merchant:
+        filters, see receipts.filters.filter_receipts
+    """
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get('format', 'csv').lower()
+        if export_format not in FORMATS:
+            return JsonResponse({'error': f"format must be one of: {', '.join(FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            receipts = filter_receipts(Receipt.objects.all(), request.GET)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            content = stream_export(receipts, export_format)
+        except ExportUnavailable as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_501_NOT_IMPLEMENTED)
+
+        response = StreamingHttpResponse(content, content_type=CONTENT_TYPES[export_format])
+        response['Content-Disposition'] = f'attachment; filename="receipts-{timezone.now():%Y%m%d-%H%M%S}.{export_format}"'
+        return response
+
+class ReceiptThumbnailView(View):
+    """
+    First-page thumbnail of a receipt (RECEIPT_THUMBNAIL_WIDTH pixels wide),
+    rendered on first request and then served from the disk cache. The URL in the
+    serializers' thumbnail_url carries a ?v= version, so browsers may keep it forever.
+    """
+    cache_control = 'public, max-age=31536000, immutable'
+
+    def get(self, request, id, *args, **kwargs):
+        receipt = (
+            Receipt.objects.filter(id=id).select_related('receipt_file')
+            .only('first_page', 'receipt_file__id', 'receipt_file__file_path', 'receipt_file__content_hash').first()
+        )
+        if receipt is None:
+            return JsonResponse({'error': 'Receipt not found'}, status=status.HTTP_404_NOT_FOUND)
+        receipt_file, page = receipt.receipt_file, receipt.first_page or 1
+
+        etag = quote_etag(thumbnails.thumbnail_version(receipt_file.content_hash, page)) if receipt_file.content_hash else None
+        if etag:
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                not_modified['ETag'], not_modified['Cache-Control'] = etag, self.cache_control
+                return not_modified
+        try:
+            path = thumbnails.get_receipt_thumbnail(receipt_file, page)
+        except ImproperlyConfigured:
+            raise
+        except Exception as e:
+            return JsonResponse({'error': f'Thumbnail could not be rendered: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        response = FileResponse(open(path, 'rb'), content_type=thumbnails.CONTENT_TYPES[thumbnails.get_thumbnail_format()])
+        response['ETag'] = quote_etag(thumbnails.thumbnail_version(receipt_file.content_hash, page))
+        response['Cache-Control'] = self.cache_control
+        return response
 
 class ReceiptDetailView(APIView):
+    def get(self, request, id, *args, **kwargs):
+        fingerprint = detail_fingerprint(id)
+        if fingerprint is None:
+            return Response({'error': 'Receipt not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        def build():
+            receipt = Receipt.objects.select_related('receipt_file').prefetch_related('items').get(id=id)
+            return ReceiptDetailSerializer(receipt).data
+
+        return conditional_response(request, *fingerprint, build)
+
+class ExtractionJobDetailView(APIView):
     def get(self, request, id, *args, **kwargs):
         try:
-            receipt = Receipt.objects.select_related('receipt_file').get(id=id)
-            serializer = ReceiptDetailSerializer(receipt)
+            job = ExtractionJob.objects.select_related('receipt_file').get(id=id)
+            serializer = ExtractionJobSerializer(job)
             return Response(serializer.data)
-        except Receipt.DoesNotExist:
-            return Response({'error': 'Receipt not found'}, status=status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+        except ExtractionJob.DoesNotExist:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+
+class ExtractionCacheStatsView(APIView):
+    def get(self, request, *args, **kwargs):
+        return Response(get_cache_stats())
+
+class ExtractionStatsView(APIView):
+    def get(self, request, *args, **kwargs):
+        return Response({
+            'paths': get_path_stats(),
+            'cache': get_cache_stats(),
+            'preprocessing': get_preprocess_stats(),
+            'thumbnails': thumbnails.get_thumbnail_stats(),
+            'near_duplicates': get_near_duplicate_stats(),
+            'batching': get_batching_stats(),
+        })
+
+def metrics_view(request):
+    """Prometheus scrape endpoint (text exposition format 0.0.4)."""
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')